@@ -0,0 +1,315 @@
+"""
+columnar pet analytics with NumPy
+
+Reports (age distribution, adoption rates per shelter and breed, species
+mix) need a few numbers from every pet, not Pet objects.  pet_columns()
+reads the pet table through one Core select, NULLs already replaced in
+SQL, straight into NumPy arrays; the breed, species and shelter dimensions
+are small and come back as lookup arrays indexed by id.  Every aggregate is
+then a numpy.bincount() over an id column:
+
+    pets = pet_columns(conn)
+    dims = dimensions(conn)
+    adoption_by(pets, 'shelter_id')       # ids, pets, adopted, rate
+    species_mix(pets, dims)
+
+to_arrow() turns the columns into a pyarrow Table when pyarrow is
+installed, for handing to other tools without a copy per row.
+
+run as a script to benchmark against SQL GROUP BY and Python loops over ORM
+objects:
+
+    python analytics.py [url] [number of pets]
+
+needs numpy; pyarrow is optional.
+"""
+import collections
+import importlib
+import timeit
+
+import numpy
+from sqlalchemy import case, func, select
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+DEFAULT_CHUNK_SIZE = 100000
+
+# column -> (dtype, what NULL becomes); ids start at 1 so 0 means none, and
+# an age of -1 means unknown
+PET_COLUMNS = collections.OrderedDict([
+    ('id', (numpy.int64, None)),
+    ('age', (numpy.int32, -1)),
+    ('adopted', (numpy.int8, 0)),
+    ('breed_id', (numpy.int32, 0)),
+    ('shelter_id', (numpy.int32, 0)),
+])
+
+Dimensions = collections.namedtuple('Dimensions', 'breed_names breed_species species_names shelter_names')
+
+Adoption = collections.namedtuple('Adoption', 'ids pets adopted rate')
+
+
+################################################################################
+# reading columns
+
+def pet_statement(where=None):
+    "the pet columns, NULLs replaced, in id order"
+    pet = model.Pet.__table__
+    columns = []
+    for name, (dtype, null) in PET_COLUMNS.items():
+        column = pet.c[name]
+        if name == 'adopted':
+            # booleans come back as bool on Postgres, 0/1 on SQLite
+            column = case((column.is_(True), 1), else_=0)
+        elif null is not None:
+            column = func.coalesce(column, null)
+        columns.append(column.label(name))
+    q = select(*columns).order_by(pet.c.id)
+    if where is not None:
+        q = q.where(where)
+    return q
+
+
+def pet_columns(conn, where=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    {column: numpy array} for every pet (or those matching where), read in
+    chunks of chunk_size rows so only one chunk is ever held as Python tuples
+    """
+    result = conn.execute(pet_statement(where).execution_options(
+        stream_results=True, yield_per=chunk_size))
+    dtypes = [dtype for dtype, null in PET_COLUMNS.values()]
+    chunks = [[] for dtype in dtypes]
+    for partition in result.partitions(chunk_size):
+        # transposing the tuples is about 4x faster than handing numpy the
+        # Row objects, which it walks through the slow sequence protocol
+        for chunk, dtype, values in zip(chunks, dtypes, zip(*partition)):
+            chunk.append(numpy.array(values, dtype=dtype))
+    return collections.OrderedDict(
+        (name, numpy.concatenate(chunk) if chunk else numpy.empty(0, dtype))
+        for name, chunk, dtype in zip(PET_COLUMNS, chunks, dtypes))
+
+
+def _lookup(rows, size_hint=0, default=None, dtype=object):
+    "an array indexed by id from (id, value) rows; ids never seen hold default"
+    rows = list(rows)
+    size = max([size_hint] + [id + 1 for id, value in rows])
+    values = numpy.full(size, default, dtype=dtype)
+    for id, value in rows:
+        values[id] = value
+    return values
+
+
+def dimensions(conn):
+    "breed, species and shelter names, and each breed's species, indexed by id"
+    breed = model.Breed.__table__
+    species = model.Species.__table__
+    shelter = model.Shelter.__table__
+    breeds = list(conn.execute(select(breed.c.id, breed.c.name, breed.c.species_id)))
+    return Dimensions(
+        breed_names=_lookup((id, name) for id, name, species_id in breeds),
+        breed_species=_lookup(((id, species_id) for id, name, species_id in breeds),
+                              default=0, dtype=numpy.int32),
+        species_names=_lookup(conn.execute(select(species.c.id, species.c.name))),
+        shelter_names=_lookup(conn.execute(select(shelter.c.id, shelter.c.name))),
+    )
+
+
+def to_arrow(columns):
+    "a pyarrow Table over the columns"
+    if pyarrow is None:
+        raise ImportError("to_arrow() needs the pyarrow package")
+    return pyarrow.table(columns)
+
+
+################################################################################
+# aggregates
+
+def age_histogram(pets):
+    "{age: pets}, unknown ages left out"
+    ages = pets['age'][pets['age'] >= 0]
+    counts = numpy.bincount(ages)
+    return dict((int(age), int(n)) for age, n in enumerate(counts) if n)
+
+
+def adoption_by(pets, key):
+    "Adoption per value of key, e.g. 'shelter_id' or 'breed_id', none (0) left out"
+    ids = pets[key]
+    totals = numpy.bincount(ids)
+    adopted = numpy.bincount(ids, weights=pets['adopted']).astype(numpy.int64)
+    present = numpy.nonzero(totals)[0]
+    present = present[present > 0]
+    return Adoption(present, totals[present], adopted[present],
+                    adopted[present] / totals[present].astype(numpy.float64))
+
+
+def mean_age_by(pets, key):
+    "{value of key: mean known age}"
+    known = pets['age'] >= 0
+    ids = pets[key][known]
+    totals = numpy.bincount(ids)
+    sums = numpy.bincount(ids, weights=pets['age'][known])
+    present = numpy.nonzero(totals)[0]
+    return dict((int(i), float(sums[i] / totals[i])) for i in present if i > 0)
+
+
+def species_mix(pets, dims):
+    "{species name: pets}, through each pet's breed"
+    breed_ids = pets['breed_id']
+    species_ids = dims.breed_species[breed_ids[breed_ids > 0]]
+    counts = numpy.bincount(species_ids)
+    return dict((dims.species_names[i], int(n)) for i, n in enumerate(counts) if n and i > 0)
+
+
+def report(conn):
+    """
+    the reporting numbers, vectorized; per shelter and breed numbers are
+    keyed by id, shelter names come separately as they needn't be unique
+    """
+    pets = pet_columns(conn)
+    dims = dimensions(conn)
+    by_shelter = adoption_by(pets, 'shelter_id')
+    by_breed = adoption_by(pets, 'breed_id')
+    return {
+        'pets': len(pets['id']),
+        'age_histogram': age_histogram(pets),
+        'adoption_by_shelter': dict((i, (int(n), int(a))) for i, n, a in zip(*by_shelter[:3])),
+        'shelter_names': dict((i, name) for i, name in enumerate(dims.shelter_names) if name is not None),
+        'adoption_by_breed': dict((i, (int(n), int(a))) for i, n, a in zip(*by_breed[:3])),
+        'species_mix': species_mix(pets, dims),
+    }
+
+
+################################################################################
+# the same numbers two other ways, for the benchmark
+
+def report_sql(conn):
+    "the report through one GROUP BY per aggregate"
+    pet = model.Pet.__table__
+    breed = model.Breed.__table__
+    species = model.Species.__table__
+    shelter = model.Shelter.__table__
+    adopted = func.sum(case((pet.c.adopted.is_(True), 1), else_=0))
+    return {
+        'pets': conn.execute(select(func.count()).select_from(pet)).scalar(),
+        'age_histogram': dict(tuple(row) for row in conn.execute(
+            select(pet.c.age, func.count()).where(pet.c.age.isnot(None)).group_by(pet.c.age))),
+        'adoption_by_shelter': dict((i, (n, a)) for i, n, a in conn.execute(
+            select(pet.c.shelter_id, func.count(), adopted)
+            .where(pet.c.shelter_id.isnot(None)).group_by(pet.c.shelter_id))),
+        'shelter_names': dict(tuple(row) for row in conn.execute(select(shelter.c.id, shelter.c.name))),
+        'adoption_by_breed': dict((i, (n, a)) for i, n, a in conn.execute(
+            select(pet.c.breed_id, func.count(), adopted)
+            .where(pet.c.breed_id.isnot(None)).group_by(pet.c.breed_id))),
+        'species_mix': dict(tuple(row) for row in conn.execute(
+            select(species.c.name, func.count())
+            .select_from(pet.join(breed, pet.c.breed_id == breed.c.id)
+                         .join(species, breed.c.species_id == species.c.id))
+            .group_by(species.c.id, species.c.name))),
+    }
+
+
+def report_orm(session):
+    "the report by looping over Pet objects, what reporting code does today"
+    ages = collections.Counter()
+    by_shelter = collections.defaultdict(lambda: [0, 0])
+    by_breed = collections.defaultdict(lambda: [0, 0])
+    mix = collections.Counter()
+    species_names = dict((s.id, s.name) for s in session.query(model.Species))
+    breed_species = dict((b.id, b.species_id) for b in session.query(model.Breed))
+    shelter_names = dict((s.id, s.name) for s in session.query(model.Shelter))
+    count = 0
+    for pet in session.query(model.Pet).yield_per(10000):
+        count += 1
+        if pet.age is not None:
+            ages[pet.age] += 1
+        if pet.shelter_id is not None:
+            by_shelter[pet.shelter_id][0] += 1
+            by_shelter[pet.shelter_id][1] += 1 if pet.adopted else 0
+        if pet.breed_id is not None:
+            by_breed[pet.breed_id][0] += 1
+            by_breed[pet.breed_id][1] += 1 if pet.adopted else 0
+            mix[species_names[breed_species[pet.breed_id]]] += 1
+    return {
+        'pets': count,
+        'age_histogram': dict(ages),
+        'adoption_by_shelter': dict((k, tuple(v)) for k, v in by_shelter.items()),
+        'shelter_names': shelter_names,
+        'adoption_by_breed': dict((k, tuple(v)) for k, v in by_breed.items()),
+        'species_mix': dict(mix),
+    }
+
+
+################################################################################
+# benchmark
+
+def benchmark(engine, num_pets):
+    bulk_load = importlib.import_module('bulk_load')
+    model.init_db(engine)
+    bulk_load.load_pets(engine, bulk_load.synthetic_records(num_pets))
+    # shelter names aren't unique, the demo has several Happy Animal Places
+    shelter = model.Shelter.__table__
+    with engine.begin() as conn:
+        conn.execute(shelter.update().where(shelter.c.id.in_([1, 2])).values(name='Happy Animal Place'))
+
+    results = {}
+    with engine.connect() as conn:
+        start = timeit.default_timer()
+        pets = pet_columns(conn)
+        dims = dimensions(conn)
+        read = timeit.default_timer() - start
+        start = timeit.default_timer()
+        adoption_by(pets, 'shelter_id')
+        adoption_by(pets, 'breed_id')
+        age_histogram(pets)
+        species_mix(pets, dims)
+        aggregate = timeit.default_timer() - start
+        log.info("numpy: columns read in {:.3f}s, aggregates in {:.4f}s".format(read, aggregate))
+
+        start = timeit.default_timer()
+        results['numpy'] = (report(conn), timeit.default_timer() - start)
+        start = timeit.default_timer()
+        results['sql group by'] = (report_sql(conn), timeit.default_timer() - start)
+    db_session = db.make_session(engine)()
+    start = timeit.default_timer()
+    results['orm loop'] = (report_orm(db_session), timeit.default_timer() - start)
+    db_session.close()
+
+    expected = results['sql group by'][0]
+    for name, (numbers, elapsed) in sorted(results.items()):
+        assert numbers == expected, name
+        log.info("{:>12}: full report over {} pets in {:.3f}s".format(name, num_pets, elapsed))
+    if pyarrow is not None:
+        log.info("arrow: {}".format(to_arrow(pets).schema))
+    return results
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    num_pets = int(args[0]) if args else 1000000
+
+    engine = db.make_engine(url)
+    benchmark(engine, num_pets)
+    engine.dispose()
+    log.info("all done!")
@@ -0,0 +1,221 @@
+"""
+bulk writes for the breed/trait and pet/person association tables
+
+The demos link traits with BreedTrait(breed=[golden, dalm]) and nicknames
+with person.pet_associations.append(...), one tracked object per link.  The
+functions here take plain tuples instead
+
+    link_traits(conn, [(golden, fluffy), (dalm.id, spotted.id)])
+    add_nicknames(conn, [(spot, tom, 'Spotty'), (goldie.id, sue.id, 'Goldie')])
+
+and write them with one INSERT ... ON CONFLICT DO NOTHING executemany per
+chunk.  A link that is already there, in the database or earlier in the same
+call, is skipped by the unique index (ux_breed_breedtrait) or constraint
+(person_pet_uniqueness_constraint) instead of failing the batch.  Pets,
+people, breeds and traits can be given as objects or ids.
+
+run as a script to benchmark against ORM appends:
+
+    python associations.py [url] [number of associations]
+"""
+import importlib
+import random
+import timeit
+
+from sqlalchemy import func, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+DEFAULT_CHUNK_SIZE = 10000
+
+# dialects whose insert() knows on_conflict_do_nothing()
+INSERTS = {
+    'sqlite': sqlite.insert,
+    'postgresql': postgresql.insert,
+}
+
+
+################################################################################
+# inserting
+
+def _id(value):
+    "an object's id, or the value itself when it already is one"
+    return getattr(value, 'id', value)
+
+
+def insert_ignoring_conflicts(conn, table, rows, index_elements):
+    """
+    insert rows, skipping any that would violate the unique index on
+    index_elements; returns the number inserted, None if the driver can't say
+    """
+    if not rows:
+        return 0
+    try:
+        insert = INSERTS[conn.dialect.name]
+    except KeyError:
+        raise ValueError("no ON CONFLICT DO NOTHING for {}".format(conn.dialect.name))
+    statement = insert(table).on_conflict_do_nothing(index_elements=index_elements)
+    rowcount = conn.execute(statement, rows).rowcount
+    return rowcount if rowcount >= 0 else None
+
+
+def _insert_chunks(conn, table, rows, index_elements, chunk_size):
+    bulk_load = importlib.import_module('bulk_load')
+    inserted = 0
+    for chunk in bulk_load.chunked(rows, chunk_size):
+        count = insert_ignoring_conflicts(conn, table, chunk, index_elements)
+        inserted = None if inserted is None or count is None else inserted + count
+    return inserted
+
+
+def link_traits(conn, pairs, chunk_size=DEFAULT_CHUNK_SIZE):
+    "give breeds their traits from (breed, trait) pairs, returns the links added"
+    table = model.breed_breedtrait_table
+    rows = ({'breed_id': _id(breed), 'breedtrait_id': _id(trait)} for breed, trait in pairs)
+    return _insert_chunks(conn, table, rows, ['breed_id', 'breedtrait_id'], chunk_size)
+
+
+def add_nicknames(conn, triples, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    record (pet, person, nickname) triples, returns the associations added;
+    a pet/person pair that already has one keeps its nickname
+    """
+    table = model.PetPersonAssociation.__table__
+    rows = ({'pet_id': _id(pet), 'person_id': _id(person), 'nickname': nickname}
+            for pet, person, nickname in triples)
+    return _insert_chunks(conn, table, rows, ['pet_id', 'person_id'], chunk_size)
+
+
+################################################################################
+# benchmark
+
+def seed(engine, num_pets, people, num_traits=20):
+    "pets, people and traits to link"
+    bulk_load = importlib.import_module('bulk_load')
+    model.init_db(engine)
+    bulk_load.load_pets(engine, bulk_load.synthetic_records(num_pets))
+    with engine.begin() as conn:
+        conn.execute(model.Person.__table__.insert(), [
+            {'first_name': 'First{}'.format(i), 'last_name': 'Last{}'.format(i)}
+            for i in range(people)])
+        conn.execute(model.BreedTrait.__table__.insert(), [
+            {'name': 'Trait{}'.format(i)} for i in range(num_traits)])
+
+
+def triples(num_associations, num_pets, people, duplicates=0.1, seed=0):
+    "random (pet_id, person_id, nickname) triples, a fraction of them repeats"
+    rng = random.Random(seed)
+    seen = []
+    result = []
+    while len(result) < num_associations:
+        if seen and rng.random() < duplicates:
+            result.append(rng.choice(seen))
+            continue
+        triple = (rng.randrange(num_pets) + 1, rng.randrange(people) + 1,
+                  'nick{}'.format(len(result)))
+        seen.append(triple)
+        result.append(triple)
+    return result
+
+
+def add_nicknames_orm(session, triples, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    the demo way: one PetPersonAssociation per link appended to the person,
+    duplicates filtered in Python first since the ORM has no ON CONFLICT
+    """
+    existing = set(tuple(row) for row in session.execute(
+        select(model.PetPersonAssociation.pet_id, model.PetPersonAssociation.person_id)))
+    people = {}
+    pets = {}
+    count = 0
+    for pet_id, person_id, nickname in triples:
+        if (pet_id, person_id) in existing:
+            continue
+        existing.add((pet_id, person_id))
+        if person_id not in people:
+            people[person_id] = session.get(model.Person, person_id)
+        if pet_id not in pets:
+            pets[pet_id] = session.get(model.Pet, pet_id)
+        people[person_id].pet_associations.append(
+            model.PetPersonAssociation(pet=pets[pet_id], nickname=nickname))
+        count += 1
+        if count % chunk_size == 0:
+            session.commit()
+    session.commit()
+    return count
+
+
+def count_associations(engine):
+    with engine.connect() as conn:
+        return conn.execute(select(func.count())
+                            .select_from(model.PetPersonAssociation.__table__)).scalar()
+
+
+def benchmark(engine, num_associations, chunk_size=DEFAULT_CHUNK_SIZE):
+    num_pets = max(1, num_associations // 2)
+    people = 1000
+    links = triples(num_associations, num_pets, people)
+    unique = len(set((p, q) for p, q, n in links))
+    results = {}
+
+    seed(engine, num_pets, people)
+    db_session = db.make_session(engine)()
+    start = timeit.default_timer()
+    assert add_nicknames_orm(db_session, links, chunk_size) == unique
+    results['orm append'] = timeit.default_timer() - start
+    db_session.close()
+    assert count_associations(engine) == unique
+
+    seed(engine, num_pets, people)
+    start = timeit.default_timer()
+    with engine.begin() as conn:
+        added = add_nicknames(conn, links, chunk_size)
+    results['on conflict'] = timeit.default_timer() - start
+    assert added in (unique, None)
+    assert count_associations(engine) == unique
+
+    # a second pass adds nothing
+    with engine.begin() as conn:
+        assert add_nicknames(conn, links, chunk_size) in (0, None)
+    assert count_associations(engine) == unique
+
+    for name, elapsed in sorted(results.items()):
+        log.info("{:>11}: {} links ({} unique) in {:.3f}s, {:,.0f} links/sec".format(
+            name, len(links), unique, elapsed, len(links) / elapsed))
+    log.info("speedup: {:.1f}x".format(results['orm append'] / results['on conflict']))
+
+    # breed traits the same way
+    with engine.begin() as conn:
+        breed_ids = list(conn.execute(select(model.Breed.__table__.c.id)).scalars())
+        trait_ids = list(conn.execute(select(model.BreedTrait.__table__.c.id)).scalars())
+        pairs = [(b, t) for b in breed_ids for t in trait_ids] * 2
+        assert link_traits(conn, pairs) in (len(pairs) // 2, None)
+    return results
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    num_associations = int(args[0]) if args else 100000
+
+    engine = db.make_engine(url)
+    benchmark(engine, num_associations)
+    engine.dispose()
+    log.info("all done!")
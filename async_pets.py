@@ -0,0 +1,347 @@
+"""
+asyncio mode for the domain model
+
+The same Base models from many-to-many.py, driven through
+create_async_engine() and AsyncSession (aiosqlite locally, asyncpg for
+Postgres), so a web tier does not block on every Pet/Person query.
+
+AsyncSession cannot lazy load, so everything here either sets foreign keys
+directly or loads relationships up front through the queries.py profiles.
+
+run as a script to seed a database and compare concurrent pet lookups
+through asyncio against the threaded sync path:
+
+    python async_pets.py [url] [concurrency] [lookups] [pets] [latency ms]
+
+latency is simulated network time added to every request, standing in for
+a remote database.  aiosqlite runs every connection in its own thread, so
+against a local SQLite file expect the sync path to come out ahead; the
+comparison is meant for asyncpg against a real server.
+
+needs Python 3 and the aiosqlite package (or asyncpg for Postgres).
+"""
+import asyncio
+import importlib
+import os
+import tempfile
+import time
+import timeit
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, StaticPool
+
+import db
+import queries
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+bulk_load = importlib.import_module('bulk_load')
+
+# sync driver name -> async driver to swap in
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+
+################################################################################
+# engines and sessions
+
+def to_async_url(url):
+    "swap the sync driver in url for its async counterpart"
+    url = make_url(url)
+    if url.get_backend_name() not in ASYNC_DRIVERS:
+        raise ValueError("no async driver known for {}".format(url))
+    if url.drivername in ASYNC_DRIVERS.values():
+        return url
+    return url.set(drivername=ASYNC_DRIVERS[url.get_backend_name()])
+
+
+def make_async_engine(url=None, pool_size=None, max_overflow=None,
+                      sqlite_pragmas=db.SQLITE_PRAGMAS, **kwargs):
+    """
+    create an AsyncEngine, defaulting to the command line/environment URL
+
+    pooling follows db.make_engine(): one shared connection for in-memory
+    SQLite, a sized queue pool for SQLite files, and SQLite gets the same
+    pragmas
+    """
+    if url is None:
+        url = db.get_url()
+    url = to_async_url(url)
+    if pool_size is not None:
+        kwargs['pool_size'] = pool_size
+    if max_overflow is not None:
+        kwargs['max_overflow'] = max_overflow
+    if url.get_backend_name() == 'sqlite':
+        if db.is_sqlite_memory(url):
+            kwargs.setdefault('poolclass', StaticPool)
+            kwargs.pop('pool_size', None)
+            kwargs.pop('max_overflow', None)
+        else:
+            kwargs.setdefault('poolclass', AsyncAdaptedQueuePool)
+    engine = create_async_engine(url, **kwargs)
+
+    if url.get_backend_name() == 'sqlite' and sqlite_pragmas:
+        @event.listens_for(engine.sync_engine, 'connect')
+        def on_connect(dbapi_connection, connection_record):
+            db.set_sqlite_pragmas(dbapi_connection, sqlite_pragmas)
+
+    log.info("make_async_engine(): {}".format(engine))
+    return engine
+
+
+def make_async_session(engine):
+    """
+    an AsyncSession factory bound to engine
+
+    expire_on_commit is off, since touching an expired attribute would need
+    an implicit (and under asyncio, impossible) refresh
+    """
+    return sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+
+async def init_db(engine):
+    "initialize our database, drops and creates our tables"
+    log.info("init_db() engine: {}".format(engine))
+    async with engine.begin() as conn:
+        await conn.run_sync(model.Base.metadata.drop_all)
+        await conn.run_sync(model.Base.metadata.create_all)
+    log.info("  - tables dropped and created")
+
+
+################################################################################
+# seeding
+
+async def seed_demo(session):
+    """
+    the people, pets, breeds, traits and nicknames from the many-to-many
+    demo, returns the pets by name
+    """
+    tom = model.Person(first_name="Tom", last_name="Smith", age=52, phone='555-555-5555')
+    sue = model.Person(first_name="Sue", last_name="Johson", age=54, phone='555 243 9988')
+
+    dog = model.Species(name="Dog")
+    dalm = model.Breed(name="Dalmatian", species=dog)
+    golden = model.Breed(name="Golden Retriever", species=dog)
+    shelter = model.Shelter(name="Happy Animal Place")
+
+    spot = model.Pet(name="Spot", age=2, adopted=True, breed=dalm)
+    goldiemom = model.Pet(name="GoldieMom", age=13, adopted=False, shelter=shelter, breed=golden)
+    goldiedad = model.Pet(name="GoldieDad", age=15, adopted=False, shelter=shelter, breed=golden)
+    session.add_all([spot, goldiemom, goldiedad, tom, sue])
+    await session.commit()
+
+    goldie = model.Pet(name="Goldie", age=9, adopted=False, shelter=shelter, breed=golden,
+                       right_pet_id=goldiemom.id, left_pet_id=goldiedad.id)
+    session.add(goldie)
+    await session.commit()
+
+    kids = [model.Pet(name="GoldieKid{}".format(n), age=n, adopted=False, shelter=shelter,
+                      breed=golden, right_pet_id=goldie.id) for n in (1, 2)]
+    session.add_all(kids)
+    await session.commit()
+
+    session.add_all([
+        model.BreedTrait(name="Fluffy", breed=[golden]),
+        model.BreedTrait(name="ShortHair", breed=[dalm]),
+        model.BreedTrait(name="Friendly", breed=[golden, dalm]),
+    ])
+    session.add_all([
+        model.PetPersonAssociation(pet_id=spot.id, person_id=sue.id, nickname="cheerio"),
+        model.PetPersonAssociation(pet_id=spot.id, person_id=tom.id, nickname="buddy"),
+        model.PetPersonAssociation(pet_id=goldie.id, person_id=sue.id, nickname="happy"),
+    ])
+    await session.commit()
+
+    pets = [spot, goldiemom, goldiedad, goldie] + kids
+    return dict((pet.name, pet) for pet in pets)
+
+
+async def nicknames(session, pet_id):
+    "the nicknames for a pet, without going through the lazy loader"
+    assoc = model.PetPersonAssociation
+    result = await session.execute(
+        select(assoc.nickname).where(assoc.pet_id == pet_id).order_by(assoc.id))
+    return result.scalars().all()
+
+
+async def count(session, entity):
+    "number of rows for a mapped class"
+    result = await session.execute(select(func.count()).select_from(entity))
+    return result.scalar()
+
+
+################################################################################
+# async bulk pipeline
+
+async def load_pets(engine, records, chunk_size=bulk_load.DEFAULT_CHUNK_SIZE, queue_size=4):
+    """
+    bulk_load.load_pets() for an AsyncEngine, returns the number of pets
+
+    a producer task builds chunks in a worker thread while the writer inserts
+    the previous ones; the bounded queue keeps at most queue_size chunks in
+    memory.  The lookup maps are the sync ones, run through run_sync().
+    """
+    queue = asyncio.Queue(maxsize=queue_size)
+    loop = asyncio.get_running_loop()
+    chunks = bulk_load.chunked(records, chunk_size)
+    done = object()
+
+    async def produce():
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, done)
+                await queue.put(chunk)
+                if chunk is done:
+                    return
+        except BaseException:
+            await queue.put(done)
+            raise
+
+    lookups = bulk_load.LookupMaps()
+    async with engine.connect() as conn:
+        await conn.run_sync(lookups.preload)
+
+    pet = model.Pet.__table__
+    loaded = 0
+    producer = asyncio.ensure_future(produce())
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is done:
+                break
+            async with engine.begin() as conn:
+                await conn.run_sync(lookups.resolve, chunk)
+                await conn.execute(pet.insert(), [lookups.pet_row(r) for r in chunk])
+            loaded += len(chunk)
+            log.debug("  - loaded {} pets".format(loaded))
+        # re-raises anything the producer hit
+        await producer
+    finally:
+        if not producer.done():
+            producer.cancel()
+    return loaded
+
+
+################################################################################
+# concurrent lookup simulator
+
+def _lookup_statement(pet_id):
+    return (select(model.Pet)
+            .options(*queries.loader_options('pet_with_nicknames'))
+            .where(model.Pet.id == pet_id))
+
+
+async def simulate_async(engine, pet_ids, concurrency, latency=0.0):
+    """
+    look up every pet in pet_ids with its nicknames, concurrency requests in
+    flight at once; latency seconds of simulated network time are added to
+    each request.  Returns requests per second.
+    """
+    Session = make_async_session(engine)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def request(pet_id):
+        async with semaphore:
+            async with Session() as session:
+                result = await session.execute(_lookup_statement(pet_id))
+                pet = result.scalars().one()
+                pet.nicknames()
+                if latency:
+                    await asyncio.sleep(latency)
+
+    start = timeit.default_timer()
+    await asyncio.gather(*[request(pet_id) for pet_id in pet_ids])
+    return len(pet_ids) / (timeit.default_timer() - start)
+
+
+def simulate_threaded(engine, pet_ids, concurrency, latency=0.0):
+    "simulate_async() through the sync Session and a thread pool"
+    Session = db.make_session(engine)
+
+    def request(pet_id):
+        session = Session()
+        try:
+            pet = session.execute(_lookup_statement(pet_id)).scalars().one()
+            pet.nicknames()
+            if latency:
+                time.sleep(latency)
+        finally:
+            session.close()
+
+    start = timeit.default_timer()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(request, pet_ids))
+    return len(pet_ids) / (timeit.default_timer() - start)
+
+
+async def main(url, concurrency=100, lookups=2000, num_pets=10000, latency=0.005):
+    engine = make_async_engine(url, pool_size=concurrency, max_overflow=0)
+    await init_db(engine)
+
+    Session = make_async_session(engine)
+    async with Session() as session:
+        pets = await seed_demo(session)
+        assert await nicknames(session, pets['Spot'].id) == ['cheerio', 'buddy']
+        log.info("async seed done, {} pets".format(await count(session, model.Pet)))
+
+    start = timeit.default_timer()
+    loaded = await load_pets(engine, bulk_load.synthetic_records(num_pets), chunk_size=2000)
+    log.info("async bulk loaded {} pets in {:.3f}s".format(
+        loaded, timeit.default_timer() - start))
+
+    pet_ids = [1 + (i * 7919) % num_pets for i in range(lookups)]
+    rate = await simulate_async(engine, pet_ids, concurrency, latency)
+    log.info("asyncio:  {} lookups, {} concurrent: {:,.0f} requests/sec".format(
+        lookups, concurrency, rate))
+    await engine.dispose()
+
+    sync_engine = db.make_engine(url, pool_size=concurrency, max_overflow=0)
+    threaded = simulate_threaded(sync_engine, pet_ids, concurrency, latency)
+    log.info("threaded: {} lookups, {} concurrent: {:,.0f} requests/sec".format(
+        lookups, concurrency, threaded))
+    sync_engine.dispose()
+    log.info("asyncio / threaded: {:.2f}x".format(rate / threaded))
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    path = None
+    if db.is_sqlite_memory(url):
+        # the sync and async engines need to see the same database
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        url = 'sqlite:///{}'.format(path)
+    concurrency = int(args[0]) if len(args) > 0 else 100
+    lookups = int(args[1]) if len(args) > 1 else 2000
+    num_pets = int(args[2]) if len(args) > 2 else 10000
+    latency = float(args[3]) / 1000 if len(args) > 3 else 0.005
+    try:
+        asyncio.run(main(url, concurrency, lookups, num_pets, latency))
+    finally:
+        if path:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+    log.info("all done!")
@@ -0,0 +1,507 @@
+"""
+end-to-end benchmark suite for the pet/shelter model
+
+Each module's own benchmark answers one question about one technique.  This
+suite times what the model and the session setup do day to day, the same
+way every run, so a change to either shows up as a number:
+
+    bulk_insert     bulk_load.load_pets() of every synthetic pet
+    insert          Pet objects added through a Session, committed per 100,
+                    then deleted again so the table stays at its scale
+    pet_by_name     Session query for a pet by name
+    person_by_name  Session query for a person by last and first name
+    nicknames       get() a pet and read pet.nicknames()
+    pedigree        walk_pedigree() five generations up
+    counts          count of pets, pets per shelter, adopted pets
+    cascade_delete  Session.delete() of pets with nicknames and children,
+                    committed per 100, left to ON DELETE CASCADE/SET NULL
+
+at each scale (1k to 10m pets, with one person per 100 pets, two nicknames
+per pet and two parents per pet after the first generation) on an
+in-memory SQLite database and a SQLite file.  Data and operations come
+from fixed seeds, so runs at the same scale do the same work.
+
+Timing: each case runs once untimed to warm the statement caches and the
+page cache, then repeat times.  A sample repeats the case until it has run
+for at least MIN_SAMPLE_SECONDS, so quick cases aren't timed in
+milliseconds, except cascade_delete, which would run out of pets at small
+scales and runs once per sample.  The cases between bulk_insert and
+cascade_delete take their samples in rounds, one of each per round, so a
+slow spell on a shared machine hits all of them a little rather than one
+of them entirely.  Every sample is followed by one of calibrate(), a fixed
+SQLite and Python workload that says how fast the machine was running.  The best
+(lowest) time per operation of the samples is the case's number, and the
+spread, median over best, says how noisy it was.
+
+Results are written as JSON.  Given a baseline from an earlier run, each
+case's best time per operation is compared after dividing out the change
+in calibration, so a slower machine isn't a regression.  Cases that grew
+by more than threshold, plus the larger spread of the two runs, are
+reported as regressions and the exit status is 1:
+
+    python bench.py --output baseline.json
+    ...
+    python bench.py --baseline baseline.json --output results.json
+
+run as a script:
+
+    python bench.py [--scales 1k,10k,100k] [--backends memory,file] [--repeat 10]
+                    [--output FILE] [--baseline FILE] [--threshold 0.2]
+"""
+import argparse
+import collections
+import datetime
+import importlib
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import sqlalchemy
+from sqlalchemy import func, select
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+SCALES = collections.OrderedDict([
+    ('1k', 1000),
+    ('10k', 10000),
+    ('100k', 100000),
+    ('1m', 1000000),
+    ('10m', 10000000),
+])
+DEFAULT_SCALES = ('1k', '10k', '100k')
+BACKENDS = ('memory', 'file')
+
+# pets per generation in the synthetic pedigree
+GENERATION = 100
+SEED = 0
+
+# shortest timed sample; quicker cases loop until they reach it
+MIN_SAMPLE_SECONDS = 0.1
+
+
+################################################################################
+# synthetic data
+
+def seed_people(engine, num_pets, chunk_size=10000):
+    "one person per 100 pets, and two nicknames per pet from different people"
+    bulk_load = importlib.import_module('bulk_load')
+    people = max(10, num_pets // 100)
+    person = model.Person.__table__
+    assoc = model.PetPersonAssociation.__table__
+    with engine.begin() as conn:
+        for chunk in bulk_load.chunked(range(people), chunk_size):
+            conn.execute(person.insert(), [
+                {'first_name': 'First{}'.format(i), 'last_name': 'Last{}'.format(i % 1000),
+                 'age': 18 + i % 70, '_phone': '555-{:03d}-{:04d}'.format(*divmod(i % 10000000, 10000))}
+                for i in chunk])
+    for chunk in bulk_load.chunked(range(1, num_pets + 1), chunk_size):
+        with engine.begin() as conn:
+            conn.execute(assoc.insert(), [
+                {'pet_id': pet_id, 'person_id': (pet_id + n * 7) % people + 1,
+                 'nickname': 'nick{}-{}'.format(pet_id, n)}
+                for pet_id in chunk for n in range(2)])
+    return people
+
+
+def seed_pedigree(engine):
+    "every pet after the first generation gets two parents from the one before"
+    pet = model.Pet.__table__
+    with engine.begin() as conn:
+        conn.execute(pet.update().where(pet.c.id > GENERATION + 1).values(
+            left_pet_id=pet.c.id - GENERATION, right_pet_id=pet.c.id - GENERATION - 1))
+
+
+class Dataset(object):
+    "what the cases need to know about the seeded database"
+
+    def __init__(self, num_pets, people):
+        self.num_pets = num_pets
+        self.people = people
+        self.deleted = set()
+
+    def pet_ids(self, rng, count):
+        "count distinct pet ids not deleted yet"
+        ids = []
+        seen = set()
+        while len(ids) < min(count, self.num_pets - len(self.deleted)):
+            pet_id = rng.randrange(self.num_pets) + 1
+            if pet_id not in self.deleted and pet_id not in seen:
+                seen.add(pet_id)
+                ids.append(pet_id)
+        return ids
+
+
+################################################################################
+# cases: each takes the engine, the Dataset and a seeded Random, and
+# returns the number of operations it did
+
+def case_bulk_insert(engine, data, rng):
+    bulk_load = importlib.import_module('bulk_load')
+    model.init_db(engine)
+    return bulk_load.load_pets(engine, bulk_load.synthetic_records(
+        data.num_pets, shelters=max(10, data.num_pets // 1000), seed=SEED))
+
+
+def case_insert(engine, data, rng, count=1000):
+    pet = model.Pet.__table__
+    db_session = db.make_session(engine)()
+    last_id = db_session.query(func.max(model.Pet.id)).scalar()
+    breeds = db_session.query(model.Breed).all()
+    shelters = db_session.query(model.Shelter).limit(20).all()
+    for i in range(count):
+        db_session.add(model.Pet(name='New pet {}'.format(rng.randrange(10 ** 9)), age=rng.randrange(20),
+                                 adopted=False, breed=rng.choice(breeds), shelter=rng.choice(shelters)))
+        if (i + 1) % 100 == 0:
+            db_session.commit()
+    db_session.commit()
+    db_session.close()
+    # every later sample and case reads the table at its scale
+    with engine.begin() as conn:
+        conn.execute(pet.delete().where(pet.c.id > last_id))
+    return count
+
+
+def case_pet_by_name(engine, data, rng, count=100):
+    db_session = db.make_session(engine)()
+    for pet_id in data.pet_ids(rng, count):
+        pet = db_session.query(model.Pet).filter(model.Pet.name == 'Pet {}'.format(pet_id - 1)).first()
+        assert pet is not None
+    db_session.close()
+    return count
+
+
+def case_person_by_name(engine, data, rng, count=1000):
+    db_session = db.make_session(engine)()
+    for i in range(count):
+        n = rng.randrange(data.people)
+        person = db_session.query(model.Person).filter(
+            model.Person.last_name == 'Last{}'.format(n % 1000),
+            model.Person.first_name == 'First{}'.format(n)).first()
+        assert person is not None
+    db_session.close()
+    return count
+
+
+def case_nicknames(engine, data, rng, count=1000):
+    Session = db.make_session(engine)
+    db_session = Session()
+    for i, pet_id in enumerate(data.pet_ids(rng, count)):
+        assert len(db_session.get(model.Pet, pet_id).nicknames()) == 2
+        if (i + 1) % 100 == 0:
+            db_session.close()
+            db_session = Session()
+    db_session.close()
+    return count
+
+
+def case_pedigree(engine, data, rng, count=50, depth=5):
+    db_session = db.make_session(engine)()
+    for pet_id in data.pet_ids(rng, count):
+        model.walk_pedigree(db_session, pet_id, depth)
+    db_session.close()
+    return count
+
+
+def case_counts(engine, data, rng, count=5):
+    pet = model.Pet.__table__
+    statements = [
+        select(func.count()).select_from(pet),
+        select(pet.c.shelter_id, func.count()).group_by(pet.c.shelter_id),
+        select(func.count()).select_from(pet).where(pet.c.adopted.is_(True)),
+    ]
+    with engine.connect() as conn:
+        for i in range(count):
+            for statement in statements:
+                conn.execute(statement).fetchall()
+    return count * len(statements)
+
+
+def case_cascade_delete(engine, data, rng, count=100):
+    db_session = db.make_session(engine)()
+    # a warm-up and repeat samples mustn't use up the pets at 1k
+    ids = data.pet_ids(rng, min(count, data.num_pets // 20))
+    for i, pet_id in enumerate(ids):
+        db_session.delete(db_session.get(model.Pet, pet_id))
+        if (i + 1) % 100 == 0:
+            db_session.commit()
+    db_session.commit()
+    db_session.close()
+    data.deleted.update(ids)
+    return len(ids)
+
+
+# in the order they run; bulk_insert seeds the database and cascade_delete
+# goes last because it removes rows the others read
+CASES = collections.OrderedDict([
+    ('bulk_insert', case_bulk_insert),
+    ('insert', case_insert),
+    ('pet_by_name', case_pet_by_name),
+    ('person_by_name', case_person_by_name),
+    ('nicknames', case_nicknames),
+    ('pedigree', case_pedigree),
+    ('counts', case_counts),
+    ('cascade_delete', case_cascade_delete),
+])
+
+# cases that run once per sample, cascade_delete would run out of pets at
+# small scales
+ONE_SHOT = ('cascade_delete',)
+
+# cases sampled in rounds, between seeding and deleting
+ROUNDS = [name for name in CASES if name not in ('bulk_insert', 'cascade_delete')]
+
+
+def calibrate(engine, data, rng, count=2000):
+    "a fixed workload with nothing of ours in it: sqlite3 lookups and a Python loop"
+    conn = sqlite3.connect(':memory:')
+    conn.execute("CREATE TABLE t (a INTEGER)")
+    conn.executemany("INSERT INTO t VALUES (?)", [(i,) for i in range(1000)])
+    for i in range(count):
+        conn.execute("SELECT a FROM t WHERE rowid = ?", (i % 1000 + 1,)).fetchall()
+        sum(j * j for j in range(50))
+    conn.close()
+    return count
+
+
+################################################################################
+# running
+
+def metadata():
+    "where and on what the numbers were taken"
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=open(os.devnull, 'w'),
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'commit': commit,
+        'python': platform.python_version(),
+        'sqlalchemy': sqlalchemy.__version__,
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def make_backend(backend):
+    "(engine, path of a file to remove afterwards or None)"
+    if backend == 'memory':
+        return db.make_engine('sqlite://'), None
+    if backend == 'file':
+        fd, path = tempfile.mkstemp(suffix='.db', prefix='pets-bench-')
+        os.close(fd)
+        return db.make_engine('sqlite:///{}'.format(path)), path
+    raise ValueError("unknown backend: {}".format(backend))
+
+
+def sample(name, engine, data, i, min_seconds=MIN_SAMPLE_SECONDS):
+    "(ops, seconds) for one timed sample of case name"
+    case = CASES.get(name, calibrate)
+    ops = 0
+    loop = 0
+    start = timeit.default_timer()
+    while True:
+        ops += case(engine, data, random.Random('{}-{}-{}'.format(name, i, loop)))
+        loop += 1
+        elapsed = timeit.default_timer() - start
+        if elapsed >= min_seconds or name in ONE_SHOT:
+            return ops, elapsed
+
+
+def summary(samples):
+    "the JSON result for a case from its (ops, seconds) samples"
+    per_op = [seconds / ops for ops, seconds in samples]
+    best = min(per_op)
+    median = statistics.median(per_op)
+    return {
+        'ops': [ops for ops, seconds in samples],
+        'seconds': [seconds for ops, seconds in samples],
+        'per_op_us': best * 1e6,
+        'median_per_op_us': median * 1e6,
+        'spread': median / best - 1,
+        'ops_per_sec': 1 / best,
+    }
+
+
+def run_scale(backend, scale, repeat=10):
+    "{case: result} for one backend and scale, on a freshly seeded database"
+    num_pets = SCALES[scale]
+    engine, path = make_backend(backend)
+    data = Dataset(num_pets, max(10, num_pets // 100))
+    samples = collections.OrderedDict((name, []) for name in list(CASES) + ['calibration'])
+    try:
+        def take(name, i):
+            # calibration alongside every sample, so it sees the machine
+            # the way the cases did
+            samples[name].append(sample(name, engine, data, i))
+            samples['calibration'].append(sample('calibration', engine, data, len(samples['calibration'])))
+
+        # bulk_insert starts from dropped tables each time, the last one
+        # leaves the database every other case reads
+        sample('bulk_insert', engine, data, 'warm-up', min_seconds=0)
+        for i in range(repeat):
+            take('bulk_insert', i)
+        seed_people(engine, num_pets)
+        seed_pedigree(engine)
+
+        for name in ROUNDS:
+            sample(name, engine, data, 'warm-up', min_seconds=0)
+        for i in range(repeat):
+            for name in ROUNDS:
+                take(name, i)
+
+        sample('cascade_delete', engine, data, 'warm-up', min_seconds=0)
+        for i in range(repeat):
+            take('cascade_delete', i)
+    finally:
+        engine.dispose()
+        if path:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    results = collections.OrderedDict()
+    for name, case_samples in samples.items():
+        results[name] = result = summary(case_samples)
+        log.info("{:>6} {:>5} {:>15}: {:>7} ops, best {:10.1f}us/op, spread {:5.1%}".format(
+            backend, scale, name, sum(result['ops']), result['per_op_us'], result['spread']))
+    return results
+
+
+def run(scales=DEFAULT_SCALES, backends=BACKENDS, repeat=10):
+    "the suite's JSON document"
+    results = collections.OrderedDict()
+    for backend in backends:
+        for scale in scales:
+            for name, result in run_scale(backend, scale, repeat).items():
+                results['{}/{}/{}'.format(backend, scale, name)] = result
+    return {'meta': metadata(), 'repeat': repeat, 'results': results}
+
+
+################################################################################
+# comparing with a baseline
+
+Comparison = collections.namedtuple('Comparison', 'key baseline current ratio status')
+
+
+def _machine(current, baseline, key):
+    "how much slower the machine ran for key's backend and scale, 1 if unknown"
+    calibration = key.rsplit('/', 1)[0] + '/calibration'
+    if calibration in current['results'] and calibration in baseline['results']:
+        return current['results'][calibration]['per_op_us'] / baseline['results'][calibration]['per_op_us']
+    return 1.0
+
+
+def compare(current, baseline, threshold=0.2):
+    """
+    a Comparison per case in either run: the ratio of best time per op,
+    current over baseline, divided by the same ratio for calibration at that
+    backend and scale, marks a 'regression' above 1 + threshold and an
+    'improvement' below 1 / (1 + threshold), threshold widened by the larger
+    spread of the two runs for that case
+    """
+    comparisons = []
+    # baseline cases at a backend and scale this run skipped aren't missing
+    ran = set(key.rsplit('/', 1)[0] for key in current['results'])
+    keys = list(current['results']) + [k for k in baseline['results']
+                                       if k not in current['results'] and k.rsplit('/', 1)[0] in ran]
+    for key in keys:
+        now = current['results'].get(key)
+        then = baseline['results'].get(key)
+        if now is None or then is None:
+            comparisons.append(Comparison(key, then and then['per_op_us'], now and now['per_op_us'],
+                                          None, 'missing' if now is None else 'new'))
+            continue
+        if key.endswith('/calibration'):
+            comparisons.append(Comparison(key, then['per_op_us'], now['per_op_us'],
+                                          now['per_op_us'] / then['per_op_us'], 'machine'))
+            continue
+        ratio = now['per_op_us'] / then['per_op_us'] / _machine(current, baseline, key)
+        allowed = threshold + max(now.get('spread', 0), then.get('spread', 0))
+        if ratio > 1 + allowed:
+            status = 'regression'
+        elif ratio < 1 / (1 + allowed):
+            status = 'improvement'
+        else:
+            status = 'ok'
+        comparisons.append(Comparison(key, then['per_op_us'], now['per_op_us'], ratio, status))
+    return comparisons
+
+
+def report(comparisons):
+    for c in comparisons:
+        if c.ratio is None:
+            log.info("{:<34} {}".format(c.key, c.status))
+        else:
+            log.info("{:<34} {:10.1f}us -> {:10.1f}us  {:5.2f}x  {}".format(
+                c.key, c.baseline, c.current, c.ratio, c.status))
+    regressions = [c for c in comparisons if c.status == 'regression']
+    log.info("{} cases, {} regressions, {} improvements".format(
+        len(comparisons), len(regressions), sum(1 for c in comparisons if c.status == 'improvement')))
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="end-to-end benchmarks for the pet model")
+    parser.add_argument('--scales', default=','.join(DEFAULT_SCALES),
+                        help="comma separated, from {}".format(', '.join(SCALES)))
+    parser.add_argument('--backends', default=','.join(BACKENDS),
+                        help="comma separated, from {}".format(', '.join(BACKENDS)))
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--output', help="write the results here as JSON")
+    parser.add_argument('--baseline', help="compare with the results in this JSON file")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="slowdown per op counted as a regression, 0.2 is 20%%")
+    args = parser.parse_args(argv)
+    args.scales = [s for s in args.scales.split(',') if s]
+    args.backends = [b for b in args.backends.split(',') if b]
+    for scale in args.scales:
+        if scale not in SCALES:
+            parser.error("unknown scale: {}".format(scale))
+    for backend in args.backends:
+        if backend not in BACKENDS:
+            parser.error("unknown backend: {}".format(backend))
+    return args
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    args = parse_args()
+
+    results = run(args.scales, args.backends, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        log.info("results written to {}".format(args.output))
+    status = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if report(compare(results, baseline, args.threshold)):
+            status = 1
+    log.info("all done!")
+    sys.exit(status)
@@ -0,0 +1,226 @@
+"""
+set-based deletes for pets, shelters and species
+
+Deleting through the session loads every dependent row and deletes them
+one object at a time.  The functions here issue DELETE ... WHERE id IN
+(...) or DELETE ... WHERE <condition> instead, and let the ON DELETE
+CASCADE/SET NULL foreign keys declared in many-to-many.py remove the
+nicknames, pedigree links and breed traits.  On a connection that does not
+enforce foreign keys (SQLite without PRAGMA foreign_keys=ON, which
+db.make_engine() turns on) the dependent rows are deleted explicitly, the
+same set-based way.
+
+Every function takes a connection and leaves the transaction to the caller:
+
+    with engine.begin() as conn:
+        delete_shelters(conn, [shelter_id])
+
+run as a script to benchmark against the ORM cascade:
+
+    python bulk_delete.py [url] [number of associations]
+"""
+import importlib
+import timeit
+
+from sqlalchemy import func, or_
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+# ids per IN (...) list, well under SQLite's bound parameter limit
+ID_CHUNK_SIZE = 500
+
+
+def foreign_keys_enforced(conn):
+    "whether the database will run the ON DELETE rules itself"
+    if conn.dialect.name == 'sqlite':
+        return bool(conn.exec_driver_sql("PRAGMA foreign_keys").scalar())
+    return True
+
+
+def _chunks(ids, size=ID_CHUNK_SIZE):
+    ids = list(ids)
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+################################################################################
+# pets
+
+def _delete_pet_dependents(conn, pet_ids):
+    "what ON DELETE would do for pets whose id is in pet_ids, a list or subquery"
+    pet = model.Pet.__table__
+    assoc = model.PetPersonAssociation.__table__
+    links = model.pet_to_pet
+    conn.execute(assoc.delete().where(assoc.c.pet_id.in_(pet_ids)))
+    conn.execute(links.delete().where(or_(links.c.left_pet_id.in_(pet_ids),
+                                          links.c.right_pet_id.in_(pet_ids))))
+    conn.execute(pet.update().where(pet.c.left_pet_id.in_(pet_ids)).values(left_pet_id=None))
+    conn.execute(pet.update().where(pet.c.right_pet_id.in_(pet_ids)).values(right_pet_id=None))
+
+
+def delete_pets(conn, pet_ids):
+    "delete pets by id with their nicknames and pedigree links, returns the pets deleted"
+    pet = model.Pet.__table__
+    cascade = not foreign_keys_enforced(conn)
+    deleted = 0
+    for chunk in _chunks(pet_ids):
+        if cascade:
+            _delete_pet_dependents(conn, chunk)
+        deleted += conn.execute(pet.delete().where(pet.c.id.in_(chunk))).rowcount
+    return deleted
+
+
+def delete_pets_where(conn, condition):
+    """
+    delete every pet matching condition, a clause on the pet table, in one
+    statement per table; returns the pets deleted
+    """
+    pet = model.Pet.__table__
+    if not foreign_keys_enforced(conn):
+        _delete_pet_dependents(conn, select(pet.c.id).where(condition).scalar_subquery())
+    return conn.execute(pet.delete().where(condition)).rowcount
+
+
+################################################################################
+# shelters and species
+
+def delete_shelters(conn, shelter_ids, with_pets=True):
+    """
+    delete shelters, and their pets unless with_pets is off, in which case
+    the pets stay with no shelter; returns (shelters, pets) deleted
+    """
+    pet = model.Pet.__table__
+    shelter = model.Shelter.__table__
+    pets = 0
+    enforced = foreign_keys_enforced(conn)
+    for chunk in _chunks(shelter_ids):
+        if with_pets:
+            pets += delete_pets_where(conn, pet.c.shelter_id.in_(chunk))
+        elif not enforced:
+            conn.execute(pet.update().where(pet.c.shelter_id.in_(chunk)).values(shelter_id=None))
+    shelters = 0
+    for chunk in _chunks(shelter_ids):
+        shelters += conn.execute(shelter.delete().where(shelter.c.id.in_(chunk))).rowcount
+    return shelters, pets
+
+
+def delete_species(conn, species_ids, with_pets=True):
+    """
+    delete species with their breeds, and the pets of those breeds unless
+    with_pets is off, in which case the pets lose their breed; returns
+    (species, breeds, pets) deleted
+    """
+    pet = model.Pet.__table__
+    breed = model.Breed.__table__
+    species = model.Species.__table__
+    traits = model.breed_breedtrait_table
+    enforced = foreign_keys_enforced(conn)
+    counts = [0, 0, 0]
+    for chunk in _chunks(species_ids):
+        breed_ids = select(breed.c.id).where(breed.c.species_id.in_(chunk)).scalar_subquery()
+        if with_pets:
+            counts[2] += delete_pets_where(conn, pet.c.breed_id.in_(breed_ids))
+        elif not enforced:
+            conn.execute(pet.update().where(pet.c.breed_id.in_(breed_ids)).values(breed_id=None))
+        if not enforced:
+            conn.execute(traits.delete().where(traits.c.breed_id.in_(breed_ids)))
+        counts[1] += conn.execute(breed.delete().where(breed.c.species_id.in_(chunk))).rowcount
+        counts[0] += conn.execute(species.delete().where(species.c.id.in_(chunk))).rowcount
+    return tuple(counts)
+
+
+################################################################################
+# benchmark
+
+def seed(engine, num_associations, people=1000, per_pet=2):
+    "pets in one shelter with per_pet nicknames each, num_associations in all"
+    bulk_load = importlib.import_module('bulk_load')
+    model.init_db(engine)
+    num_pets = num_associations // per_pet
+    records = bulk_load.synthetic_records(num_pets, shelters=1)
+    bulk_load.load_pets(engine, records)
+
+    person = model.Person.__table__
+    assoc = model.PetPersonAssociation.__table__
+    with engine.begin() as conn:
+        conn.execute(person.insert(), [
+            {'first_name': 'First{}'.format(i), 'last_name': 'Last{}'.format(i)}
+            for i in range(people)])
+        conn.execute(assoc.insert(), [
+            {'pet_id': pet_id, 'person_id': (pet_id * per_pet + n) % people + 1,
+             'nickname': 'nick{}'.format(n)}
+            for pet_id in range(1, num_pets + 1) for n in range(per_pet)])
+    return num_pets
+
+
+def count_rows(engine):
+    "rows left in the tables the benchmark deletes from"
+    with engine.connect() as conn:
+        return dict((table.name, conn.execute(select(func.count()).select_from(table)).scalar())
+                    for table in (model.Pet.__table__,
+                                  model.PetPersonAssociation.__table__,
+                                  model.Shelter.__table__))
+
+
+def benchmark(engine, num_associations):
+    results = {}
+    Session = db.make_session(engine)
+
+    # the ORM way: every pet and every association becomes an object and a
+    # DELETE of its own
+    num_pets = seed(engine, num_associations)
+    db_session = Session()
+    start = timeit.default_timer()
+    shelter = db_session.query(model.Shelter).one()
+    for pet in (db_session.query(model.Pet)
+                .options(selectinload(model.Pet.person_associations))
+                .filter(model.Pet.shelter_id == shelter.id)):
+        db_session.delete(pet)
+    db_session.delete(shelter)
+    db_session.commit()
+    results['orm'] = timeit.default_timer() - start
+    db_session.close()
+    assert count_rows(engine) == {'pet': 0, 'petPersonAssociation': 0, 'shelter': 0}
+
+    seed(engine, num_associations)
+    start = timeit.default_timer()
+    with engine.begin() as conn:
+        shelter_id = conn.execute(select(model.Shelter.__table__.c.id)).scalar()
+        assert delete_shelters(conn, [shelter_id]) == (1, num_pets)
+    results['set based'] = timeit.default_timer() - start
+    assert count_rows(engine) == {'pet': 0, 'petPersonAssociation': 0, 'shelter': 0}
+
+    for name, elapsed in sorted(results.items()):
+        log.info("{:>9}: {} pets, {} associations deleted in {:.3f}s".format(
+            name, num_pets, num_associations, elapsed))
+    log.info("speedup: {:.1f}x".format(results['orm'] / results['set based']))
+    return results
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    num_associations = int(args[0]) if args else 100000
+
+    engine = db.make_engine(url)
+    benchmark(engine, num_associations)
+    engine.dispose()
+    log.info("all done!")
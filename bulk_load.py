@@ -0,0 +1,325 @@
+"""
+bulk loader for the pet/shelter domain model
+
+Streams pet records from CSV or JSONL files in chunks, resolves the
+species/breed/shelter foreign keys through in-memory lookup maps and writes
+the pet rows with batched Core insert() executemany calls instead of tracking
+every object through Session.add_all().
+
+Each record is a mapping with the keys:
+
+    name, age, adopted, species, breed, shelter, website
+
+where species/breed/shelter are names.  Reference rows that do not exist yet
+are created on the fly, once per chunk.
+
+run as a script to benchmark against the add_all() path:
+
+    python bulk_load.py [url] [number of pets]
+"""
+import csv
+import importlib
+import itertools
+import json
+import random
+import timeit
+
+from sqlalchemy import select
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+DEFAULT_CHUNK_SIZE = 10000
+
+TRUE_STRINGS = ('1', 'true', 't', 'yes', 'y')
+
+
+################################################################################
+# reading records
+
+def read_csv(path):
+    "yield one dict per row of a CSV file with a header line"
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            yield row
+
+
+def read_jsonl(path):
+    "yield one dict per non-blank line of a JSON lines file"
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def read_records(path):
+    "pick a reader based on the file extension"
+    if path.endswith('.csv'):
+        return read_csv(path)
+    if path.endswith('.jsonl') or path.endswith('.json'):
+        return read_jsonl(path)
+    raise ValueError("don't know how to read {}".format(path))
+
+
+def chunked(iterable, size):
+    "yield lists of at most size items from iterable"
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _to_int(value):
+    if value is None or value == '':
+        return None
+    return int(value)
+
+
+def _to_bool(value):
+    if isinstance(value, bool):
+        return value
+    if value is None:
+        return None
+    return str(value).strip().lower() in TRUE_STRINGS
+
+
+def _blank_to_none(value):
+    if value == '':
+        return None
+    return value
+
+
+################################################################################
+# foreign key lookups
+
+class LookupMaps(object):
+    """
+    in-memory name -> id maps for the reference tables
+
+    species and shelters are keyed by name, breeds by (name, species_id) so
+    the same breed name can exist for two species.
+    """
+
+    def __init__(self):
+        self.species = {}
+        self.breeds = {}
+        self.shelters = {}
+
+    def preload(self, conn):
+        "fill the maps from rows already in the database"
+        species = model.Species.__table__
+        breed = model.Breed.__table__
+        shelter = model.Shelter.__table__
+
+        # order by id so the oldest row wins when names are duplicated
+        for id, name in conn.execute(
+                select(species.c.id, species.c.name).order_by(species.c.id)):
+            self.species.setdefault(name, id)
+        for id, name, species_id in conn.execute(
+                select(breed.c.id, breed.c.name, breed.c.species_id).order_by(breed.c.id)):
+            self.breeds.setdefault((name, species_id), id)
+        for id, name in conn.execute(
+                select(shelter.c.id, shelter.c.name).order_by(shelter.c.id)):
+            self.shelters.setdefault(name, id)
+
+    def resolve(self, conn, records):
+        """
+        make sure every species, breed and shelter named in records has an id,
+        inserting the missing ones with one executemany per table
+        """
+        species = model.Species.__table__
+        breed = model.Breed.__table__
+        shelter = model.Shelter.__table__
+
+        missing = set(r['species'] for r in records
+                      if r.get('species') and r['species'] not in self.species)
+        self._insert_missing(conn, species, [{'name': n} for n in missing],
+                             lambda row: row.name, self.species)
+
+        missing = set()
+        for r in records:
+            if r.get('breed'):
+                if not r.get('species'):
+                    raise ValueError("breed without a species: {}".format(r))
+                key = (r['breed'], self.species[r['species']])
+                if key not in self.breeds:
+                    missing.add(key)
+        self._insert_missing(conn, breed,
+                             [{'name': n, 'species_id': s} for n, s in missing],
+                             lambda row: (row.name, row.species_id), self.breeds)
+
+        missing = {}
+        for r in records:
+            name = r.get('shelter')
+            if name and name not in self.shelters:
+                missing.setdefault(name, _blank_to_none(r.get('website')))
+        self._insert_missing(conn, shelter,
+                             [{'name': n, 'website': w} for n, w in missing.items()],
+                             lambda row: row.name, self.shelters)
+
+    def _insert_missing(self, conn, table, rows, key, lookup):
+        if not rows:
+            return
+        conn.execute(table.insert(), rows)
+        # read back the new ids; only rows we don't already know about
+        # can be new, so setdefault keeps existing mappings stable
+        names = set(row['name'] for row in rows)
+        for row in conn.execute(
+                select(table).where(table.c.name.in_(names)).order_by(table.c.id)):
+            lookup.setdefault(key(row), row.id)
+
+    def pet_row(self, record):
+        "turn a record into a parameter dict for the pet table"
+        breed_id = None
+        if record.get('breed'):
+            breed_id = self.breeds[(record['breed'], self.species[record['species']])]
+        shelter_id = None
+        if record.get('shelter'):
+            shelter_id = self.shelters[record['shelter']]
+        return {
+            'name': record['name'],
+            'age': _to_int(record.get('age')),
+            'adopted': _to_bool(record.get('adopted')),
+            'breed_id': breed_id,
+            'shelter_id': shelter_id,
+        }
+
+
+################################################################################
+# loading
+
+def load_pets(engine, records, chunk_size=DEFAULT_CHUNK_SIZE, lookups=None):
+    """
+    insert pet records with one executemany per chunk, returns the number of
+    pets inserted
+
+    every chunk is its own transaction, so a failure part way through keeps
+    the chunks that were already written.
+    """
+    if lookups is None:
+        lookups = LookupMaps()
+        with engine.connect() as conn:
+            lookups.preload(conn)
+
+    pet = model.Pet.__table__
+    count = 0
+    for chunk in chunked(records, chunk_size):
+        with engine.begin() as conn:
+            lookups.resolve(conn, chunk)
+            conn.execute(pet.insert(), [lookups.pet_row(r) for r in chunk])
+        count += len(chunk)
+        log.debug("  - loaded {} pets".format(count))
+    return count
+
+
+def load_file(engine, path, chunk_size=DEFAULT_CHUNK_SIZE):
+    "bulk load a CSV or JSONL file of pet records"
+    log.info("load_file() {}".format(path))
+    return load_pets(engine, read_records(path), chunk_size)
+
+
+################################################################################
+# benchmark
+
+SPECIES_BREEDS = {
+    'Dog': ['Dalmatian', 'Golden Retriever', 'Poodle', 'Labrador Retriever'],
+    'Cat': ['Siamese', 'Persian', 'Maine Coon'],
+    'Parrot': ['Norwegian Blue', 'African Grey'],
+}
+
+
+def synthetic_records(count, shelters=50, seed=0):
+    "yield count random pet records"
+    rng = random.Random(seed)
+    species_names = sorted(SPECIES_BREEDS)
+    for i in range(count):
+        species = rng.choice(species_names)
+        shelter = rng.randrange(shelters)
+        yield {
+            'name': 'Pet {}'.format(i),
+            'age': rng.randrange(20),
+            'adopted': rng.random() < 0.3,
+            'species': species,
+            'breed': rng.choice(SPECIES_BREEDS[species]),
+            'shelter': 'Shelter {}'.format(shelter),
+            'website': 'http://shelter{}.example.com'.format(shelter),
+        }
+
+
+def load_pets_add_all(session, records, chunk_size=DEFAULT_CHUNK_SIZE):
+    "the ORM path the demo scripts use, for comparison"
+    species, breeds, shelters = {}, {}, {}
+    count = 0
+    for chunk in chunked(records, chunk_size):
+        pets = []
+        for r in chunk:
+            if r['species'] not in species:
+                species[r['species']] = model.Species(name=r['species'])
+            key = (r['breed'], r['species'])
+            if key not in breeds:
+                breeds[key] = model.Breed(name=r['breed'], species=species[r['species']])
+            if r['shelter'] not in shelters:
+                shelters[r['shelter']] = model.Shelter(name=r['shelter'], website=r['website'])
+            pets.append(model.Pet(name=r['name'], age=r['age'], adopted=r['adopted'],
+                                  breed=breeds[key], shelter=shelters[r['shelter']]))
+        session.add_all(pets)
+        session.commit()
+        count += len(chunk)
+    return count
+
+
+def benchmark(count, url=db.DEFAULT_URL, chunk_size=DEFAULT_CHUNK_SIZE):
+    "time add_all() against load_pets(), each on a freshly initialized database"
+    results = {}
+
+    engine = db.make_engine(url)
+    model.init_db(engine)
+    db_session = db.make_session(engine)()
+    start = timeit.default_timer()
+    load_pets_add_all(db_session, synthetic_records(count), chunk_size)
+    results['add_all'] = timeit.default_timer() - start
+    assert db_session.query(model.Pet).count() == count
+    db_session.close()
+    engine.dispose()
+
+    engine = db.make_engine(url)
+    model.init_db(engine)
+    start = timeit.default_timer()
+    load_pets(engine, synthetic_records(count), chunk_size)
+    results['executemany'] = timeit.default_timer() - start
+    db_session = db.make_session(engine)()
+    assert db_session.query(model.Pet).count() == count
+    db_session.close()
+    engine.dispose()
+
+    for name, elapsed in sorted(results.items()):
+        log.info("{:>12}: {} pets in {:.3f}s, {:,.0f} rows/sec".format(
+            name, count, elapsed, count / elapsed))
+    log.info("speedup: {:.1f}x".format(results['add_all'] / results['executemany']))
+    return results
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    count = int(args[0]) if args else 100000
+    benchmark(count, url)
+    log.info("all done!")
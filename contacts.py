@@ -0,0 +1,283 @@
+"""
+bulk person import and contact list rendering
+
+Person.phone validates and formats one number per assignment, and a bad
+number stops the import at the first record.  import_people() does whole
+chunks at once instead: normalize_phones() strips hyphens and spaces from
+a chunk of numbers in one str.translate() over the joined column, then
+checks and formats them as a NumPy array of code points, 10 digits wide,
+with no Python work per number.  Bad records are skipped and come back as
+Rejects, one per record and field, instead of raising:
+
+    report = import_people(conn, records)
+    report.inserted               # rows written
+    report.rejects                # [Reject(index, field, value, reason)]
+
+Phone numbers are stored formatted (555-555-5555), so Person.phone and
+render_people() read them as they are.  reformat_stored() converts rows
+written in the old digits-only form; schema.bootstrap() runs it as a data
+migration.
+
+run as a script to benchmark against Person(phone=...) per record:
+
+    python contacts.py [url] [number of contacts]
+
+needs numpy.
+"""
+import collections
+import importlib
+import random
+import timeit
+
+import numpy
+from sqlalchemy import func, select
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+DEFAULT_CHUNK_SIZE = 10000
+
+Reject = collections.namedtuple('Reject', 'index field value reason')
+ImportReport = collections.namedtuple('ImportReport', 'inserted rejects')
+ContactRow = collections.namedtuple('ContactRow', 'id first_name last_name phone')
+
+_SEPARATORS = str.maketrans('', '', '- ')
+_ZERO, _NINE, _HYPHEN = ord('0'), ord('9'), ord('-')
+
+
+################################################################################
+# phone numbers
+
+def _normalize_slowly(values):
+    "model.format_phone() per value, for columns the fast path can't take"
+    formatted = []
+    bad = []
+    for i, value in enumerate(values):
+        if value is None:
+            formatted.append(None)
+            continue
+        try:
+            formatted.append(model.format_phone(value))
+        except (ValueError, AttributeError):
+            formatted.append(None)
+            bad.append(i)
+    return formatted, bad
+
+
+def normalize_phones(values):
+    """
+    (formatted, bad) for a column of phone numbers: formatted holds
+    555-555-5555 or None for each value, bad the indexes of values that are
+    not 10 digits after hyphens and spaces are removed.  None is no number,
+    not a bad one.  Same rules as model.format_phone()
+    """
+    values = list(values)
+    n = len(values)
+    if not n:
+        return [], []
+    try:
+        joined = '\n'.join(values)
+    except TypeError:
+        # None or something that isn't a string somewhere in the column
+        return _normalize_slowly(values)
+    lines = joined.translate(_SEPARATORS).split('\n')
+    if len(lines) != n:
+        # a value with a newline in it
+        return _normalize_slowly(values)
+
+    lengths = numpy.fromiter(map(len, lines), dtype=numpy.int64, count=n)
+    # U10 cuts longer values short, the length check rejects them
+    points = numpy.array(lines, dtype='U10').view(numpy.uint32).reshape(n, 10)
+    good = (lengths == 10) & ((points >= _ZERO) & (points <= _NINE)).all(axis=1)
+
+    out = numpy.full((n, 12), _HYPHEN, dtype=numpy.uint32)
+    out[:, 0:3] = points[:, 0:3]
+    out[:, 4:7] = points[:, 3:6]
+    out[:, 8:12] = points[:, 6:10]
+    formatted = out.view('U12').ravel().tolist()
+    bad = numpy.nonzero(~good)[0].tolist()
+    for i in bad:
+        formatted[i] = None
+    return formatted, bad
+
+
+def reformat_stored(conn):
+    "rewrite digits-only _phone values as 555-555-5555, returns the rows changed"
+    person = model.Person.__table__
+    phone = person.c._phone
+    result = conn.execute(
+        person.update()
+        .where(func.length(phone) == 10)
+        .where(phone.notlike('%-%'))
+        .values(_phone=func.substr(phone, 1, 3) + '-' + func.substr(phone, 4, 3)
+                + '-' + func.substr(phone, 7, 4)))
+    return result.rowcount
+
+
+################################################################################
+# import and render
+
+def validate_people(records, offset=0):
+    """
+    (rows, rejects) for a chunk of person dicts with first_name, last_name,
+    age and phone keys; offset is the chunk's first index in the import
+    """
+    phones, bad_phones = normalize_phones([r.get('phone') for r in records])
+    bad = dict((i, [Reject(offset + i, 'phone', records[i].get('phone'), "not 10 digits")])
+               for i in bad_phones)
+    for field in ('first_name', 'last_name'):
+        for i, record in enumerate(records):
+            if not record.get(field):
+                bad.setdefault(i, []).append(Reject(offset + i, field, record.get(field), "missing"))
+
+    rows = [{'first_name': record['first_name'],
+             'last_name': record['last_name'],
+             'age': record.get('age'),
+             '_phone': phone}
+            for i, (record, phone) in enumerate(zip(records, phones)) if i not in bad]
+    rejects = [reject for i in sorted(bad) for reject in bad[i]]
+    return rows, rejects
+
+
+def import_people(conn, records, chunk_size=DEFAULT_CHUNK_SIZE):
+    "insert the valid records, one executemany per chunk; returns an ImportReport"
+    bulk_load = importlib.import_module('bulk_load')
+    person = model.Person.__table__
+    inserted = 0
+    rejects = []
+    offset = 0
+    for chunk in bulk_load.chunked(records, chunk_size):
+        rows, chunk_rejects = validate_people(chunk, offset)
+        if rows:
+            conn.execute(person.insert(), rows)
+        inserted += len(rows)
+        rejects.extend(chunk_rejects)
+        offset += len(chunk)
+    return ImportReport(inserted, rejects)
+
+
+def render_people(conn, where=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    "ContactRows in name order, phone numbers as stored"
+    person = model.Person.__table__
+    q = (select(person.c.id, person.c.first_name, person.c.last_name, person.c._phone)
+         .order_by(person.c.last_name, person.c.first_name, person.c.id))
+    if where is not None:
+        q = q.where(where)
+    result = conn.execute(q.execution_options(stream_results=True, yield_per=chunk_size))
+    for partition in result.partitions(chunk_size):
+        for row in partition:
+            yield ContactRow(*row)
+
+
+################################################################################
+# benchmark
+
+def contacts(num_contacts, bad=0.02, seed=0):
+    "person dicts with phone numbers in the shapes people type them, some bad"
+    rng = random.Random(seed)
+    shapes = ('{}-{}-{}', '{} {} {}', '{}{}{}', '({}) {}-{}')
+    result = []
+    for i in range(num_contacts):
+        digits = '{:010d}'.format(rng.randrange(10 ** 10))
+        shape = rng.choice(shapes[:3])
+        if rng.random() < bad:
+            # too short, or a shape format_phone() doesn't take
+            shape = rng.choice(('{}{}', shapes[3]))
+            digits = digits[:8] if shape == '{}{}' else digits
+        phone = shape.format(digits[0:3], digits[3:6], digits[6:10]) if shape != '{}{}' \
+            else digits
+        result.append({'first_name': 'First{}'.format(i), 'last_name': 'Last{}'.format(i % 5000),
+                       'age': 18 + i % 70, 'phone': phone})
+    return result
+
+
+def import_orm(session, records, chunk_size=DEFAULT_CHUNK_SIZE):
+    "the model way: Person(phone=...) per record, catching the failures"
+    inserted = 0
+    rejects = []
+    for i, record in enumerate(records):
+        try:
+            session.add(model.Person(first_name=record['first_name'], last_name=record['last_name'],
+                                     age=record['age'], phone=record['phone']))
+            inserted += 1
+        except ValueError as e:
+            rejects.append(Reject(i, 'phone', record['phone'], str(e)))
+        if (i + 1) % chunk_size == 0:
+            session.commit()
+    session.commit()
+    return ImportReport(inserted, rejects)
+
+
+def benchmark(engine, num_contacts, orm_contacts=100000):
+    records = contacts(num_contacts)
+    results = {}
+
+    # the column step alone, against format_phone() per value
+    phones = [r['phone'] for r in records]
+    start = timeit.default_timer()
+    formatted, bad = normalize_phones(phones)
+    results['normalize numpy'] = timeit.default_timer() - start
+    start = timeit.default_timer()
+    slow_formatted, slow_bad = _normalize_slowly(phones)
+    results['normalize per value'] = timeit.default_timer() - start
+    assert (formatted, bad) == (slow_formatted, slow_bad)
+    log.info("{} of {} numbers rejected".format(len(bad), len(phones)))
+
+    model.init_db(engine)
+    orm_records = records[:orm_contacts]
+    db_session = db.make_session(engine)()
+    start = timeit.default_timer()
+    orm_report = import_orm(db_session, orm_records)
+    results['import orm'] = timeit.default_timer() - start
+    start = timeit.default_timer()
+    orm_phones = [p.phone for p in db_session.query(model.Person)]
+    results['render orm'] = timeit.default_timer() - start
+    db_session.close()
+
+    model.init_db(engine)
+    start = timeit.default_timer()
+    with engine.begin() as conn:
+        report = import_people(conn, records)
+    results['import bulk'] = timeit.default_timer() - start
+    assert report.inserted == len(records) - len(bad)
+    assert [r.index for r in report.rejects] == bad
+    assert [r.index for r in orm_report.rejects] == [i for i in bad if i < orm_contacts]
+    start = timeit.default_timer()
+    with engine.connect() as conn:
+        rendered = sum(1 for row in render_people(conn))
+    results['render rows'] = timeit.default_timer() - start
+    assert rendered == report.inserted
+    assert sorted(orm_phones) == sorted(p for p in formatted[:orm_contacts] if p)
+
+    sizes = {'import orm': len(orm_records), 'render orm': len(orm_phones),
+             'render rows': rendered}
+    for name, elapsed in sorted(results.items()):
+        size = sizes.get(name, len(records))
+        log.info("{:>20}: {} contacts in {:.3f}s, {:,.0f}/sec".format(name, size, elapsed, size / elapsed))
+    return results
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    num_contacts = int(args[0]) if args else 1000000
+
+    engine = db.make_engine(url)
+    benchmark(engine, num_contacts)
+    engine.dispose()
+    log.info("all done!")
@@ -0,0 +1,437 @@
+"""
+denormalized pet counters for shelters, breeds and species
+
+Every dashboard number is a count: pets, breeds, species and shelters in
+all, and pets and adopted pets per shelter, breed and species.  The counter
+tables here hold those numbers, so reading one is a primary key lookup
+instead of a scan:
+
+    table_counts     name -> rows               ('pet', 'breed', ...)
+    shelter_counts   shelter_id -> pets, adopted
+    breed_counts     breed_id -> pets, adopted
+    species_counts   species_id -> pets, adopted
+
+Triggers on pet, breed, species and shelter keep them current.  Unlike ORM
+flush events they also see Core writes (bulk_load.py, bulk_delete.py) and
+the ON DELETE SET NULL rules, and breed triggers carry a breed's pets when
+it changes species or is deleted, so no write path can skip them.  SQLite and
+Postgres are supported.  Like pet_search the tables live on their own
+MetaData, so only databases that call init_counters() get them, after
+init_db(), which drops the triggers along with the tables.
+
+check() compares every counter against a fresh GROUP BY, rebuild() rewrites
+them all in bulk.
+
+run as a script to verify the triggers and time counter reads against
+count() scans:
+
+    python counters.py [url] [number of pets]
+"""
+import importlib
+import random
+import timeit
+
+from sqlalchemy import Column, Integer, MetaData, String, Table
+from sqlalchemy import case, func, literal, select
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+
+################################################################################
+# counter tables
+
+metadata = MetaData()
+
+table_counts = Table('table_counts', metadata,
+    Column('name', String, primary_key=True),
+    Column('rows', Integer, nullable=False, default=0),
+)
+
+shelter_counts = Table('shelter_counts', metadata,
+    Column('shelter_id', Integer, primary_key=True),
+    Column('pets', Integer, nullable=False, default=0),
+    Column('adopted', Integer, nullable=False, default=0),
+)
+
+breed_counts = Table('breed_counts', metadata,
+    Column('breed_id', Integer, primary_key=True),
+    Column('pets', Integer, nullable=False, default=0),
+    Column('adopted', Integer, nullable=False, default=0),
+)
+
+species_counts = Table('species_counts', metadata,
+    Column('species_id', Integer, primary_key=True),
+    Column('pets', Integer, nullable=False, default=0),
+    Column('adopted', Integer, nullable=False, default=0),
+)
+
+# the tables table_counts counts
+COUNTED = [model.Pet, model.Breed, model.Species, model.Shelter]
+
+# owner table -> its per row counter table and key column
+PER_ROW = [
+    (model.Shelter.__table__, shelter_counts, 'shelter_id'),
+    (model.Breed.__table__, breed_counts, 'breed_id'),
+    (model.Species.__table__, species_counts, 'species_id'),
+]
+
+
+################################################################################
+# triggers
+
+ADOPTED = "CASE WHEN {row}.adopted THEN 1 ELSE 0 END"
+
+# what one pet row adds to ({sign} = +) or takes from ({sign} = -) the counters
+PET_ROW = [
+    "UPDATE shelter_counts SET pets = pets {sign} 1, adopted = adopted {sign} " + ADOPTED +
+    " WHERE shelter_id = {row}.shelter_id",
+    "UPDATE breed_counts SET pets = pets {sign} 1, adopted = adopted {sign} " + ADOPTED +
+    " WHERE breed_id = {row}.breed_id",
+    "UPDATE species_counts SET pets = pets {sign} 1, adopted = adopted {sign} " + ADOPTED +
+    " WHERE species_id = (SELECT species_id FROM breed WHERE id = {row}.breed_id)",
+]
+
+TABLE_ROW = "UPDATE table_counts SET rows = rows {sign} 1 WHERE name = '{table}'"
+
+# what one breed's pets add to or take from a species
+BREED_PETS = (
+    "UPDATE species_counts SET"
+    " pets = pets {sign} (SELECT pets FROM breed_counts WHERE breed_id = {row}.id),"
+    " adopted = adopted {sign} (SELECT adopted FROM breed_counts WHERE breed_id = {row}.id)"
+    " WHERE species_id = {row}.species_id")
+
+
+def _trigger_bodies():
+    """
+    (name, table, when, statements) for every trigger, when being the
+    timing and event, e.g. AFTER INSERT; bodies refer to NEW and OLD like
+    both dialects do
+    """
+    pet = model.Pet.__table__.name
+    breed = model.Breed.__table__.name
+    add = [s.format(sign='+', row='NEW') for s in PET_ROW]
+    remove = [s.format(sign='-', row='OLD') for s in PET_ROW]
+    triggers = [
+        ('pet_counts_insert', pet, 'AFTER INSERT', [TABLE_ROW.format(sign='+', table=pet)] + add),
+        ('pet_counts_delete', pet, 'AFTER DELETE', [TABLE_ROW.format(sign='-', table=pet)] + remove),
+        # only the columns the counters depend on
+        ('pet_counts_update', pet, 'AFTER UPDATE OF shelter_id, breed_id, adopted', remove + add),
+        # a deleted breed's pets are set to NULL after the breed row is gone,
+        # when the pet trigger can no longer find their species, so take
+        # them off the species while it still can
+        ('breed_counts_before_delete', breed, 'BEFORE DELETE', [BREED_PETS.format(sign='-', row='OLD')]),
+        # a breed moving species takes its pets along
+        ('breed_counts_species', breed, 'AFTER UPDATE OF species_id', [
+            BREED_PETS.format(sign='-', row='OLD'),
+            BREED_PETS.format(sign='+', row='NEW'),
+        ]),
+    ]
+    for owner, counts, key in PER_ROW:
+        triggers.append(('{}_counts_insert'.format(owner.name), owner.name, 'AFTER INSERT', [
+            TABLE_ROW.format(sign='+', table=owner.name),
+            "INSERT INTO {} ({}, pets, adopted) VALUES (NEW.id, 0, 0)".format(counts.name, key),
+        ]))
+        triggers.append(('{}_counts_delete'.format(owner.name), owner.name, 'AFTER DELETE', [
+            TABLE_ROW.format(sign='-', table=owner.name),
+            "DELETE FROM {} WHERE {} = OLD.id".format(counts.name, key),
+        ]))
+    return triggers
+
+
+def _sqlite_ddl(name, table, when, statements):
+    return ["DROP TRIGGER IF EXISTS {}".format(name),
+            "CREATE TRIGGER {} {} ON {} FOR EACH ROW BEGIN\n    {};\nEND".format(
+                name, when, table, ';\n    '.join(statements))]
+
+
+def _postgresql_ddl(name, table, when, statements):
+    # NULL from a BEFORE trigger would cancel the delete
+    result = 'OLD' if when.startswith('BEFORE') else 'NULL'
+    return ["CREATE OR REPLACE FUNCTION {}() RETURNS trigger AS $$\nBEGIN\n    {};\n"
+            "    RETURN {};\nEND\n$$ LANGUAGE plpgsql".format(name, ';\n    '.join(statements), result),
+            'DROP TRIGGER IF EXISTS {0} ON "{1}"'.format(name, table),
+            'CREATE TRIGGER {0} {1} ON "{2}" FOR EACH ROW EXECUTE PROCEDURE {0}()'.format(
+                name, when, table)]
+
+
+TRIGGER_DDL = {
+    'sqlite': _sqlite_ddl,
+    'postgresql': _postgresql_ddl,
+}
+
+
+def create_triggers(conn):
+    "(re)create the counter triggers"
+    try:
+        ddl = TRIGGER_DDL[conn.dialect.name]
+    except KeyError:
+        raise ValueError("no counter triggers for {}".format(conn.dialect.name))
+    for name, table, when, statements in _trigger_bodies():
+        for statement in ddl(name, table, when, statements):
+            conn.exec_driver_sql(statement)
+
+
+def drop_triggers(conn):
+    "remove the counter triggers, e.g. around a large load followed by rebuild()"
+    for name, table, when, statements in _trigger_bodies():
+        if conn.dialect.name == 'postgresql':
+            conn.exec_driver_sql('DROP TRIGGER IF EXISTS {} ON "{}"'.format(name, table))
+        else:
+            conn.exec_driver_sql("DROP TRIGGER IF EXISTS {}".format(name))
+
+
+def init_counters(engine):
+    "drop, create and fill the counter tables, then install the triggers"
+    log.info("init_counters() engine: {}".format(engine))
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        rebuild(conn)
+        create_triggers(conn)
+
+
+################################################################################
+# rebuilding and checking
+
+def _table_totals():
+    "select of (name, rows) for every counted table"
+    selects = [select(literal(entity.__table__.name).label('name'),
+                      func.count().label('rows')).select_from(entity.__table__)
+               for entity in COUNTED]
+    return selects[0].union_all(*selects[1:])
+
+
+def _pet_totals(key, counts_key):
+    """
+    select of (counts_key, pets, adopted) for every row of key's table,
+    zeros included, from a GROUP BY over the pets
+    """
+    pet = model.Pet.__table__
+    breed = model.Breed.__table__
+    adopted = func.coalesce(func.sum(case((pet.c.adopted.is_(True), 1), else_=0)), 0)
+    if key == 'species_id':
+        owner = model.Species.__table__
+        source = owner.outerjoin(breed, breed.c.species_id == owner.c.id) \
+                      .outerjoin(pet, pet.c.breed_id == breed.c.id)
+    else:
+        owner = model.Shelter.__table__ if key == 'shelter_id' else breed
+        source = owner.outerjoin(pet, pet.c[key] == owner.c.id)
+    return (select(owner.c.id.label(counts_key), func.count(pet.c.id).label('pets'),
+                   adopted.label('adopted'))
+            .select_from(source)
+            .group_by(owner.c.id))
+
+
+def rebuild(conn):
+    "rewrite every counter from the tables they count"
+    conn.execute(table_counts.delete())
+    conn.execute(table_counts.insert().from_select(['name', 'rows'], _table_totals()))
+    for owner, counts, key in PER_ROW:
+        conn.execute(counts.delete())
+        conn.execute(counts.insert().from_select([key, 'pets', 'adopted'],
+                                                 _pet_totals(key, key)))
+    log.info("  - counters rebuilt")
+
+
+def check(conn):
+    """
+    every counter that disagrees with a fresh count, as a list of
+    (counter table, key, stored, actual); empty when all is well
+    """
+    problems = []
+    stored = dict(tuple(row) for row in conn.execute(select(table_counts)))
+    for name, rows in conn.execute(_table_totals()):
+        if stored.get(name) != rows:
+            problems.append((table_counts.name, name, stored.get(name), rows))
+    for owner, counts, key in PER_ROW:
+        stored = dict((row[0], tuple(row[1:])) for row in conn.execute(select(counts)))
+        actual = dict((row[0], tuple(row[1:])) for row in conn.execute(_pet_totals(key, key)))
+        for id in sorted(set(stored) | set(actual)):
+            if stored.get(id) != actual.get(id):
+                problems.append((counts.name, id, stored.get(id), actual.get(id)))
+    return problems
+
+
+################################################################################
+# reading
+
+def total(conn, entity):
+    "number of rows of entity, one primary key lookup"
+    return conn.execute(select(table_counts.c.rows)
+                        .where(table_counts.c.name == entity.__table__.name)).scalar()
+
+
+def totals(conn):
+    "{table name: rows} for every counted table"
+    return dict(tuple(row) for row in conn.execute(select(table_counts)))
+
+
+def _pets(conn, counts, key, id):
+    row = conn.execute(select(counts.c.pets, counts.c.adopted)
+                       .where(counts.c[key] == id)).first()
+    return tuple(row) if row is not None else (0, 0)
+
+
+def shelter_pets(conn, shelter_id):
+    "(pets, adopted) in one shelter"
+    return _pets(conn, shelter_counts, 'shelter_id', shelter_id)
+
+
+def breed_pets(conn, breed_id):
+    "(pets, adopted) of one breed"
+    return _pets(conn, breed_counts, 'breed_id', breed_id)
+
+
+def species_pets(conn, species_id):
+    "(pets, adopted) of one species"
+    return _pets(conn, species_counts, 'species_id', species_id)
+
+
+################################################################################
+# benchmark
+
+def exercise(engine, num_changes, seed=0):
+    "random ORM and Core inserts, adoptions, moves and deletes"
+    rng = random.Random(seed)
+    bulk_delete = importlib.import_module('bulk_delete')
+    pet = model.Pet.__table__
+    with engine.begin() as conn:
+        breed_ids = list(conn.execute(select(model.Breed.__table__.c.id)).scalars())
+        shelter_ids = list(conn.execute(select(model.Shelter.__table__.c.id)).scalars())
+        pet_ids = list(conn.execute(select(pet.c.id).limit(num_changes * 4)).scalars())
+        rng.shuffle(pet_ids)
+        for i in range(num_changes):
+            conn.execute(pet.update().where(pet.c.id == pet_ids.pop())
+                         .values(adopted=rng.random() < 0.5))
+            conn.execute(pet.update().where(pet.c.id == pet_ids.pop())
+                         .values(shelter_id=rng.choice(shelter_ids),
+                                 breed_id=rng.choice(breed_ids)))
+        bulk_delete.delete_pets(conn, [pet_ids.pop() for i in range(num_changes)])
+
+    db_session = db.make_session(engine)()
+    shelter = model.Shelter(name='Counted Shelter')
+    breed = db_session.query(model.Breed).first()
+    db_session.add_all([model.Pet(name='Counted {}'.format(i), adopted=i % 2 == 0,
+                                  breed=breed, shelter=shelter)
+                        for i in range(num_changes)])
+    db_session.commit()
+    db_session.delete(db_session.query(model.Pet).get(pet_ids.pop()))
+    db_session.commit()
+    db_session.close()
+
+    with engine.begin() as conn:
+        bulk_delete.delete_shelters(conn, [shelter_ids[0]], with_pets=False)
+        bulk_delete.delete_shelters(conn, [shelter_ids[1]])
+
+
+def breed_changes(conn):
+    """
+    (description, change) pairs for the breed writes the pet triggers can't
+    see: a breed with pets moving species, and one being deleted
+    """
+    breed = model.Breed.__table__
+    pet = model.Pet.__table__
+    busy = (select(pet.c.breed_id).where(pet.c.breed_id.isnot(None))
+            .group_by(pet.c.breed_id).order_by(func.count().desc()).limit(2))
+    moved, deleted = list(conn.execute(busy).scalars())
+    species_ids = list(conn.execute(select(model.Species.__table__.c.id)).scalars())
+    old_species = conn.execute(select(breed.c.species_id).where(breed.c.id == moved)).scalar()
+    new_species = [s for s in species_ids if s != old_species][0]
+    return [
+        ("breed {} moved to species {}".format(moved, new_species),
+         breed.update().where(breed.c.id == moved).values(species_id=new_species)),
+        ("breed {} deleted".format(deleted), breed.delete().where(breed.c.id == deleted)),
+    ]
+
+
+def benchmark(engine, num_pets, repeat=200):
+    bulk_load = importlib.import_module('bulk_load')
+    model.init_db(engine)
+    bulk_load.load_pets(engine, bulk_load.synthetic_records(num_pets))
+    start = timeit.default_timer()
+    init_counters(engine)
+    log.info("counters built in {:.3f}s".format(timeit.default_timer() - start))
+
+    exercise(engine, min(1000, num_pets // 10))
+    with engine.connect() as conn:
+        problems = check(conn)
+    assert not problems, problems[:10]
+    log.info("counters match a fresh count after inserts, updates and deletes")
+
+    with engine.begin() as conn:
+        for description, change in breed_changes(conn):
+            conn.execute(change)
+            problems = check(conn)
+            assert not problems, (description, problems[:10])
+            log.info("counters match a fresh count after {}".format(description))
+
+    shelter = model.Shelter.__table__
+    pet = model.Pet.__table__
+    with engine.connect() as conn:
+        shelter_id = conn.execute(select(func.min(shelter.c.id))).scalar()
+
+        start = timeit.default_timer()
+        for i in range(repeat):
+            [conn.execute(select(func.count()).select_from(e.__table__)).scalar()
+             for e in COUNTED]
+            conn.execute(select(func.count(), func.sum(case((pet.c.adopted.is_(True), 1),
+                                                            else_=0)))
+                         .where(pet.c.shelter_id == shelter_id)).first()
+        scans = (timeit.default_timer() - start) / repeat
+
+        start = timeit.default_timer()
+        for i in range(repeat):
+            totals(conn)
+            shelter_pets(conn, shelter_id)
+        reads = (timeit.default_timer() - start) / repeat
+    log.info("report numbers: {:.3f}ms with count() scans, {:.3f}ms from counters, "
+             "{:.0f}x".format(scans * 1000, reads * 1000, scans / reads))
+
+    # what the triggers cost a bulk load
+    records = list(bulk_load.synthetic_records(num_pets // 10, seed=1))
+    results = {}
+    for name in ('without triggers', 'with triggers'):
+        with engine.begin() as conn:
+            first_new = conn.execute(select(func.max(pet.c.id))).scalar() + 1
+            if name == 'without triggers':
+                drop_triggers(conn)
+        start = timeit.default_timer()
+        bulk_load.load_pets(engine, records)
+        results[name] = timeit.default_timer() - start
+        with engine.begin() as conn:
+            conn.execute(pet.delete().where(pet.c.id >= first_new))
+            if name == 'without triggers':
+                # the load may have added shelters, so rebuild before the
+                # triggers take over again
+                rebuild(conn)
+                create_triggers(conn)
+        log.info("bulk loading {} pets {}: {:.2f}s".format(len(records), name, results[name]))
+    with engine.connect() as conn:
+        assert not check(conn)
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    num_pets = int(args[0]) if args else 100000
+
+    engine = db.make_engine(url)
+    benchmark(engine, num_pets)
+    engine.dispose()
+    log.info("all done!")
@@ -0,0 +1,241 @@
+"""
+shared engine and session setup
+
+The database URL comes from the command line or the PETS_DATABASE_URL
+environment variable, so the same domain model runs against an in-memory
+SQLite database, a SQLite file or Postgres without code edits:
+
+    python many-to-many.py sqlite:///pets.db
+    PETS_DATABASE_URL=postgresql://localhost/pets python many-to-many.py
+
+Pool settings can be passed to make_engine() or set through the
+PETS_POOL_SIZE, PETS_MAX_OVERFLOW, PETS_POOL_TIMEOUT and PETS_POOL_RECYCLE
+environment variables.  SQLite connections get tuning pragmas applied as
+they are opened.
+
+run as a script to benchmark connection checkout under N worker threads:
+
+    python db.py [url] [threads] [checkouts per thread]
+"""
+import os
+import sys
+import threading
+import timeit
+
+from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+DATABASE_URL_ENV = 'PETS_DATABASE_URL'
+DEFAULT_URL = 'sqlite:///:memory:'
+
+# pool settings, with the environment variable that overrides each one
+POOL_ENV = {
+    'pool_size': 'PETS_POOL_SIZE',
+    'max_overflow': 'PETS_MAX_OVERFLOW',
+    'pool_timeout': 'PETS_POOL_TIMEOUT',
+    'pool_recycle': 'PETS_POOL_RECYCLE',
+}
+
+# applied to every new SQLite connection, in order.  WAL lets readers run
+# alongside a writer, NORMAL sync is safe under WAL, a negative cache_size
+# is in KiB, busy_timeout makes writers wait instead of failing, and
+# foreign_keys turns on the ON DELETE CASCADE/SET NULL rules
+SQLITE_PRAGMAS = [
+    ('foreign_keys', 'ON'),
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -64000),
+    ('mmap_size', 268435456),
+    ('busy_timeout', 5000),
+]
+
+
+################################################################################
+# urls
+
+def parse_args(argv=None):
+    """
+    split command line arguments into the database URL and the rest
+
+    the first argument that looks like a URL wins, then the environment,
+    then an in-memory SQLite database
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    url = None
+    rest = []
+    for arg in argv:
+        if url is None and '://' in arg:
+            url = arg
+        else:
+            rest.append(arg)
+    if url is None:
+        url = os.environ.get(DATABASE_URL_ENV, DEFAULT_URL)
+    return url, rest
+
+
+def get_url(argv=None):
+    "the database URL from the command line or environment"
+    return parse_args(argv)[0]
+
+
+def is_sqlite_memory(url):
+    url = make_url(url)
+    return url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+
+
+################################################################################
+# engines and sessions
+
+def set_sqlite_pragmas(dbapi_connection, pragmas=SQLITE_PRAGMAS):
+    "run the tuning pragmas on a raw sqlite3 connection"
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas:
+        cursor.execute("PRAGMA {}={}".format(name, value))
+    cursor.close()
+
+
+def make_engine(url=None, pool_size=None, max_overflow=None, pool_timeout=None,
+                pool_recycle=None, pool_pre_ping=None, sqlite_pragmas=SQLITE_PRAGMAS,
+                **kwargs):
+    """
+    create an engine for url, defaulting to the command line/environment
+
+    an in-memory SQLite database is a single connection shared by every
+    thread, since each new connection would otherwise see its own empty
+    database.  SQLite files get a QueuePool so pool sizing applies to them
+    the same way it does to Postgres.  pool_pre_ping defaults to on for
+    everything but SQLite, where there is no server to drop connections.
+    """
+    if url is None:
+        url = get_url()
+    settings = {
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': pool_timeout,
+        'pool_recycle': pool_recycle,
+    }
+    for name, env in POOL_ENV.items():
+        if settings[name] is None and os.environ.get(env):
+            settings[name] = int(os.environ[env])
+
+    backend = make_url(url).get_backend_name()
+    if backend == 'sqlite':
+        kwargs.setdefault('connect_args', {}).setdefault('check_same_thread', False)
+        if is_sqlite_memory(url):
+            kwargs.setdefault('poolclass', StaticPool)
+            settings = {}
+        else:
+            kwargs.setdefault('poolclass', QueuePool)
+    if pool_pre_ping is None:
+        pool_pre_ping = backend != 'sqlite'
+
+    for name, value in settings.items():
+        if value is not None:
+            kwargs[name] = value
+    engine = create_engine(url, pool_pre_ping=pool_pre_ping, **kwargs)
+
+    if backend == 'sqlite' and sqlite_pragmas:
+        @event.listens_for(engine, 'connect')
+        def on_connect(dbapi_connection, connection_record):
+            set_sqlite_pragmas(dbapi_connection, sqlite_pragmas)
+
+    log.info("make_engine(): {} {}".format(engine, engine.pool.status()))
+    return engine
+
+
+def make_session(engine=None):
+    "a sessionmaker bound to engine"
+    if engine is None:
+        engine = make_engine()
+    return sessionmaker(bind=engine)
+
+
+################################################################################
+# benchmark
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def benchmark_checkout(engine, threads=8, checkouts=500):
+    """
+    every worker thread checks out a connection, runs a trivial query and
+    returns it; reports checkout latency percentiles and total throughput
+    """
+    latencies = []
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        mine = []
+        try:
+            for i in range(checkouts):
+                start = timeit.default_timer()
+                conn = engine.connect()
+                mine.append(timeit.default_timer() - start)
+                conn.execute(text("SELECT 1")).scalar()
+                conn.close()
+        except Exception as e:
+            errors.append(e)
+        with lock:
+            latencies.extend(mine)
+
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    start = timeit.default_timer()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    elapsed = timeit.default_timer() - start
+    if errors:
+        raise errors[0]
+
+    total = threads * checkouts
+    results = {
+        'threads': threads,
+        'checkouts': total,
+        'seconds': elapsed,
+        'checkouts_per_sec': total / elapsed,
+        'p50_ms': _percentile(latencies, 0.50) * 1000,
+        'p99_ms': _percentile(latencies, 0.99) * 1000,
+        'max_ms': max(latencies) * 1000,
+    }
+    log.info("{threads} threads: {checkouts} checkouts in {seconds:.3f}s, "
+             "{checkouts_per_sec:,.0f}/sec, checkout p50 {p50_ms:.3f}ms "
+             "p99 {p99_ms:.3f}ms max {max_ms:.3f}ms".format(**results))
+    return results
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = parse_args()
+    threads = int(args[0]) if len(args) > 0 else 8
+    checkouts = int(args[1]) if len(args) > 1 else 500
+
+    engine = make_engine(url)
+    for n in sorted(set([1, threads // 2 or 1, threads])):
+        benchmark_checkout(engine, n, checkouts)
+    log.info("pool: {}".format(engine.pool.status()))
+    engine.dispose()
+    log.info("all done!")
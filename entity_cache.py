@@ -0,0 +1,567 @@
+"""
+second-level cache for pets, people, shelters and their reference rows
+
+Every new Session starts with an empty identity map, so each request
+handler fetches the same Pet, Person and Shelter rows by primary key again.
+CachingSession looks in an EntityCache when its identity map misses:
+
+  - get(), query(...).get() and many-to-one relationship loads (Pet.breed,
+    Pet.shelter, Breed.species, PetPersonAssociation.pet/.person) go
+    through Session._identity_lookup(), which CachingSession extends to
+    build the object from its cached column values with no SELECT
+  - the Pet.person_associations and Person.pet_associations collections are
+    cached as lists of association ids, answered in do_orm_execute when
+    every association in the list is cached too
+  - every row loaded from the database is stored as it is loaded
+
+    cache = EntityCache()                          # in-process LRU
+    cache = EntityCache(SocketCache('/tmp/pets-cache.sock'))
+    Session = cache.sessionmaker(engine)
+    pet = Session().get(model.Pet, 5)
+
+The cache holds plain column values, never ORM objects, so entries are
+shared between sessions, threads and, with SocketCache, processes.  A
+CacheServer serves them over a local Unix socket, as JSON lines:
+
+    python entity_cache.py --serve /tmp/pets-cache.sock
+
+Invalidation: a flush pops the entries of every row and collection it
+changed, and the commit pops them again, in case another session put the
+old row back in between.  Deleting a species, breed, shelter, pet or
+person clears the whole cache, since the database's ON DELETE rules change
+rows the session never loaded, and so does a bulk query.update()/delete()
+of a cached entity.  Once a session has flushed, it reads and stores
+nothing through the cache until the transaction ends, so uncommitted rows
+never get in.  Writes made outside a CachingSession are not seen; the
+LRU's ttl bounds how long they can be served stale.
+
+run as a script to replay a pet-detail request mix against no cache, the
+LRU and the socket backend:
+
+    python entity_cache.py [url] [number of requests] [number of pets]
+"""
+import collections
+import importlib
+import json
+import os
+import random
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import timeit
+
+from sqlalchemy import event, inspect
+from sqlalchemy.engine.result import IteratorResult, SimpleResultMetaData
+from sqlalchemy.orm import Session, attributes, make_transient_to_detached, sessionmaker
+from sqlalchemy.orm.attributes import set_committed_value
+
+import db
+from reference_cache import LRUCache
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+CACHED = (model.Species, model.Breed, model.Shelter, model.Pet, model.Person,
+          model.PetPersonAssociation)
+
+# deleting one of these clears the cache, see the module docstring
+CLEARS_ON_DELETE = (model.Species, model.Breed, model.Shelter, model.Pet, model.Person)
+
+# cached collections: name -> (parent entity, child entity, child foreign key)
+COLLECTIONS = {
+    'Pet.person_associations': (model.Pet, model.PetPersonAssociation, 'pet_id'),
+    'Person.pet_associations': (model.Person, model.PetPersonAssociation, 'person_id'),
+}
+
+# session.info keys
+WROTE = 'entity_cache_wrote'
+STALE = 'entity_cache_stale'
+CLEAR = 'entity_cache_clear'
+
+_missing = object()
+
+
+################################################################################
+# local socket backend
+
+class CacheServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    an LRUCache served on a Unix socket; each request and reply is a line
+    of JSON, [op, key, value] in and [found, value] out
+    """
+    daemon_threads = True
+
+    def __init__(self, path, maxsize=100000, ttl=300):
+        self.lru = LRUCache(maxsize, ttl)
+        socketserver.UnixStreamServer.__init__(self, path, _CacheHandler)
+        # the socket file is the only access control
+        os.chmod(path, 0o600)
+
+
+class _CacheHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        lru = self.server.lru
+        for line in self.rfile:
+            op, key, value = json.loads(line)
+            key = tuple(key) if key is not None else None
+            if op == 'get':
+                value = lru.get(key, _missing)
+                reply = [False, None] if value is _missing else [True, value]
+            elif op == 'put':
+                lru.put(key, value)
+                reply = [True, None]
+            elif op == 'pop':
+                lru.pop(key)
+                reply = [True, None]
+            elif op == 'clear':
+                lru.clear()
+                reply = [True, None]
+            elif op == 'stats':
+                reply = [True, lru.stats()]
+            else:
+                reply = [False, "unknown op {}".format(op)]
+            self.wfile.write((json.dumps(reply) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+
+def serve(path, maxsize=100000, ttl=300):
+    "a CacheServer on path, answering from a daemon thread"
+    server = CacheServer(path, maxsize, ttl)
+    thread = threading.Thread(target=server.serve_forever, name='entity-cache-server')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class SocketCache(object):
+    """
+    client for a CacheServer, with the LRUCache methods the EntityCache
+    uses; one connection per thread
+    """
+
+    def __init__(self, path, timeout=1.0):
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _call(self, op, key=None, value=None):
+        stream = getattr(self._local, 'stream', None)
+        if stream is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.path)
+            self._local.sock = sock
+            self._local.stream = stream = sock.makefile('rw')
+        stream.write(json.dumps([op, key, value]) + '\n')
+        stream.flush()
+        return json.loads(stream.readline())
+
+    def get(self, key, default=None):
+        found, value = self._call('get', key)
+        return value if found else default
+
+    def put(self, key, value):
+        self._call('put', key, value)
+
+    def pop(self, key):
+        self._call('pop', key)
+
+    def clear(self):
+        self._call('clear')
+
+    def stats(self):
+        return self._call('stats')[1]
+
+    def close(self):
+        stream = getattr(self._local, 'stream', None)
+        if stream is not None:
+            stream.close()
+            self._local.sock.close()
+            self._local.stream = None
+
+
+################################################################################
+# the cache
+
+class EntityCache(object):
+    """
+    cached column values per row and association ids per collection, in
+    backend: an LRUCache (the default) or a SocketCache
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else LRUCache(maxsize=100000, ttl=300)
+        self.columns = dict((entity, [prop.key for prop in inspect(entity).column_attrs])
+                            for entity in CACHED)
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        self.hit_seconds = 0.0
+        self.clears = 0
+        self._lock = threading.Lock()
+
+    def sessionmaker(self, engine, **kwargs):
+        "a sessionmaker for CachingSessions on engine that use this cache"
+        return sessionmaker(bind=engine, class_=CachingSession, entity_cache=self, **kwargs)
+
+    def _count(self, kind, hit, elapsed=0.0):
+        with self._lock:
+            if hit:
+                self.hits[kind] += 1
+                self.hit_seconds += elapsed
+            else:
+                self.misses[kind] += 1
+
+    # rows
+
+    def store(self, obj):
+        "cache obj's loaded column values"
+        entity = type(obj)
+        state_dict = inspect(obj).dict
+        columns = self.columns[entity]
+        if all(key in state_dict for key in columns):
+            self.backend.put((entity.__name__, obj.id), [state_dict[key] for key in columns])
+
+    def materialize(self, session, mapper, primary_key_identity):
+        "the object for a cached row, added to session, or None"
+        entity = mapper.class_
+        columns = self.columns.get(entity)
+        if columns is None or len(primary_key_identity) != 1:
+            return None
+        start = timeit.default_timer()
+        values = self.backend.get((entity.__name__, primary_key_identity[0]))
+        if values is None:
+            self._count(entity.__name__, False)
+            return None
+        obj = mapper.class_manager.new_instance()
+        for key, value in zip(columns, values):
+            set_committed_value(obj, key, value)
+        make_transient_to_detached(obj)
+        session.add(obj)
+        self._count(entity.__name__, True, timeit.default_timer() - start)
+        return obj
+
+    # collections
+
+    def collection_for(self, parent, mappers):
+        "the cached collection a relationship load of mappers from parent is for, or None"
+        for name, (parent_entity, child, fk) in COLLECTIONS.items():
+            if issubclass(parent, parent_entity) and [m.class_ for m in mappers] == [child]:
+                return name
+        return None
+
+    def load_collection(self, orm_context, name):
+        "answer a collection load from the cache, or run it and cache the ids"
+        session = orm_context.session
+        parent_id = orm_context.lazy_loaded_from.dict.get('id')
+        child = COLLECTIONS[name][1]
+        child_mapper = inspect(child)
+        key = (name, parent_id)
+
+        start = timeit.default_timer()
+        ids = self.backend.get(key)
+        if ids is not None:
+            children = []
+            for id in ids:
+                obj = session._identity_lookup(child_mapper, (id,))
+                if obj is None:
+                    break
+                children.append(obj)
+            else:
+                self._count(name, True, timeit.default_timer() - start)
+                return IteratorResult(SimpleResultMetaData([child.__name__]),
+                                      iter([(obj,) for obj in children]))
+        self._count(name, False)
+        frozen = orm_context.invoke_statement().freeze()
+        self.backend.put(key, [obj.id for obj in frozen().scalars()])
+        return frozen()
+
+    # invalidation
+
+    def stale_keys(self, obj):
+        "the entries a change to obj makes stale, before and after the change"
+        keys = [(type(obj).__name__, obj.id)]
+        for name, (parent, child, fk) in COLLECTIONS.items():
+            if isinstance(obj, child):
+                history = getattr(inspect(obj).attrs, fk).history
+                for parent_id in set(history.sum()) | set(history.unchanged or ()) | set([getattr(obj, fk)]):
+                    if parent_id is not None:
+                        keys.append((name, parent_id))
+        return keys
+
+    def invalidate(self, keys, clear=False):
+        if clear:
+            self.backend.clear()
+            with self._lock:
+                self.clears += 1
+            return
+        for key in keys:
+            self.backend.pop(key)
+
+    def stats(self):
+        "hits and misses per entity and collection, and the backend's counters"
+        hits = sum(self.hits.values())
+        lookups = hits + sum(self.misses.values())
+        return {
+            'hits': dict(self.hits),
+            'misses': dict(self.misses),
+            'hit_ratio': float(hits) / lookups if lookups else 0.0,
+            'mean_hit_us': self.hit_seconds / hits * 1e6 if hits else 0.0,
+            'clears': self.clears,
+            'backend': self.backend.stats(),
+        }
+
+
+class CachingSession(Session):
+    "a Session that falls back on an EntityCache when its identity map misses"
+
+    def __init__(self, entity_cache=None, **kwargs):
+        super(CachingSession, self).__init__(**kwargs)
+        self.entity_cache = entity_cache
+
+    def uses_cache(self):
+        "whether reads in this session may go through the cache right now"
+        return self.entity_cache is not None and not self._flushing and not self.info.get(WROTE)
+
+    def _identity_lookup(self, mapper, primary_key_identity, identity_token=None,
+                         passive=attributes.PASSIVE_OFF, lazy_loaded_from=None, **kw):
+        obj = super(CachingSession, self)._identity_lookup(
+            mapper, primary_key_identity, identity_token=identity_token, passive=passive,
+            lazy_loaded_from=lazy_loaded_from, **kw)
+        if obj is not None or not self.uses_cache():
+            return obj
+        key = mapper.identity_key_from_primary_key(primary_key_identity, identity_token=identity_token)
+        if key in self.identity_map:
+            # there but expired or deleted; the caller knows what to do
+            return obj
+        return self.entity_cache.materialize(self, mapper, primary_key_identity)
+
+
+@event.listens_for(CachingSession, 'do_orm_execute')
+def _do_orm_execute(orm_context):
+    session = orm_context.session
+    cache = session.entity_cache
+    if cache is None:
+        return None
+    if orm_context.is_update or orm_context.is_delete:
+        if any(issubclass(m.class_, CACHED) for m in orm_context.all_mappers):
+            session.info[WROTE] = True
+            session.info[CLEAR] = True
+            cache.invalidate((), clear=True)
+        return None
+    if not orm_context.is_relationship_load or not session.uses_cache():
+        return None
+    parent = orm_context.lazy_loaded_from
+    name = cache.collection_for(parent.class_, orm_context.all_mappers) if parent is not None else None
+    if name is None:
+        return None
+    return cache.load_collection(orm_context, name)
+
+
+def _on_load(target, context, *args):
+    session = context.session
+    if isinstance(session, CachingSession) and session.uses_cache():
+        session.entity_cache.store(target)
+
+
+for _entity in CACHED:
+    event.listen(_entity, 'load', _on_load)
+    event.listen(_entity, 'refresh', _on_load)
+
+
+@event.listens_for(CachingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    cache = session.entity_cache
+    if cache is None:
+        return
+    session.info[WROTE] = True
+    stale = session.info.setdefault(STALE, set())
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if not isinstance(obj, CACHED):
+            continue
+        if obj in session.deleted and isinstance(obj, CLEARS_ON_DELETE):
+            session.info[CLEAR] = True
+        if obj in session.dirty and not session.is_modified(obj, include_collections=False):
+            continue
+        stale.update(cache.stale_keys(obj))
+    cache.invalidate(stale, session.info.get(CLEAR, False))
+
+
+@event.listens_for(CachingSession, 'after_commit')
+def _after_commit(session):
+    cache = session.entity_cache
+    stale = session.info.pop(STALE, ())
+    clear = session.info.pop(CLEAR, False)
+    session.info.pop(WROTE, None)
+    if cache is not None and (stale or clear):
+        cache.invalidate(stale, clear)
+
+
+@event.listens_for(CachingSession, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop(STALE, None)
+    session.info.pop(CLEAR, None)
+    session.info.pop(WROTE, None)
+
+
+################################################################################
+# benchmark: a pet-detail request mix
+
+def pet_detail(session, pet_id):
+    "what a pet page shows"
+    pet = session.get(model.Pet, pet_id)
+    breed = pet.breed
+    return {
+        'name': pet.name,
+        'age': pet.age,
+        'adopted': pet.adopted,
+        'breed': breed.name if breed else None,
+        'species': breed.species.name if breed else None,
+        'shelter': pet.shelter.name if pet.shelter else None,
+        'nicknames': sorted((a.person.first_name, a.nickname) for a in pet.person_associations),
+    }
+
+
+def person_detail(session, person_id):
+    "what a person page shows"
+    person = session.get(model.Person, person_id)
+    return {
+        'name': '{} {}'.format(person.first_name, person.last_name),
+        'phone': person.phone,
+        'pets': sorted((a.pet.name, a.nickname) for a in person.pet_associations),
+    }
+
+
+def adopt(session, pet_id):
+    pet = session.get(model.Pet, pet_id)
+    pet.adopted = not pet.adopted
+    session.commit()
+    return pet.adopted
+
+
+def rename(session, pet_id, nickname):
+    pet = session.get(model.Pet, pet_id)
+    pet.person_associations[0].nickname = nickname
+    session.commit()
+    return nickname
+
+
+def requests(num_requests, num_pets, people, hot=0.1, seed=0):
+    """
+    (handler, args) pairs: pet pages, person pages and a few writes, four
+    in five pet requests for the hot fraction of pets
+    """
+    rng = random.Random(seed)
+    hot_pets = max(1, int(num_pets * hot))
+    result = []
+    for i in range(num_requests):
+        pet_id = rng.randrange(hot_pets if rng.random() < 0.8 else num_pets) + 1
+        kind = rng.random()
+        if kind < 0.75:
+            result.append((pet_detail, (pet_id,)))
+        elif kind < 0.95:
+            result.append((person_detail, (rng.randrange(people) + 1,)))
+        elif kind < 0.98:
+            result.append((adopt, (pet_id,)))
+        else:
+            result.append((rename, (pet_id, 'renamed{}'.format(i))))
+    return result
+
+
+def replay(Session, mix):
+    "responses and per-request latencies, each request in a new session"
+    responses = []
+    latencies = []
+    for handler, args in mix:
+        start = timeit.default_timer()
+        db_session = Session()
+        responses.append(handler(db_session, *args))
+        db_session.close()
+        latencies.append(timeit.default_timer() - start)
+    return responses, latencies
+
+
+def benchmark(engine, num_requests, num_pets, people=1000):
+    queries = importlib.import_module('queries')
+    mix = requests(num_requests, num_pets, people)
+    socket_dir = tempfile.mkdtemp(prefix='pets-cache-')
+    socket_path = os.path.join(socket_dir, 'cache.sock')
+    server = serve(socket_path)
+    results = {}
+    try:
+        for name in ('no cache', 'lru', 'socket'):
+            queries.seed(engine, num_pets, people)
+            if name == 'no cache':
+                cache = None
+                Session = db.make_session(engine)
+            else:
+                cache = EntityCache(SocketCache(socket_path) if name == 'socket' else None)
+                Session = cache.sessionmaker(engine)
+            with queries.StatementCounter(engine) as counter:
+                responses, latencies = replay(Session, mix)
+            latencies.sort()
+            results[name] = {
+                'responses': responses,
+                'statements': counter.count,
+                'seconds': sum(latencies),
+                'p50_ms': latencies[len(latencies) // 2] * 1000,
+                'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+                'cache': cache.stats() if cache else None,
+            }
+            if cache is not None:
+                cache.backend.clear()
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.remove(socket_path)
+        os.rmdir(socket_dir)
+
+    baseline = results['no cache']
+    for name in ('no cache', 'lru', 'socket'):
+        result = results[name]
+        assert result['responses'] == baseline['responses'], name
+        log.info("{:>8}: {} requests in {:.3f}s, {:,.0f}/sec, p50 {:.3f}ms p99 {:.3f}ms, "
+                 "{} statements, {:.0f}% of the time saved".format(
+                     name, num_requests, result['seconds'], num_requests / result['seconds'],
+                     result['p50_ms'], result['p99_ms'], result['statements'],
+                     100 * (1 - result['seconds'] / baseline['seconds'])))
+        if result['cache']:
+            stats = result['cache']
+            log.info("          hit ratio {:.1%}, {:.1f}us per hit, {} clears, backend {}".format(
+                stats['hit_ratio'], stats['mean_hit_us'], stats['clears'], stats['backend']))
+    return results
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--serve']:
+        server = CacheServer(sys.argv[2])
+        try:
+            server.serve_forever()
+        finally:
+            os.remove(sys.argv[2])
+        sys.exit(0)
+
+    log.info("main executing:")
+    url, args = db.parse_args()
+    num_requests = int(args[0]) if len(args) > 0 else 20000
+    num_pets = int(args[1]) if len(args) > 1 else 20000
+
+    engine = db.make_engine(url)
+    benchmark(engine, num_requests, num_pets)
+    engine.dispose()
+    log.info("all done!")
@@ -0,0 +1,253 @@
+"""
+streaming export of pets
+
+Pets are read with a server-side cursor (stream_results) in chunks of
+yield_per rows, joined to breed, species and shelter in SQL.  Their nicknames
+come from a second streamed cursor ordered the same way and are merged in
+Python, so memory stays constant however many pets there are.  Rows flow
+through generators straight into a JSONL or CSV writer.
+
+    python export.py [url] pets.jsonl
+    python export.py [url] pets.csv
+
+run with --benchmark to compare peak RSS and rows/sec against loading
+every Pet through the ORM first:
+
+    python export.py [url] --benchmark [number of pets]
+"""
+import csv
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import timeit
+
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload, selectinload
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+DEFAULT_CHUNK_SIZE = 1000
+
+FIELDS = ['id', 'name', 'age', 'adopted', 'breed', 'species', 'shelter',
+          'shelter_website', 'nicknames']
+
+
+################################################################################
+# reading
+
+def pets_statement():
+    "one row per pet with its breed, species and shelter, in id order"
+    pet = model.Pet.__table__
+    breed = model.Breed.__table__
+    species = model.Species.__table__
+    shelter = model.Shelter.__table__
+    return (select(pet.c.id, pet.c.name, pet.c.age, pet.c.adopted,
+                   breed.c.name.label('breed'), species.c.name.label('species'),
+                   shelter.c.name.label('shelter'), shelter.c.website.label('shelter_website'))
+            .select_from(pet
+                         .outerjoin(breed, pet.c.breed_id == breed.c.id)
+                         .outerjoin(species, breed.c.species_id == species.c.id)
+                         .outerjoin(shelter, pet.c.shelter_id == shelter.c.id))
+            .order_by(pet.c.id))
+
+
+def nicknames_statement():
+    "(pet_id, nickname) for every association, in pet order"
+    assoc = model.PetPersonAssociation.__table__
+    return (select(assoc.c.pet_id, assoc.c.nickname)
+            .order_by(assoc.c.pet_id, assoc.c.id))
+
+
+def stream(conn, statement, chunk_size=DEFAULT_CHUNK_SIZE):
+    "yield the rows of statement, fetching chunk_size at a time from a server-side cursor"
+    result = conn.execution_options(stream_results=True, yield_per=chunk_size).execute(statement)
+    for partition in result.partitions(chunk_size):
+        for row in partition:
+            yield row
+
+
+def pet_records(engine, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    yield one dict per pet, nicknames included
+
+    pets and nicknames are two streams in pet id order merged like a merge
+    join, each on its own connection so server-side cursors never overlap
+    """
+    with engine.connect() as pet_conn, engine.connect() as nick_conn:
+        nicknames = stream(nick_conn, nicknames_statement(), chunk_size)
+        pending = next(nicknames, None)
+        for row in stream(pet_conn, pets_statement(), chunk_size):
+            record = dict(row._mapping)
+            record['nicknames'] = []
+            # skip nicknames of pets the outer stream never sees
+            while pending is not None and pending.pet_id < row.id:
+                pending = next(nicknames, None)
+            while pending is not None and pending.pet_id == row.id:
+                record['nicknames'].append(pending.nickname)
+                pending = next(nicknames, None)
+            yield record
+
+
+################################################################################
+# writing
+
+def write_jsonl(records, f):
+    "write one JSON object per line, returns the number written"
+    count = 0
+    for record in records:
+        f.write(json.dumps(record))
+        f.write('\n')
+        count += 1
+    return count
+
+
+def write_csv(records, f):
+    "write CSV with a header, nicknames joined with |, returns the number written"
+    writer = csv.DictWriter(f, fieldnames=FIELDS)
+    writer.writeheader()
+    count = 0
+    for record in records:
+        record = dict(record)
+        record['nicknames'] = '|'.join(n for n in record['nicknames'] if n is not None)
+        writer.writerow(record)
+        count += 1
+    return count
+
+
+WRITERS = {
+    '.jsonl': write_jsonl,
+    '.json': write_jsonl,
+    '.csv': write_csv,
+}
+
+
+def export(engine, path, chunk_size=DEFAULT_CHUNK_SIZE):
+    "stream every pet into path, format from the extension; returns the row count"
+    writer = WRITERS.get(os.path.splitext(path)[1])
+    if writer is None:
+        raise ValueError("don't know how to write {}".format(path))
+    log.info("export() {}".format(path))
+    with open(path, 'w') as f:
+        return writer(pet_records(engine, chunk_size), f)
+
+
+################################################################################
+# benchmark
+
+def eager_records(engine):
+    "the all-in-memory way: load every Pet through the ORM, then convert"
+    db_session = db.make_session(engine)()
+    pets = (db_session.query(model.Pet)
+            .options(joinedload(model.Pet.breed).joinedload(model.Breed.species),
+                     joinedload(model.Pet.shelter),
+                     selectinload(model.Pet.person_associations))
+            .order_by(model.Pet.id).all())
+    records = []
+    for pet in pets:
+        records.append({
+            'id': pet.id, 'name': pet.name, 'age': pet.age, 'adopted': pet.adopted,
+            'breed': pet.breed.name if pet.breed else None,
+            'species': pet.breed.species.name if pet.breed else None,
+            'shelter': pet.shelter.name if pet.shelter else None,
+            'shelter_website': pet.shelter.website if pet.shelter else None,
+            'nicknames': pet.nicknames(),
+        })
+    db_session.close()
+    return records
+
+
+def peak_rss_kb():
+    "this process's peak resident set size in KiB"
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB on Linux
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _run(url, how, path, queue):
+    engine = db.make_engine(url)
+    before = peak_rss_kb()
+    start = timeit.default_timer()
+    if how == 'stream':
+        count = export(engine, path)
+    else:
+        with open(path, 'w') as f:
+            count = write_jsonl(eager_records(engine), f)
+    elapsed = timeit.default_timer() - start
+    queue.put((count, elapsed, peak_rss_kb() - before))
+    engine.dispose()
+
+
+def benchmark(url, num_pets):
+    """
+    load num_pets pets with two nicknames each, then export them once
+    streaming and once eagerly, each in a fresh process so peak RSS is its own
+    """
+    queries = importlib.import_module('queries')
+    engine = db.make_engine(url)
+    queries.seed(engine, num_pets)
+    engine.dispose()
+
+    results = {}
+    fd, path = tempfile.mkstemp(suffix='.jsonl')
+    os.close(fd)
+    try:
+        for how in ('stream', 'eager'):
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(target=_run, args=(url, how, path, queue))
+            process.start()
+            count, elapsed, rss = queue.get()
+            process.join()
+            assert count == num_pets
+            results[how] = (elapsed, rss)
+            log.info("{:>6}: {} pets in {:.2f}s, {:,.0f} rows/sec, peak RSS +{:,} KiB".format(
+                how, count, elapsed, count / elapsed, rss))
+    finally:
+        os.remove(path)
+    return results
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    if args and args[0] == '--benchmark':
+        num_pets = int(args[1]) if len(args) > 1 else 200000
+        path = None
+        if db.is_sqlite_memory(url):
+            # the worker processes need to see the same database
+            fd, path = tempfile.mkstemp(suffix='.db')
+            os.close(fd)
+            url = 'sqlite:///{}'.format(path)
+        try:
+            benchmark(url, num_pets)
+        finally:
+            if path:
+                for suffix in ('', '-wal', '-shm'):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+    elif args:
+        engine = db.make_engine(url)
+        log.info("exported {} pets".format(export(engine, args[0])))
+        engine.dispose()
+    else:
+        sys.exit("usage: python export.py [url] <out.jsonl|out.csv> | --benchmark [pets]")
+    log.info("all done!")
@@ -0,0 +1,442 @@
+"""
+statement-level profiling and slow-query logging
+
+SQLStats hooks before_cursor_execute/after_cursor_execute on an engine (or
+every engine) and keeps, per distinct statement, a latency histogram, the
+number of executions, the rows it returned and the rows it affected.
+Session flush and commit times get histograms of their own.  Statements slower than
+slow_threshold are logged with a fingerprint of their bound parameters, so
+repeated slow calls can be grouped without writing the values to the log.
+
+    stats = SQLStats()
+    stats.attach(engine, Session)
+    ...
+    stats.snapshot()      # plain dict
+    stats.prometheus()    # Prometheus text exposition format
+    serve(stats, 9100)    # /metrics endpoint for a long-running worker
+
+rows_returned counts rows as they are fetched from the cursor, since
+sqlite3's rowcount is -1 for SELECT; rows a caller never fetches aren't
+counted.  rows_affected is the driver's row count for INSERT/UPDATE/DELETE
+and other statements that return no rows.
+
+run as a script to profile one of the demo scripts:
+
+    python instrument.py one-to-many-demo.py [url]
+"""
+import hashlib
+import re
+import runpy
+import sys
+import threading
+import timeit
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# histogram bucket upper bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# statements beyond this many distinct ones are counted together as "other"
+MAX_STATEMENTS = 500
+
+# connection.info / session.info keys
+START_TIMES = 'instrument_query_start'
+FLUSH_START = 'instrument_flush_start'
+COMMIT_START = 'instrument_commit_start'
+
+
+################################################################################
+# fingerprints
+
+_whitespace = re.compile(r'\s+')
+_in_list = re.compile(r'\(\s*(?:\?|%\(\w+\)s|%s|:\w+|\$\d+)(?:\s*,\s*(?:\?|%\(\w+\)s|%s|:\w+|\$\d+))+\s*\)')
+
+
+def normalize(statement):
+    "collapse whitespace and IN lists so one query shape is one statement"
+    statement = _whitespace.sub(' ', statement).strip()
+    statement = _in_list.sub('(...)', statement)
+    return statement
+
+
+def fingerprint(value):
+    "short stable hash of value's repr"
+    return hashlib.sha1(repr(value).encode('utf-8')).hexdigest()[:12]
+
+
+################################################################################
+# histograms
+
+class Histogram(object):
+    "cumulative-bucket latency histogram, Prometheus style"
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def cumulative(self):
+        "[(upper bound, observations <= bound)], ending with +Inf"
+        total = 0
+        result = []
+        for bound, n in zip(list(self.buckets) + [float('inf')], self.counts):
+            total += n
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        "upper bound of the bucket holding the q quantile"
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        for bound, total in self.cumulative():
+            if total >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.quantile(0.50),
+            'p99': self.quantile(0.99),
+        }
+
+
+class StatementStats(object):
+    "everything recorded about one normalized statement"
+
+    def __init__(self, statement):
+        self.statement = statement
+        self.id = fingerprint(statement)
+        self.latency = Histogram()
+        self.rows_returned = 0
+        self.rows_affected = 0
+        self.slow = 0
+
+    def as_dict(self):
+        result = self.latency.as_dict()
+        result.update(statement=self.statement, rows_returned=self.rows_returned,
+                      rows_affected=self.rows_affected, slow=self.slow)
+        return result
+
+
+class RowCountingCursor(object):
+    "a DBAPI cursor that adds the rows fetched from it to a StatementStats"
+
+    def __init__(self, cursor, stats, lock):
+        self._cursor = cursor
+        self._stats = stats
+        self._lock = lock
+
+    def _count(self, rows):
+        with self._lock:
+            self._stats.rows_returned += rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._count(1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._count(len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._count(1)
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+################################################################################
+# collector
+
+class SQLStats(object):
+    """
+    collects statement, flush and commit timings from the engines and
+    sessions it is attached to
+    """
+
+    def __init__(self, slow_threshold=0.1, max_statements=MAX_STATEMENTS):
+        self.slow_threshold = slow_threshold
+        self.max_statements = max_statements
+        self.statements = {}
+        self.flush = Histogram()
+        self.commit = Histogram()
+        self._lock = threading.Lock()
+        self._targets = []
+
+    # wiring
+
+    def attach(self, engine=Engine, session=Session):
+        """
+        listen on engine (an Engine, or the Engine class for all of them) and
+        session (a Session, sessionmaker or the Session class); either can be
+        None to skip it
+        """
+        listeners = []
+        if engine is not None:
+            listeners += [
+                (engine, 'before_cursor_execute', self._before_cursor_execute),
+                (engine, 'after_cursor_execute', self._after_cursor_execute),
+                (engine, 'handle_error', self._handle_error),
+            ]
+        if session is not None:
+            listeners += [
+                (session, 'before_flush', self._before_flush),
+                (session, 'after_flush_postexec', self._after_flush_postexec),
+                (session, 'before_commit', self._before_commit),
+                (session, 'after_commit', self._after_commit),
+                (session, 'after_rollback', self._after_rollback),
+            ]
+        for target, name, fn in listeners:
+            event.listen(target, name, fn)
+        self._targets.extend(listeners)
+        return self
+
+    def detach(self):
+        for target, name, fn in self._targets:
+            event.remove(target, name, fn)
+        self._targets = []
+
+    # engine events
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault(START_TIMES, []).append(timeit.default_timer())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = timeit.default_timer() - conn.info[START_TIMES].pop()
+        rows_affected = 0
+        # a SELECT's rowcount is -1 on some drivers and rows returned on
+        # others, so only statements that change rows count
+        if (context is not None and context.is_crud) or cursor.description is None:
+            rows_affected = max(cursor.rowcount or 0, 0)
+        stats = self.record(statement, elapsed, rows_affected, parameters)
+        if context is not None and cursor.description is not None:
+            # the result is built on context.cursor next, so its fetches
+            # go through the wrapper
+            context.cursor = RowCountingCursor(cursor, stats, self._lock)
+
+    def _handle_error(self, exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get(START_TIMES):
+            conn.info[START_TIMES].pop()
+
+    def record(self, statement, elapsed, rows_affected=0, parameters=None):
+        "add one execution of statement, returns its StatementStats"
+        normalized = normalize(statement)
+        with self._lock:
+            stats = self.statements.get(normalized)
+            if stats is None:
+                if len(self.statements) >= self.max_statements:
+                    normalized = 'other'
+                    stats = self.statements.get(normalized)
+                if stats is None:
+                    stats = self.statements[normalized] = StatementStats(normalized)
+            stats.latency.observe(elapsed)
+            stats.rows_affected += rows_affected
+            slow = elapsed >= self.slow_threshold
+            if slow:
+                stats.slow += 1
+        if slow:
+            log.warning("slow query {:.1f}ms statement={} params={} rows_affected={}: {}".format(
+                elapsed * 1000, stats.id, fingerprint(parameters), rows_affected, normalized[:500]))
+        return stats
+
+    # session events
+
+    def _before_flush(self, session, flush_context, instances):
+        session.info[FLUSH_START] = timeit.default_timer()
+
+    def _after_flush_postexec(self, session, flush_context):
+        start = session.info.pop(FLUSH_START, None)
+        if start is not None:
+            with self._lock:
+                self.flush.observe(timeit.default_timer() - start)
+
+    def _before_commit(self, session):
+        session.info[COMMIT_START] = timeit.default_timer()
+
+    def _after_commit(self, session):
+        start = session.info.pop(COMMIT_START, None)
+        if start is not None:
+            with self._lock:
+                self.commit.observe(timeit.default_timer() - start)
+
+    def _after_rollback(self, session):
+        session.info.pop(FLUSH_START, None)
+        session.info.pop(COMMIT_START, None)
+
+    # reporting
+
+    def reset(self):
+        with self._lock:
+            self.statements = {}
+            self.flush = Histogram()
+            self.commit = Histogram()
+
+    def snapshot(self):
+        "the aggregated stats as a plain dict"
+        with self._lock:
+            return {
+                'statements': dict((s.id, s.as_dict()) for s in self.statements.values()),
+                'flush': self.flush.as_dict(),
+                'commit': self.commit.as_dict(),
+            }
+
+    def top(self, n=10, key='sum'):
+        "the n statements with the highest total (or count/max) time"
+        stats = self.snapshot()['statements'].values()
+        return sorted(stats, key=lambda s: s[key], reverse=True)[:n]
+
+    def prometheus(self):
+        "the aggregated stats in the Prometheus text exposition format"
+        lines = []
+        with self._lock:
+            statements = list(self.statements.values())
+            lines += ['# HELP sql_statement_seconds SQL statement execution time',
+                      '# TYPE sql_statement_seconds histogram']
+            for s in statements:
+                lines += _histogram_lines('sql_statement_seconds', s.latency,
+                                          'statement="{}"'.format(s.id))
+            lines += ['# HELP sql_statement_rows_returned_total rows fetched from the cursor',
+                      '# TYPE sql_statement_rows_returned_total counter']
+            for s in statements:
+                lines.append('sql_statement_rows_returned_total{{statement="{}"}} {}'.format(
+                    s.id, s.rows_returned))
+            lines += ['# HELP sql_statement_rows_affected_total rows inserted, updated or deleted',
+                      '# TYPE sql_statement_rows_affected_total counter']
+            for s in statements:
+                lines.append('sql_statement_rows_affected_total{{statement="{}"}} {}'.format(
+                    s.id, s.rows_affected))
+            lines += ['# HELP sql_statement_slow_total executions over the slow threshold',
+                      '# TYPE sql_statement_slow_total counter']
+            for s in statements:
+                lines.append('sql_statement_slow_total{{statement="{}"}} {}'.format(s.id, s.slow))
+            lines += ['# HELP sql_statement_info normalized SQL per statement id',
+                      '# TYPE sql_statement_info gauge']
+            for s in statements:
+                lines.append('sql_statement_info{{statement="{}",sql="{}"}} 1'.format(
+                    s.id, _escape(s.statement[:200])))
+            for name, histogram, help in [
+                    ('orm_flush_seconds', self.flush, 'Session flush time'),
+                    ('orm_commit_seconds', self.commit, 'Session commit time, flush included')]:
+                lines += ['# HELP {} {}'.format(name, help), '# TYPE {} histogram'.format(name)]
+                lines += _histogram_lines(name, histogram)
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _histogram_lines(name, histogram, labels=''):
+    sep = ',' if labels else ''
+    lines = []
+    for bound, total in histogram.cumulative():
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(name, labels, sep, le, total))
+    braces = '{{{}}}'.format(labels) if labels else ''
+    lines.append('{}_sum{} {}'.format(name, braces, histogram.sum))
+    lines.append('{}_count{} {}'.format(name, braces, histogram.count))
+    return lines
+
+
+################################################################################
+# scrape endpoint
+
+def serve(stats, port=9100, host='127.0.0.1'):
+    """
+    serve stats.prometheus() on http://host:port/metrics from a daemon
+    thread, returns the server so it can be shut down
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = stats.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug("metrics: " + format % args)
+
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    log.info("serving metrics on http://{}:{}/metrics".format(host, server.server_port))
+    return server
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    if len(sys.argv) < 2:
+        sys.exit("usage: python instrument.py <script.py> [script args]")
+    script = sys.argv[1]
+    sys.argv = sys.argv[1:]
+
+    # attached to the Engine and Session classes, so the script's own
+    # engine and sessions are covered
+    stats = SQLStats(slow_threshold=0.05).attach()
+    try:
+        runpy.run_path(script, run_name='__main__')
+    finally:
+        stats.detach()
+        # the script ran as __main__ too and added its own handler to our logger
+        log.handlers = [console_handler]
+        snapshot = stats.snapshot()
+        for s in stats.top(10):
+            log.info("{count:>6} x {sum:8.4f}s total, p99 {p99:.4f}s, {rows_returned} rows returned, {rows_affected} affected: {statement:.100}".format(**s))
+        log.info("flushes: {}".format(snapshot['flush']))
+        log.info("commits: {}".format(snapshot['commit']))
+        log.info("all done!")
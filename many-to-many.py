@@ -1,14 +1,13 @@
-# Getting a null constraint error when I run this. Something about my delete pet not 
-# removing the pet person association is wrong, but I don't know where to fix it
-
-from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, String, Boolean, Text
 from sqlalchemy import ForeignKey
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, object_session
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import Table
+from sqlalchemy import Table, Index
+from sqlalchemy import select, union_all, literal_column, literal, null, cast
 from sqlalchemy.schema import UniqueConstraint
+
+import db
  
 import logging
 log = logging.getLogger(__name__)
@@ -43,7 +42,7 @@ class Species(Base):
     # database fields
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
-    breeds = relationship('Breed', backref="species", cascade="all, delete-orphan")
+    breeds = relationship('Breed', backref="species", cascade="all, delete-orphan", passive_deletes=True)
 
  
     # methods
@@ -61,8 +60,8 @@ class Breed(Base):
     # database fields
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
-    species_id = Column(Integer, ForeignKey('species.id'), nullable=False )            
-    pets = relationship('Pet', backref="breed")
+    species_id = Column(Integer, ForeignKey('species.id', ondelete='CASCADE'), nullable=False, index=True)
+    pets = relationship('Pet', backref="breed", passive_deletes=True)
     # methods
     def __repr__(self):
         return "{}: {}".format(self.name, self.species) 
@@ -72,8 +71,10 @@ class Breed(Base):
 
 breed_breedtrait_table = Table('breed_breedtrait', Base.metadata,
     Column('id', Integer, primary_key=True),
-    Column('breed_id', Integer, ForeignKey('breed.id'), nullable=False),
-    Column('breedtrait_id', Integer, ForeignKey('breedtrait.id'), nullable=False)
+    Column('breed_id', Integer, ForeignKey('breed.id', ondelete='CASCADE'), nullable=False),
+    Column('breedtrait_id', Integer, ForeignKey('breedtrait.id', ondelete='CASCADE'), nullable=False, index=True),
+    # a breed has a trait once; breed first, so it covers lookups by breed
+    Index('ux_breed_breedtrait', 'breed_id', 'breedtrait_id', unique=True),
 )
 
 class BreedTrait(Base):
@@ -96,7 +97,9 @@ class Shelter(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     website = Column(Text)
-    pets = relationship('Pet', backref="shelter")
+    # shard key when the data is split across databases, see sharding.py
+    region = Column(String, nullable=True)
+    pets = relationship('Pet', backref="shelter", passive_deletes=True)
  
     def __repr__(self):
         return "Shelter: {}".format(self.name) 
@@ -105,16 +108,21 @@ class PetPersonAssociation(Base):
     __tablename__ = 'petPersonAssociation'
     __table_args__ = (
             UniqueConstraint('pet_id', 'person_id', name='person_pet_uniqueness_constraint'),
+            # the unique constraint is pet first, this covers lookups by person
+            Index('ix_petPersonAssociation_person_id', 'person_id', 'pet_id'),
         )
 
 
     id = Column(Integer, primary_key=True)
-    pet_id = Column(Integer, ForeignKey('pet.id'), nullable=False)
-    person_id = Column(Integer, ForeignKey('person.id'), nullable=False)
+    pet_id = Column(Integer, ForeignKey('pet.id', ondelete='CASCADE'), nullable=False)
+    person_id = Column(Integer, ForeignKey('person.id', ondelete='CASCADE'), nullable=False)
     nickname = Column(String, nullable=True)
 
-    pet = relationship('Pet', backref=backref('person_associations'), single_parent=True, cascade="all, delete-orphan")
-    person = relationship('Person', backref=backref('pet_associations'), single_parent=True, cascade="all, delete-orphan")
+    # the cascade belongs on the one-to-many side: deleting a pet or person
+    # deletes their associations, and the database does it with ON DELETE
+    # CASCADE so the associations don't have to be loaded first
+    pet = relationship('Pet', backref=backref('person_associations', cascade="all, delete-orphan", passive_deletes=True))
+    person = relationship('Person', backref=backref('pet_associations', cascade="all, delete-orphan", passive_deletes=True))
 
     def __repr__(self):
         return "PetPersonAssociation( {} : {} )".format(self.pet.name, 
@@ -131,8 +139,8 @@ class PetPersonAssociation(Base):
 
 
 pet_to_pet = Table("pet_to_pet", Base.metadata,
-    Column("left_pet_id", Integer, ForeignKey("pet.id"), primary_key=True),
-    Column("right_pet_id", Integer, ForeignKey("pet.id"), primary_key=True)
+    Column("left_pet_id", Integer, ForeignKey("pet.id", ondelete='CASCADE'), primary_key=True),
+    Column("right_pet_id", Integer, ForeignKey("pet.id", ondelete='CASCADE'), primary_key=True, index=True)
 )
 
  
@@ -147,10 +155,20 @@ class Pet(Base):
     name = Column(String, nullable=False)
     age = Column(Integer)
     adopted = Column(Boolean)
-    breed_id = Column(Integer, ForeignKey('breed.id'), nullable=True ) 
-    shelter_id = Column(Integer, ForeignKey('shelter.id') ) 
-    right_pet_id = Column(Integer, ForeignKey('pet.id'), nullable=True)
-    left_pet_id = Column(Integer, ForeignKey('pet.id'), nullable=True)
+    breed_id = Column(Integer, ForeignKey('breed.id', ondelete='SET NULL'), nullable=True, index=True)
+    shelter_id = Column(Integer, ForeignKey('shelter.id', ondelete='SET NULL') ) 
+    right_pet_id = Column(Integer, ForeignKey('pet.id', ondelete='SET NULL'), nullable=True, index=True)
+    left_pet_id = Column(Integer, ForeignKey('pet.id', ondelete='SET NULL'), nullable=True, index=True)
+    __table_args__ = (
+            # pets per shelter, by adoption status
+            Index('ix_pet_shelter_adopted', shelter_id, adopted),
+            # adoptable pets per shelter and breed; queries have to say
+            # Pet.adopted.is_(False) for the partial index to match
+            Index('ix_pet_adoptable', shelter_id, breed_id,
+                  sqlite_where=adopted.is_(False), postgresql_where=adopted.is_(False)),
+            # keyset pagination in shelter order, see pagination.py
+            Index('ix_pet_shelter_id', shelter_id, id),
+        )
     right_nodes = relationship("Pet", secondary=pet_to_pet, primaryjoin=id==pet_to_pet.c.left_pet_id, secondaryjoin=id==pet_to_pet.c.right_pet_id,backref="left_pets")
 
 
@@ -159,9 +177,112 @@ class Pet(Base):
         """return all nicknames for this pet"""
         return [ assoc.nickname for assoc in self.person_associations]
 
+    def ancestors(self, depth=None):
+        """return {child id: [parent ids]} for this pet's ancestors, up to
+        depth generations back, in a single query"""
+        return walk_pedigree(object_session(self), self.id, depth, ancestors=True)
+
+    def descendants(self, depth=None):
+        """return {parent id: [child ids]} for this pet's descendants, up to
+        depth generations down, in a single query"""
+        return walk_pedigree(object_session(self), self.id, depth, ancestors=False)
+
     def __repr__(self):
         return "Pet:{}".format(self.name) 
- 
+
+
+def pedigree_edges():
+    """
+    one (child_id, parent_id) row per parentage link, from the pet's own
+    left/right parent columns and from the pet_to_pet table, where the left
+    pet is the parent and the right pet the child
+    """
+    pet = Pet.__table__
+    return union_all(
+        select(pet.c.id.label('child_id'), pet.c.left_pet_id.label('parent_id'))
+            .where(pet.c.left_pet_id.isnot(None)),
+        select(pet.c.id, pet.c.right_pet_id).where(pet.c.right_pet_id.isnot(None)),
+        select(pet_to_pet.c.right_pet_id, pet_to_pet.c.left_pet_id),
+    )
+
+
+def _pedigree_steps(walk, ancestors):
+    """
+    (near_id, far_id) selects for the links one generation on from the
+    pets in walk.far_id, one per kind of link, each joining pet or
+    pet_to_pet to the walk directly so the parent and child indexes are used
+    """
+    pet = Pet.__table__
+    if ancestors:
+        return [
+            select(pet.c.id, pet.c.left_pet_id)
+                .where(pet.c.id == walk.c.far_id).where(pet.c.left_pet_id.isnot(None)),
+            select(pet.c.id, pet.c.right_pet_id)
+                .where(pet.c.id == walk.c.far_id).where(pet.c.right_pet_id.isnot(None)),
+            select(pet_to_pet.c.right_pet_id, pet_to_pet.c.left_pet_id)
+                .where(pet_to_pet.c.right_pet_id == walk.c.far_id),
+        ]
+    return [
+        select(pet.c.left_pet_id, pet.c.id).where(pet.c.left_pet_id == walk.c.far_id),
+        select(pet.c.right_pet_id, pet.c.id).where(pet.c.right_pet_id == walk.c.far_id),
+        select(pet_to_pet.c.left_pet_id, pet_to_pet.c.right_pet_id)
+            .where(pet_to_pet.c.left_pet_id == walk.c.far_id),
+    ]
+
+
+def walk_pedigree(session, pet_id, depth=None, ancestors=True):
+    """
+    walk the pedigree up (ancestors) or down from pet_id with one WITH
+    RECURSIVE query, returning the links found as an adjacency dict of
+    {pet id: [parent ids]} going up or {pet id: [child ids]} going down
+    """
+    # the walk starts from a (NULL, pet_id) row that is left out at the end
+    columns = [cast(null(), Integer).label('near_id'), literal(pet_id, Integer).label('far_id')]
+    if depth is not None:
+        columns.append(literal_column('0').label('depth'))
+    walk = select(*columns).cte('walk', recursive=True)
+
+    if session.get_bind().dialect.name == 'sqlite':
+        # one recursive select per kind of link; a join to the union of all
+        # links would have SQLite materialize every link on every walk
+        steps = _pedigree_steps(walk, ancestors)
+    else:
+        # Postgres takes a single recursive select, and pushes the join
+        # down into each branch of the union itself
+        edges = pedigree_edges().subquery('edges')
+        near, far = (edges.c.child_id, edges.c.parent_id) if ancestors \
+            else (edges.c.parent_id, edges.c.child_id)
+        steps = [select(near, far).where(near == walk.c.far_id)]
+
+    # without a depth limit UNION dedupes on the link alone, which also
+    # stops the walk on a cycle
+    if depth is not None:
+        steps = [step.add_columns(walk.c.depth + 1).where(walk.c.depth < depth) for step in steps]
+    walk = walk.union(*steps)
+
+    links = {}
+    rows = session.execute(select(walk.c.near_id, walk.c.far_id).distinct()
+                           .where(walk.c.near_id.isnot(None))
+                           .order_by(walk.c.near_id, walk.c.far_id))
+    for near_id, far_id in rows:
+        links.setdefault(near_id, []).append(far_id)
+    return links
+
+ 
+def format_phone(value):
+    """
+    a phone number as 555-555-5555; hyphens and spaces are ignored, anything
+    but 10 ASCII digits raises ValueError.  contacts.py does the same for
+    whole columns at once
+    """
+    # remove any hyphens and spaces
+    number = value.replace('-', '').replace(' ', '')
+    # check length and digits, raise exception if bad
+    if len(number) != 10 or not (number.isdigit() and number.isascii()):
+        raise ValueError("Phone number not 10 digits long: {!r}".format(value))
+    return "%s-%s-%s" % (number[0:3], number[3:6], number[6:10])
+
+
 class Person(Base):
     __tablename__ = 'person'
     id = Column(Integer, primary_key=True)
@@ -169,31 +290,26 @@ class Person(Base):
     last_name = Column(String, nullable=False)
     age = Column(Integer)
     _phone = Column(String)
+    __table_args__ = (
+            # keyset pagination in name order, see pagination.py
+            Index('ix_person_name', last_name, first_name, id),
+        )
 
  
     @property
     def phone(self):
         """return phone number formatted with hyphens"""
-        # get the phone number from the database, mapped to private self._phone
-        num = self._phone
-        # return a formatted version using hyphens
-        return "%s-%s-%s" % (num[0:3], num[3:6], num[6:10])
- 
-    # phone number writing property, writing to public Person.phone calls this 
-    @phone.setter 
+        # the database holds the formatted number, mapped to private self._phone,
+        # so reading it costs nothing
+        return self._phone
+
+    # phone number writing property, writing to public Person.phone calls this
+    @phone.setter
     def phone(self, value):
-        """store only numeric digits, raise exception on wrong number length"""
-        # remove any hyphens
-        number = value.replace('-', '')
-        # remove any spaces
-        number = number.replace(' ', '')
-        # check length, raise exception if bad
-        if len(number) != 10:
-            raise Exception("Phone number not 10 digits long")
-        else:
-            # write the value to the property that automatically goes to DB
-            self._phone = number
- 
+        """store the number formatted with hyphens, raise ValueError on bad numbers"""
+        # write the value to the property that automatically goes to DB
+        self._phone = format_phone(value)
+
     def __repr__(self):
         return "Person: {} {}".format(self.first_name, self.last_name) 
  
@@ -213,8 +329,9 @@ def init_db(engine):
 if __name__ == "__main__":
     log.info("main executing:")              
  
-    # create an engine
-    engine = create_engine('sqlite:///:memory:')
+    # create an engine, the connection string comes from the command line
+    # or the PETS_DATABASE_URL environment variable, see db.py
+    engine = db.make_engine()
     log.info("created engine: {}".format(engine) )
  
     # if we asked to init the db from the command line, do so
@@ -351,16 +468,20 @@ if __name__ == "__main__":
     sue.pet_associations.append( PetPersonAssociation( pet_id=goldie.id, person_id=sue.id, nickname="happy"))
 
 
-    print "The nicknames for spot are: {}".format(spot.nicknames())
-    print "The nicknames for goldie are: {}".format(goldie.nicknames())
+    print("The nicknames for spot are: {}".format(spot.nicknames()))
+    print("The nicknames for goldie are: {}".format(goldie.nicknames()))
 
-    # log.info("Checking if delete species cascade works")
-    # assert golden.species_id
-    # assert dog.id
-    # db_session.delete(dog)
-    # db_session.commit()
-    # assert db_session.query(Species).get(dog.id) == None
-    # assert db_session.query(Breed).get(golden.id) == None 
+    log.info("Checking if delete species cascade works")
+    assert golden.species_id
+    assert dog.id
+    # the database deletes the breeds, so the golden in our session is stale
+    # afterwards, keep the ids to check against
+    dog_id, golden_id = dog.id, golden.id
+    db_session.delete(dog)
+    db_session.commit()
+    assert db_session.query(Species).get(dog_id) == None
+    assert db_session.query(Breed).get(golden_id) == None 
+    assert db_session.query(Pet).get(goldie.id).breed_id == None
 
 
     log.info("Checking if delete a pet deletes nicknames works")
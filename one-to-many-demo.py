@@ -1,4 +1,3 @@
-from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, String, Boolean
 from sqlalchemy import ForeignKey
@@ -8,6 +7,8 @@ from sqlalchemy.orm import sessionmaker
  
 import pdb   
 import logging
+
+import db
 log = logging.getLogger(__name__)
  
 ################################################################################
@@ -110,9 +111,9 @@ def init_db(engine):
 if __name__ == "__main__":
     log.info("main executing:")              
  
-    # create an engine
-    # TODO: allow passing in a db connection string from a command line arg
-    engine = create_engine('sqlite:///:memory:')
+    # create an engine, the connection string comes from the command line
+    # or the PETS_DATABASE_URL environment variable, see db.py
+    engine = db.make_engine()
     log.info("created engine: {}".format(engine) )
  
     # if we asked to init the db from the command line, do so
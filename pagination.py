@@ -0,0 +1,235 @@
+"""
+keyset pagination for pets, shelters and people
+
+query.offset(n) makes the database walk past n rows to find a page, so page
+10,000 costs 10,000 pages of work.  Keyset pagination remembers the sort
+key of the last row instead and asks for the rows after it,
+
+    WHERE (shelter_id, id) > (:last_shelter_id, :last_id)
+    ORDER BY shelter_id, id LIMIT 50
+
+which an index on the same columns answers at the same cost on any page:
+
+    page = paginate(db_session, model.Pet, 'shelter', adopted=False)
+    while page.next:
+        page = paginate(db_session, model.Pet, 'shelter', after=page.next, adopted=False)
+
+Every ordering ends with the primary key, so keys are unique and no row is
+skipped or repeated.  Rows whose key columns are NULL (pets with no shelter,
+say) are left out of orderings on those columns.
+
+The continuation token is opaque: urlsafe base64 of the key and a digest
+of the ordering and filters, so a token only continues the listing it came
+from.
+
+run as a script to compare page latency against offset():
+
+    python pagination.py [url] [number of pets] [page size]
+"""
+import base64
+import collections
+import hashlib
+import importlib
+import json
+import timeit
+
+from sqlalchemy import select, tuple_
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+DEFAULT_PAGE_SIZE = 50
+
+Page = collections.namedtuple('Page', 'items next')
+
+# entity -> ordering name -> key columns, each backed by an index that
+# starts with the same columns
+ORDERINGS = {
+    model.Pet: {
+        'id': lambda: (model.Pet.id,),
+        'shelter': lambda: (model.Pet.shelter_id, model.Pet.id),    # ix_pet_shelter_id
+        'breed': lambda: (model.Pet.breed_id, model.Pet.id),        # ix_pet_breed_id
+    },
+    model.Shelter: {
+        'id': lambda: (model.Shelter.id,),
+    },
+    model.Person: {
+        'id': lambda: (model.Person.id,),
+        'name': lambda: (model.Person.last_name, model.Person.first_name,
+                         model.Person.id),                          # ix_person_name
+    },
+}
+
+
+################################################################################
+# filters
+
+def pet_filters(adopted=None, breed_id=None, species_id=None, shelter_id=None):
+    "criteria for the pet listing filters that are not None"
+    criteria = []
+    if adopted is not None:
+        criteria.append(model.Pet.adopted.is_(bool(adopted)))
+    if breed_id is not None:
+        criteria.append(model.Pet.breed_id == breed_id)
+    if species_id is not None:
+        criteria.append(model.Pet.breed_id.in_(
+            select(model.Breed.id).where(model.Breed.species_id == species_id)))
+    if shelter_id is not None:
+        criteria.append(model.Pet.shelter_id == shelter_id)
+    return criteria
+
+
+FILTERS = {
+    model.Pet: pet_filters,
+}
+
+
+################################################################################
+# tokens
+
+def _digest(entity, ordering, filters):
+    described = json.dumps([entity.__name__, ordering, sorted(filters.items())])
+    return hashlib.sha1(described.encode('utf-8')).hexdigest()[:12]
+
+
+def encode_token(entity, ordering, filters, key):
+    "the continuation token after the row whose sort key is key"
+    payload = json.dumps({'k': list(key), 'd': _digest(entity, ordering, filters)})
+    return base64.urlsafe_b64encode(payload.encode('utf-8')).decode('ascii')
+
+
+def decode_token(entity, ordering, filters, token):
+    "the sort key a token continues after; ValueError if it is from another listing"
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+        key, digest = payload['k'], payload['d']
+    except (ValueError, TypeError, KeyError):
+        raise ValueError("not a continuation token: {!r}".format(token))
+    if digest != _digest(entity, ordering, filters):
+        raise ValueError("token belongs to a different ordering or filter")
+    return key
+
+
+################################################################################
+# paging
+
+def keyset_query(session, entity, ordering='id', after=None, size=DEFAULT_PAGE_SIZE, **filters):
+    "the select for one page; after is a decoded key or None for the first page"
+    try:
+        columns = ORDERINGS[entity][ordering]()
+    except KeyError:
+        raise ValueError("no ordering {!r} for {}".format(ordering, entity.__name__))
+    make_filters = FILTERS.get(entity)
+    if filters and make_filters is None:
+        raise ValueError("{} listings take no filters".format(entity.__name__))
+
+    q = select(entity)
+    for criterion in make_filters(**filters) if filters else []:
+        q = q.where(criterion)
+    for column in columns:
+        if column.nullable:
+            q = q.where(column.isnot(None))
+    if after is not None:
+        if len(after) != len(columns):
+            raise ValueError("token does not fit ordering {!r}".format(ordering))
+        q = q.where(tuple_(*columns) > tuple_(*after))
+    return q.order_by(*columns).limit(size)
+
+
+def paginate(session, entity, ordering='id', after=None, size=DEFAULT_PAGE_SIZE, **filters):
+    """
+    one Page of entity in ordering, after the continuation token after; the
+    filters are keyword arguments, see pet_filters() for pets
+    """
+    filters = dict((k, v) for k, v in filters.items() if v is not None)
+    key = decode_token(entity, ordering, filters, after) if after is not None else None
+    q = keyset_query(session, entity, ordering, key, size + 1, **filters)
+    items = session.execute(q).scalars().all()
+
+    next_token = None
+    if len(items) > size:
+        items = items[:size]
+        last = items[-1]
+        key = [getattr(last, column.key) for column in ORDERINGS[entity][ordering]()]
+        next_token = encode_token(entity, ordering, filters, key)
+    return Page(items, next_token)
+
+
+def offset_page(session, entity, ordering='id', page=0, size=DEFAULT_PAGE_SIZE, **filters):
+    "the same page by offset(), for comparison"
+    q = keyset_query(session, entity, ordering, None, size, **filters)
+    return session.execute(q.offset(page * size)).scalars().all()
+
+
+################################################################################
+# benchmark
+
+def benchmark(engine, num_pets, size=DEFAULT_PAGE_SIZE, depths=(1, 100, 1000, 10000), repeat=5):
+    bulk_load = importlib.import_module('bulk_load')
+    model.init_db(engine)
+    bulk_load.load_pets(engine, bulk_load.synthetic_records(num_pets))
+    Session = db.make_session(engine)
+
+    for ordering, filters in (('id', {}), ('shelter', {'adopted': False})):
+        db_session = Session()
+        # walk every page by token, timing the pages at the depths asked for
+        keyset = {}
+        tokens = {}
+        token = None
+        page_number = 0
+        seen = 0
+        while True:
+            start = timeit.default_timer()
+            page = paginate(db_session, model.Pet, ordering, token, size, **filters)
+            elapsed = timeit.default_timer() - start
+            page_number += 1
+            seen += len(page.items)
+            if page_number in depths:
+                keyset[page_number] = elapsed
+                tokens[page_number] = token
+            db_session.expunge_all()
+            if page.next is None:
+                break
+            token = page.next
+        log.info("{} {}: walked {} pages, {} pets".format(ordering, filters, page_number, seen))
+
+        for depth in sorted(keyset):
+            start = timeit.default_timer()
+            for i in range(repeat):
+                by_token = paginate(db_session, model.Pet, ordering, tokens[depth], size, **filters)
+            by_key = (timeit.default_timer() - start) / repeat
+            start = timeit.default_timer()
+            for i in range(repeat):
+                by_offset = offset_page(db_session, model.Pet, ordering, depth - 1, size, **filters)
+            offset = (timeit.default_timer() - start) / repeat
+            assert [p.id for p in by_token.items] == [p.id for p in by_offset]
+            log.info("  page {:>6}: {:8.3f}ms keyset, {:8.3f}ms offset, {:.0f}x".format(
+                depth, by_key * 1000, offset * 1000, offset / by_key))
+        db_session.close()
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    num_pets = int(args[0]) if len(args) > 0 else 1000000
+    size = int(args[1]) if len(args) > 1 else DEFAULT_PAGE_SIZE
+
+    engine = db.make_engine(url)
+    benchmark(engine, num_pets, size)
+    engine.dispose()
+    log.info("all done!")
@@ -0,0 +1,425 @@
+"""
+parallel seeding across a process pool
+
+The parent creates the schema and the species, breed and shelter rows, then
+splits the pets, people and nicknames into one partition per worker.  Each
+partition owns a non-overlapping primary key range, so workers never need
+to ask the database for ids and never collide.  Every worker opens its own
+engine and session and commits every commit_size rows.
+
+Where the rows go depends on the database:
+
+  - Postgres and other servers: workers insert straight into the target and
+    the id sequences are moved past the new rows at the end
+  - a SQLite file: one writer at a time is all SQLite allows, so each worker
+    writes its partition to a shard file of its own and the parent merges
+    the shards with ATTACH and INSERT ... SELECT in one transaction
+
+The pets are synthetic unless records are given: pet records as
+bulk_load.read_records() yields them.  The parent then resolves their
+species, breeds and shelters once and hands each worker its slice of pet
+rows; load_file() does this for a CSV or JSONL file.
+
+run as a script to measure throughput as the number of workers grows:
+
+    python parallel_seed.py [url] [number of pets] [workers]
+"""
+import collections
+import importlib
+import json
+import multiprocessing
+import os
+import random
+import tempfile
+import timeit
+
+from sqlalchemy import func, select
+from sqlalchemy.engine import make_url
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+DEFAULT_COMMIT_SIZE = 10000
+
+FIRST_NAMES = ['Tom', 'Sue', 'Ann', 'Bob', 'Eve', 'Joe', 'Kim', 'Lee', 'Max', 'Pat']
+LAST_NAMES = ['Smith', 'Johnson', 'Lee', 'Brown', 'Garcia', 'Miller', 'Davis', 'Wilson']
+
+# a shard file only holds rows, the target database checks them on merge
+SHARD_PRAGMAS = [
+    ('journal_mode', 'OFF'),
+    ('synchronous', 'OFF'),
+]
+
+# the tables workers write, parents first
+SEEDED_TABLES = [model.Person.__table__, model.Pet.__table__,
+                 model.PetPersonAssociation.__table__]
+
+
+Partition = collections.namedtuple('Partition', [
+    'worker', 'first_pet_id', 'pets', 'first_person_id', 'people', 'first_association_id'])
+
+
+################################################################################
+# partitioning
+
+def partition(num_pets, num_people, workers, per_pet=2, start_ids=(1, 1, 1)):
+    """
+    split num_pets and num_people into one Partition per worker
+
+    pet, person and association ids are contiguous ranges starting at
+    start_ids, so partitions never overlap each other or existing rows
+    """
+    first_pet, first_person, first_assoc = start_ids
+    parts = []
+    for worker in range(workers):
+        pets = num_pets // workers + (1 if worker < num_pets % workers else 0)
+        people = num_people // workers + (1 if worker < num_people % workers else 0)
+        parts.append(Partition(worker, first_pet, pets, first_person, people, first_assoc))
+        first_pet += pets
+        first_person += people
+        first_assoc += pets * per_pet
+    return parts
+
+
+def next_ids(conn):
+    "the first free (pet, person, association) ids"
+    return tuple((conn.execute(select(func.max(table.c.id))).scalar() or 0) + 1
+                 for table in (model.Pet.__table__, model.Person.__table__,
+                               model.PetPersonAssociation.__table__))
+
+
+def seed_reference(engine, shelters=50):
+    """
+    insert the species, breeds and shelters the synthetic pets draw from,
+    returns (breed ids, shelter ids)
+    """
+    bulk_load = importlib.import_module('bulk_load')
+    records = [{'species': species, 'breed': breed, 'shelter': 'Shelter {}'.format(i),
+                'website': 'http://shelter{}.example.com'.format(i)}
+               for species, breeds in sorted(bulk_load.SPECIES_BREEDS.items())
+               for breed in breeds
+               for i in range(shelters)]
+    lookups = bulk_load.LookupMaps()
+    with engine.begin() as conn:
+        lookups.preload(conn)
+        lookups.resolve(conn, records)
+    return (sorted(lookups.breeds.values()),
+            sorted(lookups.shelters[r['shelter']] for r in records[:shelters]))
+
+
+################################################################################
+# generating rows
+
+def person_rows(part, rng):
+    for person_id in range(part.first_person_id, part.first_person_id + part.people):
+        yield {'id': person_id,
+               'first_name': rng.choice(FIRST_NAMES),
+               'last_name': rng.choice(LAST_NAMES),
+               'age': rng.randrange(18, 90),
+               '_phone': '555-{:03d}-{:04d}'.format(*divmod(person_id % 10000000, 10000))}
+
+
+def resolve_records(engine, records, chunk_size=DEFAULT_COMMIT_SIZE):
+    "pet rows, without ids, for imported records; their reference rows are added as needed"
+    bulk_load = importlib.import_module('bulk_load')
+    lookups = bulk_load.LookupMaps()
+    rows = []
+    with engine.begin() as conn:
+        lookups.preload(conn)
+        for chunk in bulk_load.chunked(records, chunk_size):
+            lookups.resolve(conn, chunk)
+            rows.extend(lookups.pet_row(r) for r in chunk)
+    return rows
+
+
+def imported_pet_rows(part, rows):
+    "the partition's slice of resolved pet rows, numbered from its first pet id"
+    for i, row in enumerate(rows):
+        row = dict(row, id=part.first_pet_id + i)
+        row.update(left_pet_id=None, right_pet_id=None)
+        yield row
+
+
+def pet_rows(part, rng, breed_ids, shelter_ids):
+    for pet_id in range(part.first_pet_id, part.first_pet_id + part.pets):
+        yield {'id': pet_id,
+               'name': 'Pet {}'.format(pet_id),
+               'age': rng.randrange(20),
+               'adopted': rng.random() < 0.3,
+               'breed_id': rng.choice(breed_ids),
+               'shelter_id': rng.choice(shelter_ids),
+               'left_pet_id': None,
+               'right_pet_id': None}
+
+
+def association_rows(part, pets, rng, per_pet):
+    """
+    per_pet nicknames for each pet in pets, given by people of the same
+    partition so a worker's rows only ever reference its own rows; a pet
+    gets each person at most once
+    """
+    for pet in pets:
+        offset = (pet['id'] - part.first_pet_id) * per_pet
+        people = rng.sample(range(part.people), min(per_pet, part.people))
+        for n, person in enumerate(people):
+            yield {'id': part.first_association_id + offset + n,
+                   'pet_id': pet['id'],
+                   'person_id': part.first_person_id + person,
+                   'nickname': 'nick{}-{}'.format(pet['id'], n)}
+
+
+################################################################################
+# workers
+
+def seed_partition(url, part, breed_ids, shelter_ids, commit_size=DEFAULT_COMMIT_SIZE,
+                   per_pet=2, seed=0, shard=False, pets=None):
+    """
+    write one partition through a session of its own, committing every
+    commit_size pets; returns (part, seconds)
+
+    with shard on, url is a fresh SQLite file that gets the tables first.
+    pets, resolved pet rows from resolve_records(), replace the synthetic ones
+    """
+    bulk_load = importlib.import_module('bulk_load')
+    start = timeit.default_timer()
+    if shard:
+        engine = db.make_engine(url, sqlite_pragmas=SHARD_PRAGMAS)
+        model.Base.metadata.create_all(engine, tables=SEEDED_TABLES)
+    else:
+        engine = db.make_engine(url)
+    db_session = db.make_session(engine)()
+    rng = random.Random(seed * 7919 + part.worker)
+
+    person = model.Person.__table__
+    pet = model.Pet.__table__
+    assoc = model.PetPersonAssociation.__table__
+    if part.people:
+        for chunk in bulk_load.chunked(person_rows(part, rng), commit_size):
+            db_session.execute(person.insert(), chunk)
+            db_session.commit()
+    if pets is None:
+        pets = pet_rows(part, rng, breed_ids, shelter_ids)
+    else:
+        pets = imported_pet_rows(part, pets)
+    for chunk in bulk_load.chunked(pets, commit_size):
+        db_session.execute(pet.insert(), chunk)
+        if part.people and per_pet:
+            db_session.execute(assoc.insert(), list(association_rows(part, chunk, rng, per_pet)))
+        db_session.commit()
+
+    db_session.close()
+    engine.dispose()
+    return part, timeit.default_timer() - start
+
+
+def _seed_partition(args):
+    return seed_partition(*args)
+
+
+################################################################################
+# merging
+
+def merge_shards(engine, paths):
+    """
+    copy the rows of every shard file into the SQLite database behind engine,
+    parents before children, in one transaction
+    """
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        for i, path in enumerate(paths):
+            cursor.execute("ATTACH DATABASE ? AS shard{}".format(i), (path,))
+        for table in SEEDED_TABLES:
+            columns = ', '.join('"{}"'.format(c.name) for c in table.c)
+            for i in range(len(paths)):
+                cursor.execute('INSERT INTO main."{0}" ({1}) SELECT {1} FROM shard{2}."{0}"'
+                               .format(table.name, columns, i))
+        raw.commit()
+        for i in range(len(paths)):
+            cursor.execute("DETACH DATABASE shard{}".format(i))
+        cursor.close()
+    finally:
+        raw.close()
+
+
+def reset_sequences(engine):
+    "move Postgres id sequences past rows inserted with explicit ids"
+    if engine.dialect.name != 'postgresql':
+        return
+    with engine.begin() as conn:
+        for table in SEEDED_TABLES:
+            conn.exec_driver_sql(
+                "SELECT setval(pg_get_serial_sequence('\"{0}\"', 'id'), "
+                "coalesce((SELECT max(id) FROM \"{0}\"), 0) + 1, false)".format(table.name))
+
+
+################################################################################
+# seeding
+
+def parallel_seed(url, num_pets, num_people=None, workers=None, commit_size=DEFAULT_COMMIT_SIZE,
+                  per_pet=2, seed=0, shelters=50, records=None):
+    """
+    add num_pets pets, num_people people and per_pet nicknames per pet to the
+    database at url using workers processes; the schema must already exist.
+    With records, the pets are those records and num_pets is ignored.
+    returns the partitions written
+    """
+    if db.is_sqlite_memory(url):
+        raise ValueError("worker processes cannot share an in-memory database, use a file")
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    engine = db.make_engine(url)
+    rows = None
+    if records is None:
+        breed_ids, shelter_ids = seed_reference(engine, shelters)
+    else:
+        breed_ids = shelter_ids = None
+        rows = resolve_records(engine, records, commit_size)
+        num_pets = len(rows)
+    if num_people is None:
+        num_people = max(workers, num_pets // 10)
+    sharded = make_url(url).get_backend_name() == 'sqlite'
+
+    with engine.connect() as conn:
+        parts = partition(num_pets, num_people, workers, per_pet, next_ids(conn))
+
+    shard_dir = tempfile.mkdtemp(prefix='pets-shards-') if sharded else None
+    jobs = []
+    for part in parts:
+        target = url
+        if sharded:
+            target = 'sqlite:///{}'.format(os.path.join(shard_dir, 'shard{}.db'.format(part.worker)))
+        pets = None
+        if rows is not None:
+            first = part.first_pet_id - parts[0].first_pet_id
+            pets = rows[first:first + part.pets]
+        jobs.append((target, part, breed_ids, shelter_ids, commit_size, per_pet, seed, sharded,
+                     pets))
+
+    try:
+        if workers == 1:
+            timings = [_seed_partition(job) for job in jobs]
+        else:
+            pool = multiprocessing.Pool(workers)
+            try:
+                timings = pool.map(_seed_partition, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        for part, elapsed in timings:
+            log.debug("  - worker {}: {} pets, {} people in {:.2f}s".format(
+                part.worker, part.pets, part.people, elapsed))
+
+        if sharded:
+            start = timeit.default_timer()
+            merge_shards(engine, [make_url(job[0]).database for job in jobs])
+            log.debug("  - merged {} shards in {:.2f}s".format(
+                len(jobs), timeit.default_timer() - start))
+        reset_sequences(engine)
+    finally:
+        if shard_dir:
+            for name in os.listdir(shard_dir):
+                os.remove(os.path.join(shard_dir, name))
+            os.rmdir(shard_dir)
+        engine.dispose()
+    return parts
+
+
+def load_file(url, path, workers=None, **kwargs):
+    "parallel_seed() with the pets of a CSV or JSONL file"
+    bulk_load = importlib.import_module('bulk_load')
+    log.info("load_file() {}".format(path))
+    return parallel_seed(url, None, workers=workers, records=bulk_load.read_records(path),
+                         **kwargs)
+
+
+################################################################################
+# benchmark
+
+def benchmark(url, num_pets, max_workers=None, commit_size=DEFAULT_COMMIT_SIZE):
+    "seed num_pets pets into a fresh database with 1, 2, 4 ... max_workers workers"
+    if max_workers is None:
+        max_workers = multiprocessing.cpu_count()
+    counts = []
+    n = 1
+    while n < max_workers:
+        counts.append(n)
+        n *= 2
+    counts.append(max_workers)
+
+    results = {}
+    for workers in counts:
+        engine = db.make_engine(url)
+        model.init_db(engine)
+        engine.dispose()
+
+        start = timeit.default_timer()
+        parts = parallel_seed(url, num_pets, workers=workers, commit_size=commit_size)
+        elapsed = timeit.default_timer() - start
+
+        engine = db.make_engine(url)
+        with engine.connect() as conn:
+            assert next_ids(conn) == (num_pets + 1, sum(p.people for p in parts) + 1,
+                                      num_pets * 2 + 1)
+        engine.dispose()
+        results[workers] = elapsed
+        log.info("{:>3} workers: {} pets in {:.2f}s, {:,.0f} pets/sec, {:.1f}x".format(
+            workers, num_pets, elapsed, num_pets / elapsed, results[1] / elapsed))
+
+    # imported pets instead of synthetic ones
+    bulk_load = importlib.import_module('bulk_load')
+    fd, path = tempfile.mkstemp(suffix='.jsonl')
+    with os.fdopen(fd, 'w') as f:
+        for record in bulk_load.synthetic_records(1000, seed=1):
+            f.write(json.dumps(record) + '\n')
+    try:
+        engine = db.make_engine(url)
+        model.init_db(engine)
+        load_file(url, path, workers=min(2, max_workers))
+        pet = model.Pet.__table__
+        with engine.connect() as conn:
+            assert conn.execute(select(func.count()).select_from(pet)).scalar() == 1000
+            assert conn.execute(select(func.count()).select_from(pet)
+                                .where(pet.c.breed_id.is_(None))).scalar() == 0
+        engine.dispose()
+    finally:
+        os.remove(path)
+    log.info("load_file(): 1000 imported pets, every one with its breed")
+    return results
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    num_pets = int(args[0]) if len(args) > 0 else 1000000
+    workers = int(args[1]) if len(args) > 1 else None
+
+    path = None
+    if db.is_sqlite_memory(url):
+        # the worker processes need to see the same database
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        url = 'sqlite:///{}'.format(path)
+    try:
+        benchmark(url, num_pets, workers)
+    finally:
+        if path:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+    log.info("all done!")
@@ -0,0 +1,288 @@
+"""
+pedigree closure table
+
+Pet.ancestors() and Pet.descendants() walk the pedigree with one WITH
+RECURSIVE query each time.  pet_closure stores every (ancestor, descendant)
+pair with its shortest distance instead, so "is X an ancestor of Y" is a
+single primary key lookup.  It lives on its own MetaData like pet_search,
+so only databases that call init_closure() get it.
+
+add_link() keeps the table current as parents are recorded; removing a
+link can disconnect any number of pairs, so call rebuild_closure() after
+removals.
+
+run as a script to benchmark on a synthetic breeding graph:
+
+    python pedigree.py [url] [generations] [pets per generation]
+"""
+import importlib
+import random
+import timeit
+
+from sqlalchemy import Column, Integer, MetaData, Table
+from sqlalchemy import and_, bindparam, exists, func, literal_column
+from sqlalchemy import select
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+
+################################################################################
+# pet_closure table
+
+metadata = MetaData()
+
+pet_closure = Table('pet_closure', metadata,
+    Column('ancestor_id', Integer, primary_key=True),
+    Column('descendant_id', Integer, primary_key=True, index=True),
+    Column('depth', Integer, nullable=False),
+)
+
+
+def init_closure(engine):
+    "drop, create and fill the pet_closure table"
+    log.info("init_closure() engine: {}".format(engine))
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        rebuild_closure(conn)
+
+
+def rebuild_closure(conn):
+    """
+    recompute every pair, one generation of distance per INSERT ... SELECT
+
+    each round only adds pairs that are not there yet, so every pair keeps
+    its shortest distance and inbred lines do not multiply rows
+    """
+    edges = model.pedigree_edges().subquery('edges')
+    conn.execute(pet_closure.delete())
+    conn.execute(pet_closure.insert().from_select(
+        ['ancestor_id', 'descendant_id', 'depth'],
+        select(edges.c.parent_id, edges.c.child_id, literal_column('1'))
+        .distinct()))
+
+    depth = 1
+    while True:
+        known = pet_closure.alias('known')
+        step = (select(pet_closure.c.ancestor_id, edges.c.child_id,
+                       literal_column(str(depth + 1)))
+                .distinct()
+                .select_from(pet_closure.join(
+                    edges, edges.c.parent_id == pet_closure.c.descendant_id))
+                .where(pet_closure.c.depth == depth)
+                .where(~exists().where(and_(
+                    known.c.ancestor_id == pet_closure.c.ancestor_id,
+                    known.c.descendant_id == edges.c.child_id))))
+        added = conn.execute(pet_closure.insert().from_select(
+            ['ancestor_id', 'descendant_id', 'depth'], step)).rowcount
+        if not added:
+            break
+        depth += 1
+    log.info("  - pet_closure rebuilt, {} generations deep".format(depth))
+
+
+def add_link(conn, parent_id, child_id):
+    """
+    record that parent_id is a parent of child_id: every ancestor of the
+    parent (and the parent) becomes an ancestor of every descendant of the
+    child (and the child), keeping the shorter distance for known pairs
+    """
+    ancestors = [(parent_id, 0)] + [tuple(row) for row in conn.execute(
+        select(pet_closure.c.ancestor_id, pet_closure.c.depth)
+        .where(pet_closure.c.descendant_id == parent_id))]
+    descendants = [(child_id, 0)] + [tuple(row) for row in conn.execute(
+        select(pet_closure.c.descendant_id, pet_closure.c.depth)
+        .where(pet_closure.c.ancestor_id == child_id))]
+
+    pairs = {}
+    for ancestor_id, up in ancestors:
+        for descendant_id, down in descendants:
+            pairs[(ancestor_id, descendant_id)] = up + 1 + down
+
+    existing = {}
+    descendant_ids = [d for d, down in descendants]
+    for ancestor_id, up in ancestors:
+        for row in conn.execute(
+                select(pet_closure.c.descendant_id, pet_closure.c.depth)
+                .where(pet_closure.c.ancestor_id == ancestor_id)
+                .where(pet_closure.c.descendant_id.in_(descendant_ids))):
+            existing[(ancestor_id, row.descendant_id)] = row.depth
+
+    inserts = [{'ancestor_id': a, 'descendant_id': d, 'depth': depth}
+               for (a, d), depth in pairs.items() if (a, d) not in existing]
+    updates = [{'a': a, 'd': d, 'depth': depth}
+               for (a, d), depth in pairs.items()
+               if (a, d) in existing and depth < existing[(a, d)]]
+    if inserts:
+        conn.execute(pet_closure.insert(), inserts)
+    if updates:
+        conn.execute(pet_closure.update()
+                     .where(pet_closure.c.ancestor_id == bindparam('a'))
+                     .where(pet_closure.c.descendant_id == bindparam('d')),
+                     updates)
+
+
+def is_ancestor(conn, ancestor_id, descendant_id):
+    "True if ancestor_id is somewhere in descendant_id's pedigree"
+    return conn.execute(
+        select(pet_closure.c.depth)
+        .where(pet_closure.c.ancestor_id == ancestor_id)
+        .where(pet_closure.c.descendant_id == descendant_id)).first() is not None
+
+
+def generations_apart(conn, ancestor_id, descendant_id):
+    "shortest number of generations between the two pets, or None"
+    return conn.execute(
+        select(pet_closure.c.depth)
+        .where(pet_closure.c.ancestor_id == ancestor_id)
+        .where(pet_closure.c.descendant_id == descendant_id)).scalar()
+
+
+def ancestor_ids(conn, pet_id, depth=None):
+    "every ancestor of pet_id within depth generations"
+    q = select(pet_closure.c.ancestor_id).where(pet_closure.c.descendant_id == pet_id)
+    if depth is not None:
+        q = q.where(pet_closure.c.depth <= depth)
+    return set(conn.execute(q).scalars())
+
+
+################################################################################
+# benchmark
+
+def breeding_graph(engine, generations=20, width=200, seed=0):
+    """
+    insert generations of width pets each, every pet after the first
+    generation gets two random parents from the generation before.
+    returns the pet ids per generation
+    """
+    rng = random.Random(seed)
+    pet = model.Pet.__table__
+    ids = []
+    with engine.begin() as conn:
+        next_id = (conn.execute(select(func.max(pet.c.id))).scalar() or 0) + 1
+        for g in range(generations):
+            rows = []
+            for i in range(width):
+                row = {'id': next_id, 'name': 'Gen{}Pet{}'.format(g, i), 'age': generations - g,
+                       'adopted': False, 'left_pet_id': None, 'right_pet_id': None}
+                if ids:
+                    dad, mom = rng.sample(ids[-1], 2)
+                    row['left_pet_id'] = dad
+                    row['right_pet_id'] = mom
+                rows.append(row)
+                next_id += 1
+            conn.execute(pet.insert(), rows)
+            ids.append([row['id'] for row in rows])
+    return ids
+
+
+def walk_one_load_per_pet(session, pet_id, depth):
+    "the lazy way: load every parent by primary key, a generation at a time"
+    links = {}
+    frontier = [pet_id]
+    for generation in range(depth):
+        parents = []
+        for child_id in frontier:
+            child = session.query(model.Pet).get(child_id)
+            found = [p for p in (child.left_pet_id, child.right_pet_id) if p is not None]
+            if found and child_id not in links:
+                links[child_id] = sorted(found)
+                parents.extend(found)
+        frontier = sorted(set(parents))
+        if not frontier:
+            break
+    return links
+
+
+def benchmark(engine, generations=20, width=50, samples=20):
+    model.init_db(engine)
+    ids = breeding_graph(engine, generations, width)
+    rng = random.Random(1)
+    youngest = rng.sample(ids[-1], samples)
+    oldest = rng.sample(ids[0], samples)
+    Session = db.make_session(engine)
+
+    db_session = Session()
+    start = timeit.default_timer()
+    for pet_id in youngest:
+        links = db_session.query(model.Pet).get(pet_id).ancestors(generations)
+    cte = (timeit.default_timer() - start) / samples
+    log.info("ancestors() through WITH RECURSIVE: {:.2f}ms, {} links".format(
+        cte * 1000, sum(len(v) for v in links.values())))
+    assert links == walk_one_load_per_pet(Session(), youngest[-1], generations)
+
+    start = timeit.default_timer()
+    for pet_id in oldest:
+        db_session.query(model.Pet).get(pet_id).descendants(generations)
+    log.info("descendants() through WITH RECURSIVE: {:.2f}ms".format(
+        (timeit.default_timer() - start) / samples * 1000))
+    db_session.close()
+
+    start = timeit.default_timer()
+    for pet_id in youngest:
+        walk_one_load_per_pet(Session(), pet_id, generations)
+    log.info("ancestors one load per pet: {:.2f}ms".format(
+        (timeit.default_timer() - start) / samples * 1000))
+
+    start = timeit.default_timer()
+    init_closure(engine)
+    log.info("closure rebuilt in {:.2f}s".format(timeit.default_timer() - start))
+
+    pairs = [(rng.choice(rng.choice(ids[:-1])), rng.choice(ids[-1])) for i in range(1000)]
+    with engine.connect() as conn:
+        start = timeit.default_timer()
+        hits = sum(is_ancestor(conn, a, d) for a, d in pairs)
+        closure = (timeit.default_timer() - start) / len(pairs)
+
+    db_session = Session()
+    start = timeit.default_timer()
+    for a, d in pairs[:samples]:
+        links = model.walk_pedigree(db_session, d)
+        assert (a in set(p for parents in links.values() for p in parents)) == \
+            is_ancestor(db_session.connection(), a, d)
+    recursive = (timeit.default_timer() - start) / samples
+    db_session.close()
+    log.info("is X an ancestor of Y: {:.3f}ms closure lookup, {:.2f}ms recursive walk "
+             "({} of {} pairs related)".format(closure * 1000, recursive * 1000,
+                                               hits, len(pairs)))
+
+    # add_link() agrees with a full rebuild
+    with engine.begin() as conn:
+        child = ids[-1][0]
+        parent = ids[0][0]
+        conn.execute(model.pet_to_pet.insert(), {'left_pet_id': parent, 'right_pet_id': child})
+        add_link(conn, parent, child)
+        incremental = set(conn.execute(select(pet_closure)))
+        rebuild_closure(conn)
+        assert incremental == set(conn.execute(select(pet_closure)))
+        assert generations_apart(conn, parent, child) == 1
+        conn.execute(model.pet_to_pet.delete())
+    log.info("add_link() matches rebuild_closure()")
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    generations = int(args[0]) if len(args) > 0 else 20
+    width = int(args[1]) if len(args) > 1 else 50
+
+    engine = db.make_engine(url)
+    benchmark(engine, generations, width)
+    engine.dispose()
+    log.info("all done!")
@@ -0,0 +1,383 @@
+"""
+indexed search path for adoptable pets
+
+The pet table indexes themselves are declared on the models in
+many-to-many.py, so init_db() creates them; ensure_indexes() adds them to a
+database that was created before they existed.
+
+pet_search is an optional, denormalized copy of each pet with its breed,
+species and shelter, so "adoptable pets in shelter X of species Y" reads
+one table through one index.  It lives on its own MetaData, so only
+databases that call init_search() get it.  enable_sync() keeps it current
+from ORM flushes; Core writes (bulk_load.py and friends) call refresh() or
+rebuild() themselves.
+
+run as a script to check the query plans and time the hot queries with and
+without the indexes:
+
+    python pet_search.py [url] [number of pets]
+"""
+import importlib
+import random
+import timeit
+
+from sqlalchemy import Boolean, Column, Integer, MetaData, String, Table
+from sqlalchemy import Index
+from sqlalchemy import event
+from sqlalchemy import func, select
+from sqlalchemy import text
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+# ids per IN (...) list, well under SQLite's bound parameter limit
+ID_CHUNK_SIZE = 500
+
+# the size the hot queries are tuned for; from here up the benchmark
+# asserts that each of them uses its index
+TARGET_PETS = 1000000
+
+
+################################################################################
+# indexes
+
+def ensure_indexes(engine):
+    "create any model index missing from an existing database"
+    for table in model.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    log.info("  - indexes checked")
+
+
+################################################################################
+# pet_search table
+
+metadata = MetaData()
+
+pet_search = Table('pet_search', metadata,
+    Column('pet_id', Integer, primary_key=True),
+    Column('name', String, nullable=False),
+    Column('age', Integer),
+    Column('adopted', Boolean),
+    Column('shelter_id', Integer),
+    Column('shelter_name', String),
+    Column('breed_id', Integer),
+    Column('breed_name', String),
+    Column('species_id', Integer),
+    Column('species_name', String),
+)
+
+Index('ix_pet_search_adoptable', pet_search.c.shelter_id, pet_search.c.species_id,
+      sqlite_where=pet_search.c.adopted.is_(False),
+      postgresql_where=pet_search.c.adopted.is_(False))
+Index('ix_pet_search_species', pet_search.c.species_id, pet_search.c.breed_id)
+
+
+def source():
+    "the select pet_search is materialized from, one row per pet"
+    pet = model.Pet.__table__
+    breed = model.Breed.__table__
+    species = model.Species.__table__
+    shelter = model.Shelter.__table__
+    return (select(pet.c.id, pet.c.name, pet.c.age, pet.c.adopted,
+                   pet.c.shelter_id, shelter.c.name,
+                   pet.c.breed_id, breed.c.name,
+                   breed.c.species_id, species.c.name)
+            .select_from(pet
+                         .outerjoin(breed, pet.c.breed_id == breed.c.id)
+                         .outerjoin(species, breed.c.species_id == species.c.id)
+                         .outerjoin(shelter, pet.c.shelter_id == shelter.c.id)))
+
+
+def init_search(engine):
+    "drop, create and fill the pet_search table"
+    log.info("init_search() engine: {}".format(engine))
+    metadata.drop_all(engine)
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        rebuild(conn)
+
+
+def rebuild(conn):
+    "re-materialize every pet_search row"
+    conn.execute(pet_search.delete())
+    conn.execute(pet_search.insert().from_select([c.name for c in pet_search.c], source()))
+    log.info("  - pet_search rebuilt")
+
+
+def refresh(conn, condition):
+    """
+    re-materialize the pet_search rows for the pets matching condition,
+    a clause against the pet, breed, species or shelter tables
+    """
+    pet = model.Pet.__table__
+    ids = source().where(condition).with_only_columns(pet.c.id)
+    conn.execute(pet_search.delete().where(pet_search.c.pet_id.in_(ids)))
+    conn.execute(pet_search.insert().from_select(
+        [c.name for c in pet_search.c], source().where(condition)))
+
+
+def refresh_pets(conn, pet_ids):
+    "re-materialize the rows for pet_ids, dropping ids whose pet is gone"
+    pet = model.Pet.__table__
+    pet_ids = sorted(pet_ids)
+    for i in range(0, len(pet_ids), ID_CHUNK_SIZE):
+        chunk = pet_ids[i:i + ID_CHUNK_SIZE]
+        conn.execute(pet_search.delete().where(pet_search.c.pet_id.in_(chunk)))
+        conn.execute(pet_search.insert().from_select(
+            [c.name for c in pet_search.c], source().where(pet.c.id.in_(chunk))))
+
+
+################################################################################
+# keeping pet_search in sync with ORM flushes
+
+def _after_flush(session, flush_context):
+    pet_ids = set()
+    breed_ids = set()
+    species_ids = set()
+    shelter_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, model.Pet):
+            pet_ids.add(obj.id)
+        elif isinstance(obj, model.Breed):
+            breed_ids.add(obj.id)
+        elif isinstance(obj, model.Species):
+            species_ids.add(obj.id)
+        elif isinstance(obj, model.Shelter):
+            shelter_ids.add(obj.id)
+
+    conn = session.connection()
+    pet = model.Pet.__table__
+    breed = model.Breed.__table__
+    if pet_ids:
+        refresh_pets(conn, pet_ids)
+    if breed_ids:
+        refresh(conn, pet.c.breed_id.in_(breed_ids))
+    if species_ids:
+        refresh(conn, breed.c.species_id.in_(species_ids))
+    if shelter_ids:
+        refresh(conn, pet.c.shelter_id.in_(shelter_ids))
+
+
+def enable_sync(target):
+    """
+    keep pet_search current from every flush of target, a Session class,
+    sessionmaker or session; the refresh runs in the flush's transaction
+    """
+    event.listen(target, 'after_flush', _after_flush)
+
+
+def disable_sync(target):
+    event.remove(target, 'after_flush', _after_flush)
+
+
+################################################################################
+# hot queries
+
+def adoptable_pets(shelter_id, species_id):
+    "adoptable pets in a shelter of a species, through the normalized tables"
+    pet = model.Pet.__table__
+    breed = model.Breed.__table__
+    return (select(pet.c.id, pet.c.name)
+            .select_from(pet.join(breed, pet.c.breed_id == breed.c.id))
+            .where(pet.c.shelter_id == shelter_id)
+            .where(pet.c.adopted.is_(False))
+            .where(breed.c.species_id == species_id))
+
+
+def adoptable_pets_search(shelter_id, species_id):
+    "adoptable_pets() through pet_search"
+    return (select(pet_search.c.pet_id, pet_search.c.name)
+            .where(pet_search.c.shelter_id == shelter_id)
+            .where(pet_search.c.adopted.is_(False))
+            .where(pet_search.c.species_id == species_id))
+
+
+def shelter_pets(shelter_id, adopted):
+    "pets in a shelter by adoption status"
+    pet = model.Pet.__table__
+    return (select(pet.c.id, pet.c.name)
+            .where(pet.c.shelter_id == shelter_id)
+            .where(pet.c.adopted == adopted))
+
+
+def breed_count(breed_id):
+    "how many pets of a breed; ix_pet_breed_id answers it without the table"
+    pet = model.Pet.__table__
+    return select(func.count()).select_from(pet).where(pet.c.breed_id == breed_id)
+
+
+def person_pets(person_id):
+    "pets a person has a nickname for"
+    assoc = model.PetPersonAssociation.__table__
+    return select(assoc.c.pet_id, assoc.c.nickname).where(assoc.c.person_id == person_id)
+
+
+def explain(conn, statement):
+    "the database's query plan for statement, one string per line"
+    compiled = statement.compile(conn)
+    sql = str(compiled)
+    if conn.dialect.name == 'sqlite':
+        params = tuple(compiled.params[name] for name in compiled.positiontup)
+        # sqlite3 caches prepared statements by their text, and a cached
+        # EXPLAIN isn't prepared again when indexes come and go, so the
+        # schema version goes in the text
+        version = conn.exec_driver_sql("PRAGMA schema_version").scalar()
+        rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN /* schema {} */ {}".format(version, sql), params)
+        return [row[-1] for row in rows]
+    rows = conn.execute(text("EXPLAIN " + sql), compiled.params)
+    return [row[0] for row in rows]
+
+
+################################################################################
+# benchmark
+
+def _time_queries(conn, make_statement, arguments):
+    "average seconds per query over arguments"
+    start = timeit.default_timer()
+    for args in arguments:
+        conn.execute(make_statement(*args)).fetchall()
+    return (timeit.default_timer() - start) / len(arguments)
+
+
+def benchmark(engine, num_pets, shelters=1000, repeat=50):
+    bulk_load = importlib.import_module('bulk_load')
+    model.init_db(engine)
+    start = timeit.default_timer()
+    bulk_load.load_pets(engine, bulk_load.synthetic_records(num_pets, shelters=shelters))
+    log.info("loaded {} pets in {:.1f}s".format(num_pets, timeit.default_timer() - start))
+
+    person = model.Person.__table__
+    assoc = model.PetPersonAssociation.__table__
+    with engine.begin() as conn:
+        conn.execute(person.insert(), [
+            {'first_name': 'First{}'.format(i), 'last_name': 'Last{}'.format(i)}
+            for i in range(1000)])
+        conn.execute(assoc.insert(), [
+            {'pet_id': pet_id, 'person_id': pet_id % 1000 + 1, 'nickname': 'nick'}
+            for pet_id in range(1, min(num_pets, 100000) + 1)])
+
+    start = timeit.default_timer()
+    init_search(engine)
+    log.info("built pet_search in {:.1f}s".format(timeit.default_timer() - start))
+
+    with engine.connect() as conn:
+        if engine.dialect.name == 'sqlite':
+            conn.exec_driver_sql("ANALYZE")
+        else:
+            conn.execute(text("ANALYZE"))
+
+        rng = random.Random(0)
+        num_species = conn.execute(select(model.Species.__table__.c.id)).fetchall()
+        num_breeds = conn.execute(select(model.Breed.__table__.c.id)).fetchall()
+        adoptable_args = [(rng.randrange(1, shelters + 1), rng.choice(num_species)[0])
+                          for i in range(repeat)]
+        cases = [
+            ('adoptable_pets', adoptable_pets, adoptable_args, 'ix_pet_adoptable'),
+            ('adoptable_pets_search', adoptable_pets_search, adoptable_args,
+             'ix_pet_search_adoptable'),
+            ('shelter_pets', shelter_pets,
+             [(rng.randrange(1, shelters + 1), False) for i in range(repeat)],
+             'ix_pet_shelter_adopted'),
+            ('breed_count', breed_count,
+             [(rng.choice(num_breeds)[0],) for i in range(5)], 'ix_pet_breed_id'),
+            ('person_pets', person_pets,
+             [(rng.randrange(1, 1001),) for i in range(repeat)],
+             'ix_petPersonAssociation_person_id'),
+        ]
+
+        results = {}
+        for name, make_statement, arguments, index in cases:
+            plan = explain(conn, make_statement(*arguments[0]))
+            for line in plan:
+                log.info("  {} plan: {}".format(name, line))
+            # which index wins depends on the statistics, so on the size
+            # loaded; a small table can make another one look as good
+            if not any(index in line for line in plan):
+                assert num_pets < TARGET_PETS, "{} does not use {} with {} pets: {}".format(
+                    name, index, num_pets, plan)
+                log.warning("  {} does not use {} with {} pets".format(name, index, num_pets))
+            results[name] = _time_queries(conn, make_statement, arguments)
+
+    # the same queries with every index they could use gone, for comparison
+    pet_indexes = [i for i in model.Pet.__table__.indexes
+                   if list(i.columns)[0].name in ('shelter_id', 'breed_id')]
+    assoc_indexes = [i for i in assoc.indexes if i.name == 'ix_petPersonAssociation_person_id']
+    for index in pet_indexes + assoc_indexes:
+        index.drop(engine)
+    with engine.connect() as conn:
+        for name, make_statement, arguments, index in cases:
+            if name == 'adoptable_pets_search':
+                continue
+            for line in explain(conn, make_statement(*arguments[0])):
+                log.info("  {} plan without index: {}".format(name, line))
+            unindexed = _time_queries(conn, make_statement, arguments[:5])
+            log.info("{:>22}: {:8.3f}ms indexed, {:8.3f}ms without index".format(
+                name, results[name] * 1000, unindexed * 1000))
+    log.info("{:>22}: {:8.3f}ms".format('adoptable_pets_search',
+                                          results['adoptable_pets_search'] * 1000))
+    for index in pet_indexes + assoc_indexes:
+        index.create(engine)
+    return results
+
+
+def demo_sync(engine):
+    "show enable_sync() following ORM changes"
+    model.init_db(engine)
+    init_search(engine)
+    Session = db.make_session(engine)
+    enable_sync(Session)
+    db_session = Session()
+
+    dog = model.Species(name="Dog")
+    shelter = model.Shelter(name="Happy Animal Place")
+    spot = model.Pet(name="Spot", age=2, adopted=False, shelter=shelter,
+                     breed=model.Breed(name="Dalmatian", species=dog))
+    db_session.add(spot)
+    db_session.commit()
+
+    def adoptable():
+        return db_session.execute(adoptable_pets_search(shelter.id, dog.id)).fetchall()
+
+    assert [row.name for row in adoptable()] == ['Spot']
+    spot.adopted = True
+    db_session.commit()
+    assert adoptable() == []
+    spot.adopted = False
+    dog.name = "Canine"
+    db_session.commit()
+    row = db_session.execute(select(pet_search).where(pet_search.c.pet_id == spot.id)).one()
+    assert row.species_name == "Canine" and not row.adopted
+    db_session.delete(spot)
+    db_session.commit()
+    assert adoptable() == []
+    db_session.close()
+    disable_sync(Session)
+    log.info("pet_search followed inserts, updates and deletes")
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    num_pets = int(args[0]) if args else 1000000
+
+    engine = db.make_engine(url)
+    demo_sync(engine)
+    benchmark(engine, num_pets)
+    engine.dispose()
+    log.info("all done!")
@@ -0,0 +1,198 @@
+"""
+query layer with preconfigured loader strategies
+
+Pet.nicknames(), PetPersonAssociation.__repr__ and Breed.__repr__ all walk
+relationships, which by default are lazy loaded with one SELECT per object.
+The loader profiles here load those relationships up front, so listing any
+number of pets costs a fixed number of statements:
+
+    pets = query(db_session, model.Pet, 'pet_with_nicknames').all()
+
+Collections come in through subqueryload, one statement per collection
+however many parents there are, where selectinload would take one per 500.
+subqueryload repeats the parent query as a subquery, so a query with
+LIMIT/OFFSET needs an ORDER BY for the two to agree on the rows.
+
+StatementCounter counts the statements an engine emits, so the fixed count
+can be asserted on.
+"""
+import importlib
+
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload, subqueryload
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+
+################################################################################
+# loader profiles
+
+# profiles are functions, because the backref attributes such as
+# Pet.person_associations only exist once the mappers are configured
+PROFILES = {
+    # Pet.nicknames() and PetPersonAssociation.__repr__
+    'pet_with_nicknames': lambda: [
+        subqueryload(model.Pet.person_associations)
+        .joinedload(model.PetPersonAssociation.person),
+    ],
+    # Breed.__repr__
+    'breed_with_species': lambda: [
+        joinedload(model.Breed.species),
+    ],
+    # everything a pet listing shows
+    'pet_detail': lambda: [
+        joinedload(model.Pet.breed).joinedload(model.Breed.species),
+        joinedload(model.Pet.shelter),
+        subqueryload(model.Pet.person_associations)
+        .joinedload(model.PetPersonAssociation.person),
+    ],
+    # Person.pet_associations and the pets behind them
+    'person_with_pets': lambda: [
+        subqueryload(model.Person.pet_associations)
+        .joinedload(model.PetPersonAssociation.pet),
+    ],
+    # Species.breeds, for listing breeds per species
+    'species_with_breeds': lambda: [
+        subqueryload(model.Species.breeds),
+    ],
+}
+
+
+def loader_options(profile):
+    "return the loader options for a named profile"
+    try:
+        return PROFILES[profile]()
+    except KeyError:
+        raise ValueError("unknown loader profile: {}".format(profile))
+
+
+def query(session, entity, profile=None):
+    "session.query(entity) with a loader profile applied"
+    q = session.query(entity)
+    if profile is not None:
+        q = q.options(*loader_options(profile))
+    return q
+
+
+def pets_with_nicknames(session):
+    "all pets, ready for Pet.nicknames()"
+    return query(session, model.Pet, 'pet_with_nicknames').order_by(model.Pet.id)
+
+
+def breeds_with_species(session):
+    "all breeds, ready for Breed.__repr__"
+    return query(session, model.Breed, 'breed_with_species').order_by(model.Breed.id)
+
+
+################################################################################
+# statement counting
+
+class StatementCounter(object):
+    """
+    context manager that records every statement an engine executes
+
+        with StatementCounter(engine) as counter:
+            ...
+        assert counter.count == 2
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        self.statements.append(statement)
+
+    def __enter__(self):
+        self.statements = []
+        event.listen(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+        return False
+
+    def assert_count(self, expected):
+        "raise AssertionError listing the statements if the count is off"
+        if self.count != expected:
+            raise AssertionError("expected {} statements, got {}:\n{}".format(
+                expected, self.count, "\n".join(self.statements)))
+
+
+################################################################################
+# demo
+
+def seed(engine, num_pets, people=10):
+    "bulk insert num_pets pets, each with two nicknames"
+    bulk_load = importlib.import_module('bulk_load')
+    model.init_db(engine)
+    bulk_load.load_pets(engine, bulk_load.synthetic_records(num_pets))
+
+    person = model.Person.__table__
+    assoc = model.PetPersonAssociation.__table__
+    with engine.begin() as conn:
+        conn.execute(person.insert(), [
+            {'first_name': 'First{}'.format(i), 'last_name': 'Last{}'.format(i),
+             '_phone': '555-555-{:04d}'.format(i)} for i in range(people)])
+        conn.execute(assoc.insert(), [
+            {'pet_id': pet_id, 'person_id': (pet_id + n) % people + 1,
+             'nickname': 'nick{}-{}'.format(pet_id, n)}
+            for pet_id in range(1, num_pets + 1) for n in range(2)])
+
+
+def count_listing_statements(engine, profile):
+    "statements needed to list every pet with its nicknames"
+    db_session = db.make_session(engine)()
+    with StatementCounter(engine) as counter:
+        for pet in query(db_session, model.Pet, profile):
+            pet.nicknames()
+            [repr(a) for a in pet.person_associations]
+    db_session.close()
+    return counter.count
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    sizes = [int(n) for n in args] or [10, 100, 1000]
+
+    for num_pets in sizes:
+        engine = db.make_engine(url)
+        seed(engine, num_pets)
+        lazy = count_listing_statements(engine, None)
+        eager = count_listing_statements(engine, 'pet_with_nicknames')
+        log.info("{} pets: {} statements lazy loaded, {} with pet_with_nicknames".format(
+            num_pets, lazy, eager))
+
+        # pets, then associations with their people, at any size
+        assert eager == 2, eager
+
+        db_session = db.make_session(engine)()
+        with StatementCounter(engine) as counter:
+            [repr(b) for b in breeds_with_species(db_session)]
+        counter.assert_count(1)
+        db_session.close()
+        engine.dispose()
+
+    log.info("all done!")
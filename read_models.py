@@ -0,0 +1,199 @@
+"""
+read-only projections of pets, breeds and shelters
+
+A listing that only shows a few columns does not need full Pet instances,
+each with its instance state, identity map entry and backref collections.
+The functions here run a Core select against the mapped table and return
+namedtuples instead: no identity map, no change tracking, and a fraction
+of the memory per row.
+
+    for pet in rows(conn, model.Pet, ['id', 'name', 'age']):
+        print(pet.name)
+
+columns picks a subset of the table's columns; each subset gets its own
+namedtuple class, made once.  A session works as well as a connection, the
+rows still never enter its identity map.
+
+run as a script to compare against full ORM entities:
+
+    python read_models.py [url] [number of pets]
+"""
+import collections
+import gc
+import importlib
+import timeit
+import tracemalloc
+
+from sqlalchemy import select
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+DEFAULT_CHUNK_SIZE = 1000
+
+PetRow = collections.namedtuple('PetRow', [c.name for c in model.Pet.__table__.c])
+BreedRow = collections.namedtuple('BreedRow', [c.name for c in model.Breed.__table__.c])
+ShelterRow = collections.namedtuple('ShelterRow', [c.name for c in model.Shelter.__table__.c])
+
+# entity -> its full row class; subsets are added to _row_types as they are asked for
+READ_MODELS = {
+    model.Pet: PetRow,
+    model.Breed: BreedRow,
+    model.Shelter: ShelterRow,
+}
+
+_row_types = {}
+
+
+################################################################################
+# row classes and statements
+
+def row_type(entity, columns=None):
+    "the namedtuple class for entity's rows, limited to columns if given"
+    try:
+        full = READ_MODELS[entity]
+    except KeyError:
+        raise ValueError("no read model for {}".format(entity))
+    if columns is None:
+        return full
+    columns = tuple(columns)
+    key = (entity, columns)
+    if key not in _row_types:
+        unknown = [c for c in columns if c not in full._fields]
+        if unknown:
+            raise ValueError("{} has no column {}".format(full.__name__, ', '.join(unknown)))
+        _row_types[key] = collections.namedtuple(full.__name__, columns)
+    return _row_types[key]
+
+
+def statement(entity, columns=None):
+    "a Core select of the row class's columns, in id order"
+    table = entity.__table__
+    return (select(*[table.c[f] for f in row_type(entity, columns)._fields])
+            .order_by(table.c.id))
+
+
+################################################################################
+# reading
+
+def rows(conn, entity, columns=None, where=None):
+    """
+    every row of entity as namedtuples, optionally filtered by where, a
+    clause on entity's table; conn is a connection or a session
+    """
+    make = row_type(entity, columns)._make
+    stmt = statement(entity, columns)
+    if where is not None:
+        stmt = stmt.where(where)
+    return [make(row) for row in conn.execute(stmt)]
+
+
+def iter_rows(conn, entity, columns=None, where=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    "like rows(), streamed chunk_size rows at a time so memory stays flat"
+    make = row_type(entity, columns)._make
+    stmt = statement(entity, columns)
+    if where is not None:
+        stmt = stmt.where(where)
+    # options on the statement, so sessions and connections both honour them
+    result = conn.execute(stmt.execution_options(stream_results=True, yield_per=chunk_size))
+    for partition in result.partitions(chunk_size):
+        for row in partition:
+            yield make(row)
+
+
+def get(conn, entity, id, columns=None):
+    "one row by primary key, or None"
+    row = conn.execute(statement(entity, columns)
+                       .where(entity.__table__.c.id == id)).first()
+    if row is None:
+        return None
+    return row_type(entity, columns)._make(row)
+
+
+################################################################################
+# benchmark
+
+def load_entities(engine, limit=None):
+    "the ORM way: full Pet instances, with the session whose identity map holds them"
+    db_session = db.make_session(engine)()
+    q = db_session.query(model.Pet).order_by(model.Pet.id)
+    if limit is not None:
+        q = q.filter(model.Pet.id <= limit)
+    return q.all(), db_session
+
+
+def load_rows(engine, limit=None, columns=None):
+    "PetRow namedtuples, with nothing else to keep alive"
+    with engine.connect() as conn:
+        where = model.Pet.__table__.c.id <= limit if limit is not None else None
+        return rows(conn, model.Pet, columns, where), None
+
+
+def _measure(load, engine, sample):
+    """
+    (rows/sec, bytes per object): rows/sec over the whole table, memory
+    under tracemalloc for the first sample pets only, since tracing slows
+    everything down
+    """
+    gc.collect()
+    start = timeit.default_timer()
+    loaded, keep = load(engine)
+    elapsed = timeit.default_timer() - start
+    count = len(loaded)
+    del loaded, keep
+    gc.collect()
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    loaded, keep = load(engine, sample)
+    per_object = float(tracemalloc.get_traced_memory()[0] - before) / len(loaded)
+    tracemalloc.stop()
+    del loaded, keep
+    return count / elapsed, per_object
+
+
+def benchmark(engine, num_pets, sample=100000):
+    bulk_load = importlib.import_module('bulk_load')
+    model.init_db(engine)
+    bulk_load.load_pets(engine, bulk_load.synthetic_records(num_pets))
+    sample = min(sample, num_pets)
+
+    results = {}
+    for name, load in [
+            ('orm entities', load_entities),
+            ('PetRow', load_rows),
+            ('PetRow(id, name)',
+             lambda engine, limit=None: load_rows(engine, limit, ['id', 'name']))]:
+        results[name] = _measure(load, engine, sample)
+        log.info("{:>16}: {:,.0f} rows/sec, {:,.0f} bytes per object".format(
+            name, *results[name]))
+    log.info("PetRow: {:.1f}x the rows/sec, 1/{:.1f} the memory of orm entities".format(
+        results['PetRow'][0] / results['orm entities'][0],
+        results['orm entities'][1] / results['PetRow'][1]))
+    return results
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    num_pets = int(args[0]) if args else 1000000
+
+    engine = db.make_engine(url)
+    benchmark(engine, num_pets)
+    engine.dispose()
+    log.info("all done!")
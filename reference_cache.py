@@ -0,0 +1,418 @@
+"""
+read-through cache for the Species, Breed and BreedTrait reference tables
+
+These tables are small and rarely change, but every pet insert in the demos
+either queries them again or builds duplicate rows.  ReferenceCache keeps
+their rows in a process-local LRU with a TTL, keyed by name and by id, and
+hands out get-or-create lookups, so creating a pet on the hot path issues no
+SELECT for its reference data:
+
+    cache = ReferenceCache()
+    cache.attach(Session)
+    golden = cache.breed(db_session, "Golden Retriever", "Dog")
+    db_session.add(Pet(name="Goldie", breed_id=golden.id))
+
+Rows come back as namedtuples, never ORM objects, so they are safe to share
+between sessions and threads.  Rows a session creates stay private to it
+until it commits; a rollback forgets them.  Committed changes to cached
+rows through an attached session invalidate them; deleting a species drops
+its breeds too, since ON DELETE CASCADE removes them without the session
+seeing it.
+
+run as a script for a demo and a benchmark against querying every time:
+
+    python reference_cache.py [url] [number of pets]
+"""
+import collections
+import importlib
+import threading
+import time
+import timeit
+
+from sqlalchemy import event
+from sqlalchemy import inspect
+from sqlalchemy import select
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+SpeciesRow = collections.namedtuple('SpeciesRow', 'id name')
+BreedRow = collections.namedtuple('BreedRow', 'id name species_id')
+TraitRow = collections.namedtuple('TraitRow', 'id name')
+
+# session.info keys
+PENDING = 'reference_cache_pending'
+CHANGED = 'reference_cache_changed'
+DELETED_SPECIES = 'reference_cache_deleted_species'
+
+_clock = getattr(time, 'monotonic', time.time)
+_missing = object()
+
+
+################################################################################
+# LRU with TTL
+
+class LRUCache(object):
+    """
+    thread safe least-recently-used mapping whose entries also expire ttl
+    seconds after they were stored (never, if ttl is None)
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, clock=_clock):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _missing)
+            if entry is _missing:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires is not None and expires <= self.clock():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.pop(key)
+            self._data[key] = entry
+            self.hits += 1
+            return value
+
+    def peek(self, key, default=None):
+        "get without touching the counters or the recency order"
+        with self._lock:
+            entry = self._data.get(key, _missing)
+            return default if entry is _missing else entry[0]
+
+    def put(self, key, value):
+        with self._lock:
+            expires = None if self.ttl is None else self.clock() + self.ttl
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            if self._data.pop(key, _missing) is not _missing:
+                self.invalidations += 1
+
+    def pop_values(self, predicate):
+        "drop every entry whose value predicate is true for"
+        with self._lock:
+            for key in [k for k, (value, expires) in self._data.items() if predicate(value)]:
+                del self._data[key]
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        "counters as a dict"
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+            'invalidations': self.invalidations,
+        }
+
+
+################################################################################
+# reference cache
+
+def _keys(kind, row):
+    "the id key and name key a row is cached under"
+    if kind == 'breed':
+        return [(kind, 'id', row.id), (kind, 'name', row.name, row.species_id)]
+    return [(kind, 'id', row.id), (kind, 'name', row.name)]
+
+
+class ReferenceCache(object):
+    """
+    get-or-create lookups for species, breeds and breed traits
+    """
+
+    KINDS = {
+        'species': (model.Species, SpeciesRow),
+        'breed': (model.Breed, BreedRow),
+        'trait': (model.BreedTrait, TraitRow),
+    }
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.lru = LRUCache(maxsize, ttl)
+        self.pending_hits = 0
+
+    # events
+
+    def attach(self, target):
+        "follow commits and rollbacks of target, a Session class, sessionmaker or session"
+        event.listen(target, 'after_flush', self._after_flush)
+        event.listen(target, 'after_commit', self._after_commit)
+        event.listen(target, 'after_rollback', self._after_rollback)
+
+    def detach(self, target):
+        event.remove(target, 'after_flush', self._after_flush)
+        event.remove(target, 'after_commit', self._after_commit)
+        event.remove(target, 'after_rollback', self._after_rollback)
+
+    def _after_flush(self, session, flush_context):
+        changed = session.info.setdefault(CHANGED, [])
+        for obj in list(session.dirty) + list(session.deleted):
+            for kind, (entity, row_class) in self.KINDS.items():
+                if isinstance(obj, entity):
+                    changed.extend(self._stale_keys(kind, obj))
+        # the database deletes a species' breeds itself (passive_deletes),
+        # so they never show up in session.deleted
+        deleted = set(obj.id for obj in session.deleted if isinstance(obj, model.Species))
+        if deleted:
+            session.info.setdefault(DELETED_SPECIES, set()).update(deleted)
+
+    def _stale_keys(self, kind, obj):
+        "every key obj could be cached under, before and after the flush"
+        state = inspect(obj)
+        keys = [(kind, 'id', obj.id)]
+        names = set(state.attrs.name.history.deleted) | set([obj.name])
+        if kind == 'breed':
+            species_ids = set(state.attrs.species_id.history.deleted) | set([obj.species_id])
+            keys.extend((kind, 'name', n, s) for n in names for s in species_ids)
+        else:
+            keys.extend((kind, 'name', n) for n in names)
+        return keys
+
+    def _after_commit(self, session):
+        for key in session.info.pop(CHANGED, []):
+            self.lru.pop(key)
+        deleted = session.info.pop(DELETED_SPECIES, None)
+        if deleted:
+            self.lru.pop_values(lambda row: isinstance(row, BreedRow) and row.species_id in deleted)
+        for row_kind, row in session.info.pop(PENDING, {}).values():
+            for key in _keys(row_kind, row):
+                self.lru.put(key, row)
+
+    def _after_rollback(self, session):
+        session.info.pop(CHANGED, None)
+        session.info.pop(DELETED_SPECIES, None)
+        session.info.pop(PENDING, None)
+
+    # lookups
+
+    def _lookup(self, session, kind, key, where, values, create):
+        pending = session.info.get(PENDING, {})
+        if key in pending:
+            self.pending_hits += 1
+            return pending[key][1]
+        row = self.lru.get(key, _missing)
+        if row is not _missing:
+            return row
+
+        entity, row_class = self.KINDS[kind]
+        table = entity.__table__
+        found = session.execute(
+            select(*[table.c[f] for f in row_class._fields])
+            .where(where).order_by(table.c.id).limit(1)).first()
+        if found is not None:
+            row = row_class(*found)
+            for k in _keys(kind, row):
+                self.lru.put(k, row)
+            return row
+        if not create:
+            return None
+
+        result = session.execute(table.insert().values(**values))
+        row = row_class(id=result.inserted_primary_key[0], **values)
+        pending = session.info.setdefault(PENDING, {})
+        for k in _keys(kind, row):
+            pending[k] = (kind, row)
+        return row
+
+    def species(self, session, name, create=True):
+        "the SpeciesRow named name, created if missing and create is set"
+        table = model.Species.__table__
+        return self._lookup(session, 'species', ('species', 'name', name),
+                            table.c.name == name, {'name': name}, create)
+
+    def breed(self, session, name, species, create=True):
+        """
+        the BreedRow named name for species, a species name or id; a missing
+        species is created along with the breed
+        """
+        if not isinstance(species, int):
+            species_row = self.species(session, species, create)
+            if species_row is None:
+                return None
+            species = species_row.id
+        table = model.Breed.__table__
+        return self._lookup(session, 'breed', ('breed', 'name', name, species),
+                            (table.c.name == name) & (table.c.species_id == species),
+                            {'name': name, 'species_id': species}, create)
+
+    def trait(self, session, name, create=True):
+        "the TraitRow named name, created if missing and create is set"
+        table = model.BreedTrait.__table__
+        return self._lookup(session, 'trait', ('trait', 'name', name),
+                            table.c.name == name, {'name': name}, create)
+
+    def get(self, session, kind, id):
+        "a species, breed or trait row by id, or None"
+        table = self.KINDS[kind][0].__table__
+        return self._lookup(session, kind, (kind, 'id', id), table.c.id == id, None, False)
+
+    def stats(self):
+        "LRU counters, plus hits on rows the session created itself"
+        stats = self.lru.stats()
+        stats['pending_hits'] = self.pending_hits
+        return stats
+
+    def clear(self):
+        self.lru.clear()
+
+
+################################################################################
+# demo and benchmark
+
+def demo(engine):
+    "the many-to-many demo pets, without the duplicate Golden Retriever rows"
+    queries = importlib.import_module('queries')
+    model.init_db(engine)
+    Session = db.make_session(engine)
+    cache = ReferenceCache()
+    cache.attach(Session)
+    db_session = Session()
+
+    for name, age in [("GoldieMom", 13), ("GoldieDad", 15), ("Goldie", 9)]:
+        golden = cache.breed(db_session, "Golden Retriever", "Dog")
+        db_session.add(model.Pet(name=name, age=age, adopted=False, breed_id=golden.id))
+    cache.trait(db_session, "Fluffy")
+    db_session.commit()
+    assert db_session.query(model.Breed).count() == 1
+    assert db_session.query(model.Species).count() == 1
+
+    # committed rows are shared: no SELECT for the reference data now
+    with queries.StatementCounter(engine) as counter:
+        golden = cache.breed(db_session, "Golden Retriever", "Dog")
+        fluffy = cache.trait(db_session, "Fluffy")
+    assert [s for s in counter.statements if s.startswith('SELECT')] == []
+    db_session.commit()
+
+    # a rolled back row is forgotten
+    cache.breed(db_session, "Dalmatian", "Dog")
+    db_session.rollback()
+    assert cache.breed(db_session, "Dalmatian", "Dog", create=False) is None
+
+    # renaming through the ORM invalidates the cached row on commit
+    breed = db_session.query(model.Breed).get(golden.id)
+    breed.name = "Golden"
+    db_session.commit()
+    assert cache.breed(db_session, "Golden Retriever", "Dog", create=False) is None
+    assert cache.breed(db_session, "Golden", "Dog").id == golden.id
+    assert cache.get(db_session, 'trait', fluffy.id) == fluffy
+
+    # deleting the species takes its cached breeds with it
+    golden = cache.breed(db_session, "Golden", "Dog")
+    db_session.delete(db_session.query(model.Species).get(golden.species_id))
+    db_session.commit()
+    assert cache.get(db_session, 'breed', golden.id) is None
+    assert cache.breed(db_session, "Golden", golden.species_id, create=False) is None
+
+    db_session.close()
+    cache.detach(Session)
+    log.info("demo cache stats: {}".format(cache.stats()))
+
+
+def benchmark(engine, num_pets):
+    bulk_load = importlib.import_module('bulk_load')
+    records = list(bulk_load.synthetic_records(num_pets))
+    Session = db.make_session(engine)
+    results = {}
+
+    model.init_db(engine)
+    db_session = Session()
+    start = timeit.default_timer()
+    for r in records:
+        species = db_session.query(model.Species).filter(model.Species.name == r['species']).first()
+        if species is None:
+            species = model.Species(name=r['species'])
+            db_session.add(species)
+            db_session.flush()
+        breed = db_session.query(model.Breed).filter(
+            model.Breed.name == r['breed'], model.Breed.species_id == species.id).first()
+        if breed is None:
+            breed = model.Breed(name=r['breed'], species_id=species.id)
+            db_session.add(breed)
+            db_session.flush()
+        db_session.add(model.Pet(name=r['name'], age=r['age'], adopted=r['adopted'],
+                                 breed_id=breed.id))
+        if len(db_session.new) >= 1000:
+            db_session.commit()
+    db_session.commit()
+    results['query'] = timeit.default_timer() - start
+    db_session.close()
+
+    model.init_db(engine)
+    cache = ReferenceCache()
+    cache.attach(Session)
+    db_session = Session()
+    start = timeit.default_timer()
+    for r in records:
+        breed = cache.breed(db_session, r['breed'], r['species'])
+        db_session.add(model.Pet(name=r['name'], age=r['age'], adopted=r['adopted'],
+                                 breed_id=breed.id))
+        if len(db_session.new) >= 1000:
+            db_session.commit()
+    db_session.commit()
+    results['cache'] = timeit.default_timer() - start
+    assert db_session.query(model.Breed).count() == 9
+    db_session.close()
+    cache.detach(Session)
+
+    for name, elapsed in sorted(results.items()):
+        log.info("{:>6}: {} pets in {:.3f}s, {:,.0f} pets/sec".format(
+            name, num_pets, elapsed, num_pets / elapsed))
+    log.info("cache stats: {}".format(cache.stats()))
+    return results
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    num_pets = int(args[0]) if args else 20000
+
+    engine = db.make_engine(url)
+    demo(engine)
+    benchmark(engine, num_pets)
+    engine.dispose()
+    log.info("all done!")
@@ -0,0 +1,290 @@
+"""
+prebuilt statements for the recurring lookups and counts
+
+The demos build the same queries over and over, e.g.
+
+    db_session.query(Species).filter(Species.name == 'Parrot').one()
+
+and every call constructs a new Query, converts it to a select and
+generates its cache key before SQLAlchemy can find the compiled form in the
+engine's compiled cache.  The statements here are built once at import with
+bindparam() placeholders, so a call only binds its values; a select memoizes
+its own cache key, so every execution after the first is a cache hit with
+no construction work at all.
+
+    parrot = species_by_name(db_session, 'Parrot')
+    counts = pets_per_shelter(db_session)
+
+CacheStats counts compiled cache hits and misses per statement, from the
+cache_hit flag SQLAlchemy sets on every execution context.
+
+run as a script for a microbenchmark against building queries per call:
+
+    python repository.py [url] [calls]
+"""
+import collections
+import importlib
+import timeit
+
+from sqlalchemy import bindparam, event, func, select
+from sqlalchemy.engine import default
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+Pet = model.Pet
+Breed = model.Breed
+Species = model.Species
+Shelter = model.Shelter
+
+
+################################################################################
+# statements
+
+SPECIES_BY_NAME = select(Species).where(Species.name == bindparam('name'))
+
+BREED_BY_NAME = (select(Breed)
+                 .where(Breed.name == bindparam('name'))
+                 .where(Breed.species_id == bindparam('species_id')))
+
+SHELTER_BY_NAME = select(Shelter).where(Shelter.name == bindparam('name'))
+
+COUNTS = dict((entity, select(func.count()).select_from(entity.__table__))
+              for entity in (Species, Breed, model.BreedTrait, Shelter, Pet, model.Person))
+
+PETS_IN_SHELTER = (select(func.count())
+                   .select_from(Pet.__table__)
+                   .where(Pet.__table__.c.shelter_id == bindparam('shelter_id')))
+
+PETS_PER_SHELTER = (select(Pet.__table__.c.shelter_id, func.count())
+                    .group_by(Pet.__table__.c.shelter_id))
+
+PETS_BY_BREED = (select(Pet)
+                 .where(Pet.breed_id == bindparam('breed_id'))
+                 .order_by(Pet.id))
+
+PETS_BY_BREED_NAME = (select(Pet)
+                      .join(Breed, Pet.breed_id == Breed.id)
+                      .join(Species, Breed.species_id == Species.id)
+                      .where(Breed.name == bindparam('breed'))
+                      .where(Species.name == bindparam('species'))
+                      .order_by(Pet.id))
+
+
+################################################################################
+# access paths
+
+def species_by_name(session, name):
+    "the first Species called name, or None"
+    return session.execute(SPECIES_BY_NAME, {'name': name}).scalars().first()
+
+
+def breed_by_name(session, name, species_id):
+    "the first Breed called name for species_id, or None"
+    return session.execute(BREED_BY_NAME,
+                           {'name': name, 'species_id': species_id}).scalars().first()
+
+
+def shelter_by_name(session, name):
+    "the first Shelter called name, or None"
+    return session.execute(SHELTER_BY_NAME, {'name': name}).scalars().first()
+
+
+def count(session, entity):
+    "the number of rows of entity, what query(entity).count() answers"
+    try:
+        statement = COUNTS[entity]
+    except KeyError:
+        raise ValueError("no count statement for {}".format(entity))
+    return session.execute(statement).scalar()
+
+
+def pets_in_shelter(session, shelter_id):
+    "the number of pets in one shelter"
+    return session.execute(PETS_IN_SHELTER, {'shelter_id': shelter_id}).scalar()
+
+
+def pets_per_shelter(session):
+    "{shelter_id: number of pets}, pets with no shelter under None"
+    return dict(tuple(row) for row in session.execute(PETS_PER_SHELTER))
+
+
+def pets_by_breed(session, breed_id):
+    "every Pet of breed_id, in id order"
+    return session.execute(PETS_BY_BREED, {'breed_id': breed_id}).scalars().all()
+
+
+def pets_by_breed_name(session, breed, species):
+    "every Pet of the named breed and species, in id order"
+    return session.execute(PETS_BY_BREED_NAME,
+                           {'breed': breed, 'species': species}).scalars().all()
+
+
+################################################################################
+# cache statistics
+
+class CacheStats(object):
+    """
+    compiled cache outcomes for every statement an engine executes
+
+        stats = CacheStats().attach(engine)
+        ...
+        stats.hits, stats.misses, stats.hit_ratio
+    """
+
+    OUTCOMES = {
+        default.CACHE_HIT: 'hit',
+        default.CACHE_MISS: 'miss',
+        default.CACHING_DISABLED: 'disabled',
+        default.NO_CACHE_KEY: 'no key',
+    }
+
+    def __init__(self):
+        self.totals = collections.Counter()
+        self.statements = collections.defaultdict(collections.Counter)
+        self.engine = None
+
+    def attach(self, engine):
+        self.engine = engine
+        event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+        return self
+
+    def detach(self):
+        event.remove(self.engine, 'before_cursor_execute', self._before_cursor_execute)
+        self.engine = None
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if context is None or context.compiled is None:
+            outcome = 'raw sql'
+        else:
+            outcome = self.OUTCOMES.get(context.cache_hit, 'unknown')
+        self.totals[outcome] += 1
+        self.statements[statement][outcome] += 1
+
+    @property
+    def hits(self):
+        return self.totals['hit']
+
+    @property
+    def misses(self):
+        return self.totals['miss']
+
+    @property
+    def hit_ratio(self):
+        total = sum(self.totals.values())
+        return float(self.hits) / total if total else 0.0
+
+    def reset(self):
+        self.totals.clear()
+        self.statements.clear()
+
+    def snapshot(self):
+        "plain dict of the totals and the per statement outcomes"
+        return {
+            'totals': dict(self.totals),
+            'hit_ratio': self.hit_ratio,
+            'statements': dict((s, dict(c)) for s, c in self.statements.items()),
+        }
+
+
+################################################################################
+# benchmark
+
+def _time(call, calls):
+    "microseconds per call"
+    start = timeit.default_timer()
+    for i in range(calls):
+        call()
+    return (timeit.default_timer() - start) / calls * 1e6
+
+
+def benchmark(engine, calls=5000, num_pets=1000):
+    """
+    microseconds per call for each access path three ways: a Query built per
+    call with the compiled cache off, a Query built per call with the cache
+    on, and the prebuilt statement
+    """
+    bulk_load = importlib.import_module('bulk_load')
+    model.init_db(engine)
+    bulk_load.load_pets(engine, bulk_load.synthetic_records(num_pets))
+
+    db_session = db.make_session(engine)()
+    parrot = species_by_name(db_session, 'Parrot')
+    grey = breed_by_name(db_session, 'African Grey', parrot.id)
+    shelter = shelter_by_name(db_session, 'Shelter 0')
+
+    def per_call(session):
+        return [
+            ('species by name',
+             lambda: session.query(Species).filter(Species.name == 'Parrot').first()),
+            ('count pets',
+             lambda: session.query(Pet).count()),
+            ('pets in shelter',
+             lambda: session.query(Pet).filter(Pet.shelter_id == shelter.id).count()),
+            ('pets by breed',
+             lambda: session.query(Pet).filter(Pet.breed_id == grey.id).order_by(Pet.id).all()),
+        ]
+
+    prebuilt = [
+        ('species by name', lambda: species_by_name(db_session, 'Parrot')),
+        ('count pets', lambda: count(db_session, Pet)),
+        ('pets in shelter', lambda: pets_in_shelter(db_session, shelter.id)),
+        ('pets by breed', lambda: pets_by_breed(db_session, grey.id)),
+    ]
+
+    def ids(answer):
+        # objects from two sessions never compare equal, their ids do
+        if isinstance(answer, list):
+            return [o.id for o in answer]
+        return getattr(answer, 'id', answer)
+
+    # same answers every way
+    uncached_session = db.make_session(engine.execution_options(compiled_cache=None))()
+    for (name, built), (_, ready) in zip(per_call(uncached_session), prebuilt):
+        assert ids(built()) == ids(ready()), name
+
+    stats = CacheStats().attach(engine)
+    results = {}
+    for way, paths in [('uncached query()', per_call(uncached_session)),
+                       ('cached query()', per_call(db_session)),
+                       ('prebuilt', prebuilt)]:
+        stats.reset()
+        for name, call in paths:
+            results[(name, way)] = _time(call, calls)
+        log.info("{:>16}: cache {}".format(way, dict(stats.totals)))
+    stats.detach()
+    uncached_session.close()
+    db_session.close()
+
+    for name, _ in prebuilt:
+        log.info("{:>16}: {:7.1f}us uncached query(), {:7.1f}us cached query(), "
+                 "{:7.1f}us prebuilt".format(
+                     name, results[(name, 'uncached query()')],
+                     results[(name, 'cached query()')], results[(name, 'prebuilt')]))
+    return results
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    calls = int(args[0]) if args else 5000
+
+    engine = db.make_engine(url)
+    benchmark(engine, calls)
+    engine.dispose()
+    log.info("all done!")
@@ -0,0 +1,382 @@
+"""
+read-replica routing
+
+RoutingSession sends everything that writes to the primary engine and
+spreads reads across replica engines:
+
+  - flushes, and INSERT/UPDATE/DELETE statements, go to the primary
+  - once a session has flushed, the rest of its transaction reads from the
+    primary too, so it sees its own uncommitted rows
+  - after a commit that wrote something, reads keep going to the primary
+    for sticky_seconds, long enough for the replicas to catch up.  The
+    Router remembers this, not the session, so a new session for the next
+    request reads its writes too.  Sessions made with a client token (a
+    user id, say) only stick for that client; those without share one
+    window
+  - everything else goes to the replica a selector picks: RoundRobin, or
+    LeastLatency, which follows a moving average of each replica's statement
+    times and now and then tries the others
+
+    router = Router(primary, [replica1, replica2], selector='least_latency')
+    Session = router.sessionmaker()
+    with Session() as db_session:
+        db_session.query(model.Pet).count()    # a replica
+    with Session(client=user_id) as db_session:
+        ...                                    # sticks for user_id only
+
+Raw text() statements can't be told apart from reads; run writes of that
+kind inside "with db_session.primary():".
+
+run as a script for a local demo with SQLite files standing in for the
+primary and two replicas, copied over with the backup API:
+
+    python routing.py [number of pets] [reads]
+"""
+import collections
+import contextlib
+import importlib
+import itertools
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import timeit
+
+from sqlalchemy import event, func
+from sqlalchemy.engine.base import OptionEngine
+from sqlalchemy.orm import Session, sessionmaker
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+# session.info keys
+WROTE = 'routing_wrote'
+FORCE_PRIMARY = 'routing_force_primary'
+# conn.info key for LeastLatency's start times
+START_TIMES = 'routing_start_times'
+
+_clock = getattr(time, 'monotonic', time.time)
+
+# sticky clients the Router tracks before it sweeps out expired ones
+STICKY_SWEEP = 1024
+
+
+################################################################################
+# replica selection
+
+def _base_engine(engine):
+    "the Engine an engine.execution_options(...) copy was made from"
+    while isinstance(engine, OptionEngine):
+        engine = engine._proxied
+    return engine
+
+
+class RoundRobin(object):
+    "each replica in turn"
+
+    def __init__(self, engines):
+        self.engines = list(engines)
+        self._cycle = itertools.cycle(self.engines)
+        self._lock = threading.Lock()
+
+    def choose(self):
+        with self._lock:
+            return next(self._cycle)
+
+    def close(self):
+        pass
+
+
+class LeastLatency(object):
+    """
+    the replica with the lowest moving average statement time; explore is
+    the share of picks that go to a random replica instead, so one that got
+    faster again gets noticed
+    """
+
+    def __init__(self, engines, decay=0.2, explore=0.05, seed=None):
+        self.engines = list(engines)
+        self.decay = decay
+        self.explore = explore
+        # untried replicas look free, so each gets tried early on
+        self.latency = dict((engine, 0.0) for engine in self.engines)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        for engine in self.engines:
+            event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+            event.listen(engine, 'handle_error', self._handle_error)
+
+    def choose(self):
+        with self._lock:
+            if self._rng.random() < self.explore:
+                return self._rng.choice(self.engines)
+            return min(self.engines, key=self.latency.__getitem__)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault(START_TIMES, []).append(timeit.default_timer())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed = timeit.default_timer() - conn.info[START_TIMES].pop()
+        engine = _base_engine(conn.engine)
+        with self._lock:
+            previous = self.latency[engine]
+            self.latency[engine] = previous + self.decay * (elapsed - previous)
+
+    def _handle_error(self, exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get(START_TIMES):
+            conn.info[START_TIMES].pop()
+
+    def close(self):
+        for engine in self.engines:
+            event.remove(engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.remove(engine, 'after_cursor_execute', self._after_cursor_execute)
+            event.remove(engine, 'handle_error', self._handle_error)
+
+
+SELECTORS = {
+    'round_robin': RoundRobin,
+    'least_latency': LeastLatency,
+}
+
+
+################################################################################
+# router and session
+
+class Router(object):
+    """
+    a primary engine, the replica engines and how to pick between them;
+    with no replicas everything goes to the primary
+    """
+
+    def __init__(self, primary, replicas=(), selector='round_robin', sticky_seconds=2.0):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.sticky_seconds = sticky_seconds
+        # client token -> when its reads may go back to the replicas
+        self._sticky_until = {}
+        self._sticky_lock = threading.Lock()
+        if isinstance(selector, str):
+            try:
+                selector = SELECTORS[selector]
+            except KeyError:
+                raise ValueError("unknown selector: {}".format(selector))
+        self.selector = selector(self.replicas) if self.replicas else None
+
+    def choose_replica(self):
+        if self.selector is None:
+            return self.primary
+        return self.selector.choose()
+
+    def stick(self, client=None):
+        "send client's reads to the primary for the next sticky_seconds"
+        now = _clock()
+        with self._sticky_lock:
+            if len(self._sticky_until) >= STICKY_SWEEP:
+                self._sticky_until = dict((c, until) for c, until in self._sticky_until.items()
+                                          if until > now)
+            self._sticky_until[client] = now + self.sticky_seconds
+
+    def is_sticky(self, client=None):
+        "whether client wrote within the last sticky_seconds"
+        return self._sticky_until.get(client, 0) > _clock()
+
+    def sessionmaker(self, **kwargs):
+        "a sessionmaker for RoutingSessions on this router"
+        return sessionmaker(class_=RoutingSession, router=self, **kwargs)
+
+    def close(self):
+        if self.selector is not None:
+            self.selector.close()
+
+
+class RoutingSession(Session):
+    """
+    a Session that picks an engine per statement; see the module docstring
+    for the rules.  client is the token the router's sticky window is kept
+    under
+    """
+
+    def __init__(self, router=None, client=None, **kwargs):
+        super(RoutingSession, self).__init__(**kwargs)
+        self.router = router
+        self.client = client
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.reads_from_primary() or (clause is not None and getattr(clause, 'is_dml', False)):
+            return self.router.primary
+        return self.router.choose_replica()
+
+    def reads_from_primary(self):
+        "whether reads in this session have to go to the primary right now"
+        return bool(self._flushing
+                    or self.info.get(FORCE_PRIMARY)
+                    or self.info.get(WROTE)
+                    or self.router.is_sticky(self.client))
+
+    @contextlib.contextmanager
+    def primary(self):
+        "send every statement in the block to the primary"
+        previous = self.info.get(FORCE_PRIMARY)
+        self.info[FORCE_PRIMARY] = True
+        try:
+            yield self
+        finally:
+            self.info[FORCE_PRIMARY] = previous
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _after_flush(session, flush_context):
+    session.info[WROTE] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _after_commit(session):
+    if session.info.pop(WROTE, False):
+        session.router.stick(session.client)
+
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def _after_rollback(session):
+    session.info.pop(WROTE, None)
+
+
+################################################################################
+# local demo: SQLite files as replicas
+
+def replicate(primary, replica_paths):
+    "copy the primary database over every replica file, like a replication catch up"
+    schema = importlib.import_module('schema')
+    for path in replica_paths:
+        # the backup API takes the replica's locks, so open connections see
+        # the new pages on their next read
+        schema.snapshot(primary, path)
+
+
+class StatementsPerEngine(object):
+    "how many statements each engine ran"
+
+    def __init__(self, engines):
+        self.counts = collections.Counter()
+        self.names = {}
+        for name, engine in engines:
+            self.names[engine] = name
+            event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, conn, cursor, statement, parameters, context, executemany):
+        self.counts[self.names[conn.engine]] += 1
+
+    def reset(self):
+        counts = dict(self.counts)
+        self.counts.clear()
+        return counts
+
+
+def demo(num_pets=10000, reads=300, sticky_seconds=0.5):
+    bulk_load = importlib.import_module('bulk_load')
+    directory = tempfile.mkdtemp(prefix='pets-replicas-')
+    paths = [os.path.join(directory, name) for name in ('primary.db', 'replica1.db', 'replica2.db')]
+    try:
+        primary = db.make_engine('sqlite:///{}'.format(paths[0]),
+                                 sqlite_pragmas=[('journal_mode', 'DELETE')])
+        model.init_db(primary)
+        bulk_load.load_pets(primary, bulk_load.synthetic_records(num_pets))
+        replicate(primary, paths[1:])
+        replicas = [db.make_engine('sqlite:///{}'.format(path)) for path in paths[1:]]
+        counter = StatementsPerEngine([('primary', primary), ('replica1', replicas[0]),
+                                       ('replica2', replicas[1])])
+
+        for selector in ('round_robin', 'least_latency'):
+            router = Router(primary, replicas, selector, sticky_seconds=sticky_seconds)
+            Session = router.sessionmaker()
+
+            # reads spread out
+            db_session = Session()
+            for i in range(reads):
+                db_session.query(model.Pet).filter(model.Pet.id == i % num_pets + 1).one()
+            db_session.close()
+            log.info("{}: {} reads went to {}".format(selector, reads, counter.reset()))
+
+            # a slow replica loses its traffic to least_latency
+            def slow(conn, cursor, statement, parameters, context, executemany):
+                time.sleep(0.002)
+            event.listen(replicas[0], 'before_cursor_execute', slow)
+            db_session = Session()
+            for i in range(reads):
+                db_session.query(func.count(model.Pet.id)).scalar()
+            db_session.close()
+            event.remove(replicas[0], 'before_cursor_execute', slow)
+            log.info("{} with replica1 2ms slower: {}".format(selector, counter.reset()))
+            router.close()
+
+        # read your writes
+        router = Router(primary, replicas, 'round_robin', sticky_seconds=sticky_seconds)
+        Session = router.sessionmaker()
+        db_session = Session()
+        pet = model.Pet(name='Fresh Pet', age=1, adopted=False)
+        db_session.add(pet)
+        db_session.flush()
+        assert db_session.query(model.Pet).filter_by(name='Fresh Pet').count() == 1
+        db_session.commit()
+        pet_id = pet.id
+        db_session.close()
+        # the next request gets a new session, which still reads the write
+        with Session() as next_request:
+            assert next_request.get(model.Pet, pet_id).name == 'Fresh Pet'
+            assert next_request.query(model.Pet).filter_by(id=pet_id).count() == 1
+        writes = counter.reset()
+        assert set(writes) == set(['primary']), writes
+        log.info("inside the sticky window every statement went to the primary: {}".format(writes))
+
+        time.sleep(sticky_seconds)
+        with Session() as later:
+            assert later.query(model.Pet).filter_by(id=pet_id).count() == 0
+        log.info("after the window the replicas don't have the pet yet: {}".format(counter.reset()))
+
+        # with client tokens only the client that wrote sticks
+        with Session(client='alice') as alice:
+            with alice.primary():
+                alice.get(model.Pet, pet_id).age = 2
+            alice.commit()
+        with Session(client='alice') as alice, Session(client='bob') as bob:
+            assert alice.get(model.Pet, pet_id).age == 2
+            assert bob.query(model.Pet).filter_by(id=pet_id).count() == 0
+        log.info("alice wrote, alice reads the primary and bob the replicas: {}".format(counter.reset()))
+        time.sleep(sticky_seconds)
+        replicate(primary, paths[1:])
+        with Session() as fresh:
+            assert fresh.query(model.Pet).filter_by(id=pet_id).count() == 1
+        log.info("after replicate() they do: {}".format(counter.reset()))
+        router.close()
+
+        for engine in [primary] + replicas:
+            engine.dispose()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    num_pets = int(args[0]) if len(args) > 0 else 10000
+    reads = int(args[1]) if len(args) > 1 else 300
+    demo(num_pets, reads)
+    log.info("all done!")
@@ -0,0 +1,428 @@
+"""
+versioned schema bootstrap and SQLite snapshots
+
+init_db() drops and recreates every table, which throws the data away and
+pays for all the DDL on every start.  bootstrap() starts warm instead:
+
+  - the schema_version table records a fingerprint of the DDL Base.metadata
+    would emit; when it matches, bootstrap() costs one SELECT
+  - otherwise the live schema is inspected and only what is missing is
+    added: tables, columns (ALTER TABLE ... ADD COLUMN) and indexes.
+    Changes that cannot be applied in place (a changed column type, a
+    dropped column, a foreign key with another ON DELETE rule, a unique
+    constraint, an index on other columns) are logged and left for a
+    hand-written migration; until it is done no fingerprint is recorded,
+    so every bootstrap() inspects the schema again and logs them again
+  - then the DATA_MIGRATIONS run, rewriting rows an older version stored in
+    another form.  Each is safe to run again, and their names are part of
+    the fingerprint, so adding one makes every database run them once
+
+    engine = db.make_engine('sqlite:///pets.db')
+    bootstrap(engine)
+
+snapshot() and restore() copy a whole SQLite database with the sqlite3
+backup API, so a pre-seeded file can be restored into memory (or another
+file) page by page instead of being seeded again.
+
+run as a script to benchmark process start and first query latency on a
+large existing database:
+
+    python schema.py [url] [number of pets]
+"""
+import datetime
+import hashlib
+import importlib
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table
+from sqlalchemy import inspect, select
+from sqlalchemy.schema import CreateColumn, CreateIndex, CreateTable, UniqueConstraint
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+
+################################################################################
+# schema_version table
+
+version_metadata = MetaData()
+
+schema_version = Table('schema_version', version_metadata,
+    Column('id', Integer, primary_key=True),
+    Column('fingerprint', String(40), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+
+# data migrations bootstrap() runs on the model's database, in order, as
+# (name, module, function); the function takes a connection and returns the
+# rows it changed
+DATA_MIGRATIONS = [
+    ('person._phone formatted as 555-555-5555', 'contacts', 'reformat_stored'),
+]
+
+
+def fingerprint(dialect, metadata=None, migrations=None):
+    """
+    sha1 of the CREATE TABLE/INDEX statements metadata emits on dialect and
+    the names of the data migrations
+    """
+    if metadata is None:
+        metadata = model.Base.metadata
+        if migrations is None:
+            migrations = DATA_MIGRATIONS
+    digest = hashlib.sha1()
+    for name, module, function in migrations or ():
+        digest.update(name.encode('utf-8'))
+    for table in metadata.sorted_tables:
+        digest.update(str(CreateTable(table).compile(dialect=dialect)).encode('utf-8'))
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            digest.update(str(CreateIndex(index).compile(dialect=dialect)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def stored_fingerprint(conn):
+    "the fingerprint recorded by the last bootstrap, or None"
+    if not inspect(conn).has_table(schema_version.name):
+        return None
+    return conn.execute(select(schema_version.c.fingerprint)
+                        .order_by(schema_version.c.id.desc())).scalar()
+
+
+################################################################################
+# deltas
+
+def _ondelete(rule):
+    "an ON DELETE rule as the database reports it; NO ACTION is the default"
+    if rule is None or rule.upper() == 'NO ACTION':
+        return None
+    return rule.upper()
+
+
+def _foreign_keys(table):
+    "(columns, referred table, referred columns) -> ON DELETE rule for table's foreign keys"
+    keys = {}
+    for fk in table.foreign_key_constraints:
+        elements = fk.elements
+        keys[(tuple(e.parent.name for e in elements), elements[0].column.table.name,
+              tuple(e.column.name for e in elements))] = _ondelete(fk.ondelete)
+    return keys
+
+
+def _live_foreign_keys(inspector, table_name):
+    keys = {}
+    for fk in inspector.get_foreign_keys(table_name):
+        keys[(tuple(fk['constrained_columns']), fk['referred_table'],
+              tuple(fk['referred_columns']))] = _ondelete(fk.get('options', {}).get('ondelete'))
+    return keys
+
+
+def _constraint_problems(inspector, table):
+    "foreign keys and unique constraints that differ between table and the database"
+    problems = []
+    model_keys = _foreign_keys(table)
+    live_keys = _live_foreign_keys(inspector, table.name)
+    for key in sorted(set(model_keys) | set(live_keys)):
+        columns, referred, referred_columns = key
+        described = "{}({}) -> {}({})".format(table.name, ', '.join(columns),
+                                              referred, ', '.join(referred_columns))
+        if key not in live_keys:
+            problems.append("foreign key {} is not in the database".format(described))
+        elif key not in model_keys:
+            problems.append("foreign key {} is not in the model".format(described))
+        elif model_keys[key] != live_keys[key]:
+            problems.append("foreign key {} is ON DELETE {} in the database, {} in the model".format(
+                described, live_keys[key] or 'NO ACTION', model_keys[key] or 'NO ACTION'))
+
+    model_unique = set(tuple(c.name for c in constraint.columns)
+                       for constraint in table.constraints
+                       if isinstance(constraint, UniqueConstraint))
+    live_unique = set(tuple(u['column_names'])
+                      for u in inspector.get_unique_constraints(table.name))
+    for columns in sorted(model_unique - live_unique):
+        problems.append("unique constraint on {}({}) is not in the database".format(
+            table.name, ', '.join(columns)))
+    for columns in sorted(live_unique - model_unique):
+        problems.append("unique constraint on {}({}) is not in the model".format(
+            table.name, ', '.join(columns)))
+    return problems
+
+
+def plan(conn, metadata=None):
+    """
+    what it takes to bring the database up to metadata, as (statements,
+    problems): DDL strings to run, in order, and descriptions of the
+    differences that can't be applied in place
+    """
+    if metadata is None:
+        metadata = model.Base.metadata
+    dialect = conn.dialect
+    inspector = inspect(conn)
+    existing = set(inspector.get_table_names())
+    statements = []
+    problems = []
+
+    for table in metadata.sorted_tables:
+        if table.name not in existing:
+            statements.append(str(CreateTable(table).compile(dialect=dialect)))
+            for index in sorted(table.indexes, key=lambda i: i.name):
+                statements.append(str(CreateIndex(index).compile(dialect=dialect)))
+            continue
+
+        live = dict((c['name'], c) for c in inspector.get_columns(table.name))
+        for column in table.c:
+            if column.name not in live:
+                if not column.nullable and column.server_default is None:
+                    problems.append("{}.{} is NOT NULL without a server default".format(
+                        table.name, column.name))
+                    continue
+                statements.append("ALTER TABLE {} ADD COLUMN {}".format(
+                    dialect.identifier_preparer.format_table(table),
+                    CreateColumn(column).compile(dialect=dialect)))
+            elif not column.type._compare_type_affinity(live[column.name]['type']):
+                problems.append("{}.{} is {} in the database, {} in the model".format(
+                    table.name, column.name, live[column.name]['type'], column.type))
+        for name in sorted(set(live) - set(table.c.keys())):
+            problems.append("{}.{} is not in the model".format(table.name, name))
+
+        problems.extend(_constraint_problems(inspector, table))
+
+        live_indexes = dict((i['name'], i) for i in inspector.get_indexes(table.name))
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            live = live_indexes.get(index.name)
+            if live is None:
+                statements.append(str(CreateIndex(index).compile(dialect=dialect)))
+                continue
+            columns = [c.name for c in index.columns]
+            if columns != list(live['column_names']) or bool(index.unique) != bool(live['unique']):
+                problems.append("index {} is {}({}) in the database, {}({}) in the model".format(
+                    index.name, 'unique ' if live['unique'] else '',
+                    ', '.join(str(c) for c in live['column_names']),
+                    'unique ' if index.unique else '', ', '.join(columns)))
+    return statements, problems
+
+
+def bootstrap(engine, metadata=None, migrations=None):
+    """
+    bring the database at engine up to metadata without dropping anything,
+    returns the DDL statements that were run, none when it was current.
+    migrations defaults to DATA_MIGRATIONS for the model's metadata and
+    none for any other.  The data migrations and the fingerprint only run
+    once nothing is left for a manual migration
+    """
+    if metadata is None:
+        metadata = model.Base.metadata
+        if migrations is None:
+            migrations = DATA_MIGRATIONS
+    migrations = migrations or ()
+    current = fingerprint(engine.dialect, metadata, migrations)
+    with engine.connect() as conn:
+        if stored_fingerprint(conn) == current:
+            return []
+
+    with engine.begin() as conn:
+        statements, problems = plan(conn, metadata)
+        for statement in statements:
+            log.debug("  - {}".format(statement.strip().splitlines()[0]))
+            conn.exec_driver_sql(statement)
+        for problem in problems:
+            log.warning("  - needs a manual migration: {}".format(problem))
+        if not problems:
+            for name, module, function in migrations:
+                rows = getattr(importlib.import_module(module), function)(conn)
+                log.debug("  - {}: {} rows".format(name, rows))
+            version_metadata.create_all(conn)
+            conn.execute(schema_version.insert(), {
+                'fingerprint': current, 'applied_at': datetime.datetime.utcnow()})
+    log.info("bootstrap(): {} statements applied, {} left for a manual migration".format(
+        len(statements), len(problems)))
+    return statements
+
+
+################################################################################
+# snapshots
+
+def _sqlite_connection(engine):
+    "the raw sqlite3 connection behind a pooled connection from engine"
+    if engine.dialect.name != 'sqlite':
+        raise ValueError("snapshots need SQLite, not {}".format(engine.dialect.name))
+    return engine.raw_connection()
+
+
+def snapshot(engine, path, pages=-1):
+    "copy the whole SQLite database behind engine into the file at path"
+    raw = _sqlite_connection(engine)
+    target = sqlite3.connect(path)
+    try:
+        raw.driver_connection.backup(target, pages=pages)
+    finally:
+        target.close()
+        raw.close()
+
+
+def restore(engine, path, pages=-1):
+    """
+    replace the SQLite database behind engine with the file at path; with an
+    in-memory engine the copy is the database every session then sees
+    """
+    raw = _sqlite_connection(engine)
+    source = sqlite3.connect(path)
+    try:
+        source.backup(raw.driver_connection, pages=pages)
+    finally:
+        source.close()
+        raw.close()
+
+
+################################################################################
+# benchmark
+
+def first_query(engine):
+    "the first thing a demo asks: how many pets, and one of them by id"
+    with engine.connect() as conn:
+        pet = model.Pet.__table__
+        count = conn.execute(select(pet.c.id).order_by(pet.c.id.desc()).limit(1)).scalar()
+        conn.execute(select(pet).where(pet.c.id == count // 2)).first()
+        return count
+
+
+def start(how, url, path):
+    """
+    what one process does from import to its first answered query:
+    drop/create and reseed, bootstrap an existing file, or restore a
+    snapshot into memory.  prints seconds to ready and the first query
+    latency
+    """
+    began = timeit.default_timer()
+    if how == 'restore':
+        engine = db.make_engine('sqlite://')
+        restore(engine, path)
+    else:
+        engine = db.make_engine(url)
+    if how == 'drop/create':
+        bulk_load = importlib.import_module('bulk_load')
+        num_pets = int(os.environ['PETS_BENCHMARK_PETS'])
+        model.init_db(engine)
+        bulk_load.load_pets(engine, bulk_load.synthetic_records(num_pets))
+    bootstrap(engine)
+    ready = timeit.default_timer()
+    first_query(engine)
+    print("{} {}".format(ready - began, timeit.default_timer() - ready))
+    engine.dispose()
+
+
+def benchmark(url, num_pets):
+    bulk_load = importlib.import_module('bulk_load')
+    engine = db.make_engine(url)
+    model.init_db(engine)
+    bulk_load.load_pets(engine, bulk_load.synthetic_records(num_pets))
+
+    # deltas: a lost index, a lost table, a lost column
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP INDEX ix_pet_adoptable")
+        conn.exec_driver_sql("DROP TABLE pet_to_pet")
+        conn.exec_driver_sql("ALTER TABLE person DROP COLUMN age")
+        # a phone number stored before numbers were stored formatted
+        conn.execute(model.Person.__table__.insert(), {
+            'first_name': 'Old', 'last_name': 'Phone', '_phone': '5552439988'})
+    statements = bootstrap(engine)
+    assert len(statements) == 4, statements
+    with engine.connect() as conn:
+        assert conn.execute(select(model.Person.__table__.c._phone)).scalar() == '555-243-9988'
+    with engine.connect() as conn:
+        assert plan(conn) == ([], [])
+    assert bootstrap(engine) == []
+    log.info("bootstrap() restored the missing index, table and column, reformatted the old phone "
+             "number, then had nothing to do")
+
+    # a table made before the foreign keys had ON DELETE rules, and an index
+    # on other columns: both are left for a manual migration
+    with engine.begin() as conn:
+        conn.execute(schema_version.delete())
+        conn.exec_driver_sql("DROP TABLE pet_to_pet")
+        conn.exec_driver_sql(
+            "CREATE TABLE pet_to_pet (left_pet_id INTEGER NOT NULL REFERENCES pet (id), "
+            "right_pet_id INTEGER NOT NULL REFERENCES pet (id), "
+            "PRIMARY KEY (left_pet_id, right_pet_id))")
+        conn.exec_driver_sql("CREATE INDEX ix_pet_to_pet_right_pet_id ON pet_to_pet (left_pet_id)")
+    with engine.connect() as conn:
+        statements, problems = plan(conn)
+    assert statements == [] and len(problems) == 3, problems
+    bootstrap(engine)
+    with engine.connect() as conn:
+        assert stored_fingerprint(conn) is None
+    log.info("bootstrap() reported {} problems and recorded no fingerprint".format(len(problems)))
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DROP TABLE pet_to_pet")
+    assert len(bootstrap(engine)) == 2
+    assert bootstrap(engine) == []
+
+    fd, snapshot_path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    start_time = timeit.default_timer()
+    snapshot(engine, snapshot_path)
+    log.info("snapshot of {} pets taken in {:.2f}s, {:,} KiB".format(
+        num_pets, timeit.default_timer() - start_time, os.path.getsize(snapshot_path) // 1024))
+    engine.dispose()
+
+    results = {}
+    env = dict(os.environ, PETS_BENCHMARK_PETS=str(num_pets))
+    try:
+        for how in ('bootstrap', 'restore', 'drop/create'):
+            began = timeit.default_timer()
+            output = subprocess.check_output(
+                [sys.executable, __file__, '--start', how, url, snapshot_path],
+                env=env, stderr=open(os.devnull, 'w'))
+            wall = timeit.default_timer() - began
+            ready, first = [float(n) for n in output.split()]
+            results[how] = (wall, ready, first)
+            log.info("{:>11}: process {:.3f}s, ready after {:.3f}s, first query {:.3f}ms".format(
+                how, wall, ready, first * 1000))
+    finally:
+        os.remove(snapshot_path)
+    return results
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['--start']:
+        start(*sys.argv[2:5])
+        sys.exit(0)
+
+    log.info("main executing:")
+    url, args = db.parse_args()
+    num_pets = int(args[0]) if args else 1000000
+
+    path = None
+    if db.is_sqlite_memory(url):
+        # an existing database has to outlive the process that made it
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        url = 'sqlite:///{}'.format(path)
+    try:
+        benchmark(url, num_pets)
+    finally:
+        if path:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+    log.info("all done!")
@@ -0,0 +1,493 @@
+"""
+horizontal sharding of shelters and pets by shelter region
+
+ShardMap spreads the shelter, pet and nickname association rows across N
+databases, where one database used to hold them all:
+
+  - a Shelter lives on the shard its region maps to.  Regions missing from
+    the directory, and shelters with no region, are placed by a hash of the
+    region or the name.  Its pets, their nickname associations and
+    pedigree links live on the same shard
+  - ids for sharded rows are handed out so that id % N is the shard, so
+    get(Pet, id) and filters on Pet.id, Pet.shelter_id, Shelter.id or
+    Shelter.region go straight to one shard
+  - Species, Breed, BreedTrait and Person rows are copied to every shard by
+    replicate(), so foreign keys hold and joins stay local.  Reads of them
+    go to one shard; ORM writes to them are refused
+  - everything else fans out to every shard and the results are
+    concatenated.  ShardMap.fan_out() runs a Core statement on all shards
+    in parallel threads; merged_counts() and merged_sorted() combine the
+    per-shard rows
+
+    shards = ShardMap([engine0, engine1, engine2], regions={'north': 0})
+    Session = shards.sessionmaker()
+    db_session = Session()
+    db_session.add(model.Shelter(name='Northside', region='north'))
+    ...
+    merged_counts(shards.fan_out(select(Pet.adopted, func.count()).group_by(Pet.adopted)))
+
+ORM queries that fan out concatenate the shard results, so ORDER BY,
+LIMIT and count() only hold per shard; use fan_out() and the merge
+functions for those.  A pet can't move to a shelter on another shard, or
+be the parent of a pet on another shard; those take a delete and an
+insert.  The id allocator lives in one process; several writing processes
+would need a sequence per shard (START shard INCREMENT BY N on Postgres).
+
+run as a script for a local demo with SQLite files as shards:
+
+    python sharding.py [number of shards] [number of pets]
+"""
+import collections
+import heapq
+import importlib
+import itertools
+import os
+import random
+import shutil
+import tempfile
+import threading
+import timeit
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import case, event, func, inspect, select
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import BindParameter
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+SHARDED = (model.Shelter, model.Pet, model.PetPersonAssociation)
+REPLICATED = (model.Species, model.Breed, model.BreedTrait, model.Person)
+
+# table name -> columns whose value % N is the shard of the row
+SHARD_KEYS = {
+    'shelter': ('id',),
+    'pet': ('id', 'shelter_id'),
+    'petPersonAssociation': ('id', 'pet_id'),
+}
+
+
+################################################################################
+# shard map
+
+class IdAllocator(object):
+    "ids for new sharded rows, so that id % N is the shard the row lives on"
+
+    def __init__(self, shard_map):
+        self.shard_map = shard_map
+        self._next = {}
+        self._lock = threading.Lock()
+
+    def next_ids(self, table, shard, count=1):
+        "count ids for new rows of table on shard"
+        n = len(self.shard_map)
+        with self._lock:
+            key = (table.name, shard)
+            if key not in self._next:
+                with self.shard_map.engines[shard].connect() as conn:
+                    top = conn.execute(select(func.max(table.c.id))).scalar() or 0
+                # the first id above top that belongs to this shard
+                self._next[key] = top + 1 + (shard - top - 1) % n
+            first = self._next[key]
+            self._next[key] = first + count * n
+        return range(first, first + count * n, n)
+
+
+class ShardMap(object):
+    """
+    the shard engines, numbered from 0, and the region directory, which
+    maps region names to shard numbers; replicated rows are read from
+    reference_shard
+    """
+
+    def __init__(self, engines, regions=None, reference_shard=0):
+        self.engines = list(engines)
+        self.regions = dict(regions or {})
+        self.reference_shard = reference_shard
+        self.allocator = IdAllocator(self)
+        self._pool = None
+
+    def __len__(self):
+        return len(self.engines)
+
+    @property
+    def shard_ids(self):
+        return list(range(len(self.engines)))
+
+    def shard_for_region(self, region):
+        if region in self.regions:
+            return self.regions[region]
+        return zlib.crc32(region.encode('utf-8')) % len(self.engines)
+
+    def shard_for_id(self, id):
+        return id % len(self.engines)
+
+    def shard_of(self, instance):
+        "the shard a Shelter, Pet or PetPersonAssociation belongs on"
+        if instance.id is not None:
+            return self.shard_for_id(instance.id)
+        token = inspect(instance).identity_token
+        if token is not None:
+            return token
+        if isinstance(instance, model.Shelter):
+            return self.shard_for_region(instance.region or instance.name)
+        if isinstance(instance, model.Pet):
+            if instance.shelter is not None:
+                return self.shard_of(instance.shelter)
+            if instance.shelter_id is not None:
+                return self.shard_for_id(instance.shelter_id)
+            # pets with no shelter
+            return 0
+        if isinstance(instance, model.PetPersonAssociation):
+            if instance.pet is not None:
+                return self.shard_of(instance.pet)
+            if instance.pet_id is not None:
+                return self.shard_for_id(instance.pet_id)
+        raise ValueError("no shard for {!r}".format(instance))
+
+    def shards_for_criteria(self, statement, params=None):
+        """
+        the shards a statement's top-level AND terms pin it to (an equality
+        or IN on a shard key), None when they don't
+        """
+        where = getattr(statement, 'whereclause', None)
+        if where is None:
+            return None
+        terms = where.clauses if getattr(where, 'operator', None) is operators.and_ else [where]
+        for term in terms:
+            left = getattr(term, 'left', None)
+            right = getattr(term, 'right', None)
+            table = getattr(left, 'table', None)
+            if table is None or not isinstance(right, BindParameter):
+                continue
+            if term.operator is operators.eq:
+                values = [_bound_value(right, params)]
+            elif term.operator is operators.in_op:
+                values = _bound_value(right, params) or []
+            else:
+                continue
+            values = [value for value in values if value is not None]
+            if not values:
+                continue
+            if table.name == 'shelter' and left.key == 'region':
+                return sorted(set(self.shard_for_region(value) for value in values))
+            if left.key in SHARD_KEYS.get(table.name, ()):
+                return sorted(set(self.shard_for_id(value) for value in values))
+        return None
+
+    # the three ShardedSession hooks
+
+    def _shard_chooser(self, mapper, instance, clause=None):
+        if instance is None:
+            # text() and other statements that name no entity; pass
+            # bind_arguments={'shard_id': n} to send them elsewhere
+            return 0
+        return self.shard_of(instance)
+
+    def _id_chooser(self, query, ident):
+        entity = query.column_descriptions[0]['entity']
+        if issubclass(entity, REPLICATED):
+            return [self.reference_shard]
+        return [self.shard_for_id(ident[0])]
+
+    def _execute_chooser(self, orm_context):
+        mappers = orm_context.all_mappers
+        replicated = bool(mappers) and all(issubclass(m.class_, REPLICATED) for m in mappers)
+        parent = orm_context.lazy_loaded_from
+        if parent is not None and (issubclass(parent.class_, SHARDED) or replicated):
+            # a relationship load comes from the parent's shard, unless it
+            # goes from a replicated row to sharded ones (Person.pet_associations)
+            return [parent.identity_token]
+        if replicated:
+            # bulk UPDATE/DELETE of replicated rows has to reach every copy
+            return [self.reference_shard] if orm_context.is_select else self.shard_ids
+        shards = self.shards_for_criteria(orm_context.statement, orm_context.parameters)
+        return shards if shards is not None else self.shard_ids
+
+    def sessionmaker(self, **kwargs):
+        "a sessionmaker for ShardedPetSessions on these shards"
+        return sessionmaker(class_=ShardedPetSession, shard_map=self, **kwargs)
+
+    def fan_out(self, statement, shard_ids=None, parallel=True):
+        "[(shard, rows)] from running a Core statement on each shard, in threads when parallel"
+        if shard_ids is None:
+            shard_ids = self.shard_ids
+
+        def run(shard):
+            with self.engines[shard].connect() as conn:
+                return shard, conn.execute(statement).fetchall()
+
+        if not parallel or len(shard_ids) == 1:
+            return [run(shard) for shard in shard_ids]
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=len(self.engines))
+        return list(self._pool.map(run, shard_ids))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+
+def _bound_value(bind, params):
+    "a bind parameter's value, from the execution parameters when given there"
+    if params and bind.key in params:
+        return params[bind.key]
+    return bind.effective_value
+
+
+class ShardedPetSession(ShardedSession):
+    "a ShardedSession routed by a ShardMap; see the module docstring"
+
+    def __init__(self, shard_map=None, **kwargs):
+        super(ShardedPetSession, self).__init__(
+            shard_chooser=shard_map._shard_chooser,
+            id_chooser=shard_map._id_chooser,
+            execute_chooser=shard_map._execute_chooser,
+            shards=dict(enumerate(shard_map.engines)),
+            **kwargs)
+        self.shard_map = shard_map
+
+
+@event.listens_for(ShardedPetSession, 'before_flush')
+def _before_flush(session, flush_context, instances):
+    for obj in itertools.chain(session.new, session.deleted, session.dirty):
+        if isinstance(obj, REPLICATED) and (obj in session.new or obj in session.deleted
+                                            or session.is_modified(obj, include_collections=False)):
+            raise ValueError("{} rows are copied to every shard, write them with replicate()".format(
+                type(obj).__name__))
+    # give new rows ids that name their shard before the flush picks one
+    shard_map = session.shard_map
+    for obj in session.new:
+        if isinstance(obj, SHARDED) and obj.id is None:
+            obj.id = shard_map.allocator.next_ids(type(obj).__table__, shard_map.shard_of(obj))[0]
+
+
+################################################################################
+# replicated rows and merging
+
+def replicate(shard_map, table, rows):
+    """
+    insert the same rows into table on every shard, one transaction per
+    shard; rows carry their ids so they match everywhere
+    """
+    rows = list(rows)
+    if 'id' in table.c and any('id' not in row for row in rows):
+        raise ValueError("replicated {} rows need their ids".format(table.name))
+    for engine in shard_map.engines:
+        with engine.begin() as conn:
+            conn.execute(table.insert(), rows)
+
+
+def merged_counts(results, keys=1):
+    "sum the columns after the first keys ones of grouped rows from every shard"
+    totals = collections.OrderedDict()
+    for shard, rows in results:
+        for row in rows:
+            key = tuple(row[:keys])
+            values = [value or 0 for value in row[keys:]]
+            if key in totals:
+                totals[key] = [a + b for a, b in zip(totals[key], values)]
+            else:
+                totals[key] = values
+    return sorted(key + tuple(values) for key, values in totals.items())
+
+
+def merged_sorted(results, key=None, reverse=False, limit=None):
+    "merge rows each shard returned already sorted by key, keeping the first limit"
+    merged = heapq.merge(*[rows for shard, rows in results], key=key, reverse=reverse)
+    return list(itertools.islice(merged, limit))
+
+
+################################################################################
+# local demo: SQLite files as shards
+
+REGIONS = ('north', 'south', 'east', 'west', 'coast', 'valley', 'hills', 'city')
+
+
+def seed_reference(shard_map, people=1000, num_traits=10):
+    "species, breeds, traits and people, copied to every shard"
+    bulk_load = importlib.import_module('bulk_load')
+    species_rows = []
+    breed_rows = []
+    for name in sorted(bulk_load.SPECIES_BREEDS):
+        species_rows.append({'id': len(species_rows) + 1, 'name': name})
+        for breed in bulk_load.SPECIES_BREEDS[name]:
+            breed_rows.append({'id': len(breed_rows) + 1, 'name': breed,
+                               'species_id': len(species_rows)})
+    replicate(shard_map, model.Species.__table__, species_rows)
+    replicate(shard_map, model.Breed.__table__, breed_rows)
+    replicate(shard_map, model.BreedTrait.__table__,
+              [{'id': i + 1, 'name': 'Trait{}'.format(i)} for i in range(num_traits)])
+    replicate(shard_map, model.Person.__table__,
+              [{'id': i + 1, 'first_name': 'First{}'.format(i), 'last_name': 'Last{}'.format(i),
+                '_phone': '555-555-{:04d}'.format(i % 10000)} for i in range(people)])
+    return [row['id'] for row in breed_rows]
+
+
+def seed_pets(shard_map, num_pets, breed_ids, people=1000, seed=0):
+    "pets spread over the shelters already on the shards, a third with a nickname"
+    rng = random.Random(seed)
+    shelters = {}
+    for shard, rows in shard_map.fan_out(select(model.Shelter.__table__.c.id)):
+        shelters[shard] = [id for id, in rows]
+    all_shelters = [(shard, id) for shard in shelters for id in shelters[shard]]
+    per_shard = collections.defaultdict(list)
+    for i in range(num_pets):
+        per_shard[rng.choice(all_shelters)].append(i)
+
+    pet = model.Pet.__table__
+    assoc = model.PetPersonAssociation.__table__
+    for shard in shard_map.shard_ids:
+        pets = []
+        for (pet_shard, shelter_id), numbers in sorted(per_shard.items()):
+            if pet_shard != shard:
+                continue
+            for i in numbers:
+                pets.append({'name': 'Pet {}'.format(i), 'age': rng.randrange(1, 16),
+                             'adopted': rng.random() < 0.3, 'breed_id': rng.choice(breed_ids),
+                             'shelter_id': shelter_id})
+        for row, id in zip(pets, shard_map.allocator.next_ids(pet, shard, len(pets))):
+            row['id'] = id
+        nicknamed = [row for row in pets if rng.random() < 0.3]
+        associations = [{'pet_id': row['id'], 'person_id': rng.randrange(people) + 1,
+                         'nickname': 'Nick {}'.format(row['id'])} for row in nicknamed]
+        for row, id in zip(associations, shard_map.allocator.next_ids(assoc, shard, len(associations))):
+            row['id'] = id
+        with shard_map.engines[shard].begin() as conn:
+            if pets:
+                conn.execute(pet.insert(), pets)
+            if associations:
+                conn.execute(assoc.insert(), associations)
+
+
+def demo(num_shards=4, num_pets=200000, repeat=5):
+    routing = importlib.import_module('routing')
+    directory = tempfile.mkdtemp(prefix='pets-shards-')
+    try:
+        engines = [db.make_engine('sqlite:///{}'.format(os.path.join(directory, 'shard{}.db'.format(i))))
+                   for i in range(num_shards)]
+        for engine in engines:
+            model.init_db(engine)
+        # half the regions have a home in the directory, the rest are hashed
+        shard_map = ShardMap(engines, regions=dict((region, i % num_shards)
+                                                  for i, region in enumerate(REGIONS[:4])))
+        breed_ids = seed_reference(shard_map)
+        counter = routing.StatementsPerEngine([('shard{}'.format(i), engine)
+                                               for i, engine in enumerate(engines)])
+        Session = shard_map.sessionmaker()
+
+        # ORM writes land on the shelter's shard
+        db_session = Session()
+        breeds = db_session.query(model.Breed).all()
+        shelters = [model.Shelter(name='{} Shelter {}'.format(region.title(), i), region=region)
+                    for region in REGIONS for i in range(2)]
+        db_session.add_all(shelters)
+        pets = [model.Pet(name='{} pet {}'.format(shelter.name, i), age=i + 1, adopted=False,
+                          breed=breeds[i % len(breeds)], shelter=shelter)
+                for shelter in shelters for i in range(3)]
+        db_session.add_all(pets)
+        db_session.add(model.PetPersonAssociation(pet=pets[0], person=db_session.get(model.Person, 1),
+                                                  nickname='Buddy'))
+        db_session.commit()
+        for shelter in shelters:
+            shard = shard_map.shard_for_region(shelter.region)
+            assert shard_map.shard_for_id(shelter.id) == shard
+            found = [s for s, rows in shard_map.fan_out(
+                select(model.Pet.__table__.c.id).where(model.Pet.__table__.c.shelter_id == shelter.id))
+                if rows]
+            assert found == [shard], (shelter, found)
+        log.info("shelters by shard: {}".format(dict(
+            (shard, sorted(s.region for s in shelters if shard_map.shard_of(s) == shard))
+            for shard in shard_map.shard_ids)))
+        try:
+            db_session.add(model.Species(name='Lizard'))
+            db_session.flush()
+            raise AssertionError("replicated rows written through the ORM")
+        except ValueError as e:
+            log.info("refused: {}".format(e))
+            db_session.rollback()
+        sample_id = pets[5].id
+        db_session.close()
+
+        seed_pets(shard_map, num_pets, breed_ids)
+        log.info("pets per shard: {}".format(dict(
+            (shard, rows[0][0]) for shard, rows in shard_map.fan_out(
+                select(func.count()).select_from(model.Pet.__table__)))))
+
+        # which shards each kind of query reaches
+        db_session = Session()
+        counter.reset()
+        pet = db_session.get(model.Pet, sample_id)
+        assert counter.reset() == {'shard{}'.format(shard_map.shard_for_id(sample_id)): 1}
+        assert pet.breed.name and pet.shelter.region
+        log.info("get(Pet) and its breed and shelter: {}".format(counter.reset()))
+        in_shelter = db_session.query(model.Pet).filter(model.Pet.shelter_id == pet.shelter_id).all()
+        assert all(p.shelter_id == pet.shelter_id for p in in_shelter)
+        log.info("pets in one shelter: {}".format(counter.reset()))
+        north = db_session.query(model.Shelter).filter(model.Shelter.region == 'north').all()
+        assert set(s.region for s in north) == set(['north'])
+        log.info("shelters in one region: {}".format(counter.reset()))
+        young = db_session.query(model.Pet.id).filter(model.Pet.age == 1).all()
+        log.info("pets aged 1, fanned out: {} rows from {}".format(len(young), counter.reset()))
+        person = db_session.get(model.Person, 1)
+        nicknames = [a.nickname for a in person.pet_associations]
+        assert 'Buddy' in nicknames
+        log.info("Person.pet_associations, fanned out: {} nicknames from {}".format(
+            len(nicknames), counter.reset()))
+        db_session.close()
+
+        # a grouped aggregate over every shard, one thread per shard or not
+        pet_table, breed, species = model.Pet.__table__, model.Breed.__table__, model.Species.__table__
+        by_species = (select(species.c.name, func.count(), func.sum(case((pet_table.c.adopted.is_(True), 1), else_=0)))
+                      .select_from(pet_table.join(breed, pet_table.c.breed_id == breed.c.id)
+                                   .join(species, breed.c.species_id == species.c.id))
+                      .group_by(species.c.name))
+        timings = {}
+        for parallel in (False, True):
+            start = timeit.default_timer()
+            for i in range(repeat):
+                totals = merged_counts(shard_map.fan_out(by_species, parallel=parallel))
+            timings[parallel] = (timeit.default_timer() - start) / repeat
+        assert sum(count for name, count, adopted in totals) == num_pets + len(pets)
+        log.info("pets and adoptions per species: {}".format(totals))
+        log.info("fan out: {:.3f}s one shard after another, {:.3f}s in parallel, {:.1f}x".format(
+            timings[False], timings[True], timings[False] / timings[True]))
+
+        oldest = merged_sorted(shard_map.fan_out(
+            select(pet_table.c.age, pet_table.c.id).order_by(pet_table.c.age.desc(), pet_table.c.id).limit(5)),
+            key=lambda row: (-row[0], row[1]), limit=5)
+        log.info("oldest five pets across shards: {}".format(oldest))
+
+        shard_map.close()
+        for engine in engines:
+            engine.dispose()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    num_shards = int(args[0]) if len(args) > 0 else 4
+    num_pets = int(args[1]) if len(args) > 1 else 200000
+    demo(num_shards, num_pets)
+    log.info("all done!")
@@ -0,0 +1,315 @@
+"""
+full-text search over pet, nickname, breed, trait and shelter names
+
+The name columns are plain strings, so finding "goldie" means an exact
+match or a LIKE '%goldie%' scan of every row.  The search_index here holds
+one document per name, in an FTS5 virtual table on SQLite or a table with a
+GIN indexed tsvector on Postgres, and triggers on the five source tables
+keep it current through ORM and Core writes alike:
+
+    for hit in search(conn, 'gold ret'):
+        print(hit.kind, hit.id, hit.name)
+
+Every word of the term matches as a prefix, all of them have to match, and
+hits come back best first (bm25 on SQLite, ts_rank on Postgres).  A
+nickname hit's id is the pet it belongs to.
+
+Like pet_search, nothing exists until init_text_search() is called, after
+init_db(), which drops the triggers along with the tables.
+
+run as a script to benchmark against LIKE scans:
+
+    python text_search.py [url] [number of pets]
+"""
+import collections
+import importlib
+import random
+import re
+import timeit
+
+from sqlalchemy import literal, select, text, union_all
+
+import db
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+Hit = collections.namedtuple('Hit', 'kind id name score')
+
+# (kind, code, source table, id column, name column); the document rowid is
+# source id * 8 + code, so triggers find their row by rowid, not by a scan
+SOURCES = [
+    ('pet', 1, 'pet', 'id', 'name'),
+    ('nickname', 2, 'petPersonAssociation', 'pet_id', 'nickname'),
+    ('breed', 3, 'breed', 'id', 'name'),
+    ('trait', 4, 'breedtrait', 'id', 'name'),
+    ('shelter', 5, 'shelter', 'id', 'name'),
+]
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+
+################################################################################
+# SQLite: an FTS5 table
+
+def _sqlite_ddl():
+    statements = [
+        "DROP TABLE IF EXISTS search_index",
+        "CREATE VIRTUAL TABLE search_index USING fts5("
+        "kind UNINDEXED, target_id UNINDEXED, name, tokenize = 'unicode61 remove_diacritics 2')",
+    ]
+    for kind, code, table, target, name in SOURCES:
+        row = "{{row}}.id * 8 + {}".format(code)
+        insert = ("INSERT INTO search_index (rowid, kind, target_id, name) "
+                  "SELECT {}, '{}', {{row}}.{}, {{row}}.{} WHERE {{row}}.{} IS NOT NULL".format(
+                      row, kind, target, name, name))
+        delete = "DELETE FROM search_index WHERE rowid = " + row
+        triggers = [
+            ('insert', 'INSERT', [insert.format(row='NEW')]),
+            ('delete', 'DELETE', [delete.format(row='OLD')]),
+            ('update', 'UPDATE OF {}, {}'.format(target, name),
+             [delete.format(row='OLD'), insert.format(row='NEW')]),
+        ]
+        for suffix, when, body in triggers:
+            trigger = '"{}_search_{}"'.format(table, suffix)
+            statements.append("DROP TRIGGER IF EXISTS {}".format(trigger))
+            statements.append('CREATE TRIGGER {} AFTER {} ON "{}" FOR EACH ROW BEGIN\n'
+                              '    {};\nEND'.format(trigger, when, table, ';\n    '.join(body)))
+    return statements
+
+
+def _sqlite_rebuild():
+    return ["DELETE FROM search_index"] + [
+        "INSERT INTO search_index (rowid, kind, target_id, name) "
+        "SELECT id * 8 + {}, '{}', {}, {} FROM \"{}\" WHERE {} IS NOT NULL".format(
+            code, kind, target, name, table, name)
+        for kind, code, table, target, name in SOURCES]
+
+
+def _sqlite_query(words):
+    match = ' '.join('"{}"*'.format(w.replace('"', '""')) for w in words)
+    return (text("SELECT kind, target_id, name, bm25(search_index) AS score "
+                 "FROM search_index WHERE search_index MATCH :match "
+                 "AND (:kind IS NULL OR kind = :kind) "
+                 "ORDER BY score LIMIT :limit"),
+            {'match': match})
+
+
+################################################################################
+# Postgres: a tsvector column with a GIN index
+
+def _postgresql_ddl():
+    statements = [
+        "DROP TABLE IF EXISTS search_index",
+        "CREATE TABLE search_index (id bigint PRIMARY KEY, kind text NOT NULL, "
+        "target_id integer NOT NULL, name text NOT NULL, document tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('simple', name)) STORED)",
+        "CREATE INDEX ix_search_index_document ON search_index USING gin (document)",
+    ]
+    for kind, code, table, target, name in SOURCES:
+        function = '{}_search'.format(table.lower())
+        statements.append(
+            "CREATE OR REPLACE FUNCTION {function}() RETURNS trigger AS $$\n"
+            "BEGIN\n"
+            "    IF TG_OP IN ('DELETE', 'UPDATE') THEN\n"
+            "        DELETE FROM search_index WHERE id = OLD.id * 8 + {code};\n"
+            "    END IF;\n"
+            "    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.{name} IS NOT NULL THEN\n"
+            "        INSERT INTO search_index (id, kind, target_id, name)\n"
+            "        VALUES (NEW.id * 8 + {code}, '{kind}', NEW.{target}, NEW.{name});\n"
+            "    END IF;\n"
+            "    RETURN NULL;\n"
+            "END\n"
+            "$$ LANGUAGE plpgsql".format(function=function, code=code, kind=kind,
+                                         target=target, name=name))
+        statements.append('DROP TRIGGER IF EXISTS {0} ON "{1}"'.format(function, table))
+        statements.append(
+            'CREATE TRIGGER {0} AFTER INSERT OR DELETE OR UPDATE OF {2}, {3} ON "{1}" '
+            'FOR EACH ROW EXECUTE PROCEDURE {0}()'.format(function, table, target, name))
+    return statements
+
+
+def _postgresql_rebuild():
+    return ["DELETE FROM search_index"] + [
+        "INSERT INTO search_index (id, kind, target_id, name) "
+        "SELECT id * 8 + {}, '{}', {}, {} FROM \"{}\" WHERE {} IS NOT NULL".format(
+            code, kind, target, name, table, name)
+        for kind, code, table, target, name in SOURCES]
+
+
+def _postgresql_query(words):
+    query = ' & '.join("{}:*".format(re.sub(r"[^\w]", '', w)) for w in words)
+    return (text("SELECT kind, target_id, name, "
+                 "ts_rank(document, to_tsquery('simple', :query)) AS score "
+                 "FROM search_index WHERE document @@ to_tsquery('simple', :query) "
+                 "AND (CAST(:kind AS text) IS NULL OR kind = :kind) "
+                 "ORDER BY score DESC LIMIT :limit"),
+            {'query': query})
+
+
+BACKENDS = {
+    'sqlite': (_sqlite_ddl, _sqlite_rebuild, _sqlite_query),
+    'postgresql': (_postgresql_ddl, _postgresql_rebuild, _postgresql_query),
+}
+
+
+def _backend(conn):
+    try:
+        return BACKENDS[conn.dialect.name]
+    except KeyError:
+        raise ValueError("no full-text search for {}".format(conn.dialect.name))
+
+
+################################################################################
+# setup
+
+def init_text_search(engine):
+    "create search_index and its triggers, then index every existing name"
+    log.info("init_text_search() engine: {}".format(engine))
+    with engine.begin() as conn:
+        for statement in _backend(conn)[0]():
+            conn.exec_driver_sql(statement)
+        rebuild(conn)
+
+
+def rebuild(conn):
+    "re-index every name, e.g. after loading with the triggers out of the way"
+    for statement in _backend(conn)[1]():
+        conn.exec_driver_sql(statement)
+    log.info("  - search_index rebuilt")
+
+
+################################################################################
+# searching
+
+def search(conn, term, kind=None, limit=20):
+    """
+    the best limit Hits for term, every word a prefix; kind restricts the
+    hits to one of pet, nickname, breed, trait, shelter
+    """
+    words = WORD.findall(term)
+    if not words:
+        return []
+    statement, params = _backend(conn)[2](words)
+    params.update(kind=kind, limit=limit)
+    return [Hit(*row) for row in conn.execute(statement, params)]
+
+
+def like_search(conn, term, kind=None, limit=20):
+    "the scan it replaces: every word somewhere in the name, LIKE '%word%'"
+    words = WORD.findall(term)
+    if not words:
+        return []
+    selects = []
+    for source_kind, code, table, target, name in SOURCES:
+        if kind is not None and kind != source_kind:
+            continue
+        t = model.Base.metadata.tables[table]
+        q = select(literal(source_kind).label('kind'), t.c[target].label('target_id'),
+                   t.c[name].label('name'), literal(0.0).label('score'))
+        for word in words:
+            q = q.where(t.c[name].like('%{}%'.format(word)))
+        selects.append(q)
+    statement = union_all(*selects).limit(limit)
+    return [Hit(*row) for row in conn.execute(statement)]
+
+
+################################################################################
+# benchmark
+
+SYLLABLES = ['ba', 'bi', 'lo', 'ma', 'ri', 'to', 'zu', 'ka', 'ne', 'po', 'sa', 'de',
+             'fi', 'go', 'lu', 'mi', 'no', 'pe', 'ru', 'ti']
+
+
+def names(seed=0):
+    "two made up words per name, e.g. 'Kalo Mitoru', from a few thousand words"
+    rng = random.Random(seed)
+    while True:
+        words = []
+        for i in range(2):
+            word = ''.join(rng.choice(SYLLABLES) for n in range(rng.choice((2, 3))))
+            words.append(word.capitalize())
+        yield ' '.join(words)
+
+
+def seed(engine, num_pets, num_nicknames=None):
+    bulk_load = importlib.import_module('bulk_load')
+    associations = importlib.import_module('associations')
+    if num_nicknames is None:
+        num_nicknames = num_pets // 5
+    model.init_db(engine)
+    name = names()
+    records = (dict(r, name=next(name)) for r in bulk_load.synthetic_records(num_pets))
+    bulk_load.load_pets(engine, records)
+    people = 1000
+    with engine.begin() as conn:
+        conn.execute(model.Person.__table__.insert(), [
+            {'first_name': 'First{}'.format(i), 'last_name': 'Last{}'.format(i)}
+            for i in range(people)])
+        rng = random.Random(1)
+        associations.add_nicknames(conn, ((rng.randrange(num_pets) + 1, i % people + 1,
+                                           next(name).split()[0])
+                                          for i in range(num_nicknames)))
+        conn.execute(model.BreedTrait.__table__.insert(), [
+            {'name': n} for n in ('Fluffy', 'Loyal', 'Talkative', 'Spotted', 'Golden')])
+
+
+def benchmark(engine, num_pets, repeat=20):
+    seed(engine, num_pets)
+    start = timeit.default_timer()
+    init_text_search(engine)
+    log.info("search_index built in {:.2f}s".format(timeit.default_timer() - start))
+
+    with engine.connect() as conn:
+        sample = [row.name for row in conn.execute(
+            select(model.Pet.__table__.c.name).limit(1000))]
+    terms = [sample[0], sample[1].split()[0][:4], sample[2].lower(),
+             sample[3].split()[1][:3] + ' ' + sample[3].split()[0][:2], 'Golden Ret']
+
+    # the triggers: inserts, renames and deletes are searchable at once
+    with engine.begin() as conn:
+        pet = model.Pet.__table__
+        new_id = conn.execute(pet.insert().values(name='Zyxwv Quokka')).inserted_primary_key[0]
+        assert [h.id for h in search(conn, 'zyx quok')] == [new_id]
+        conn.execute(pet.update().where(pet.c.id == new_id).values(name='Renamed Quokka'))
+        assert search(conn, 'zyx') == [] and search(conn, 'renam')[0].id == new_id
+        conn.execute(pet.delete().where(pet.c.id == new_id))
+        assert search(conn, 'quokka') == []
+
+    with engine.connect() as conn:
+        for term in terms:
+            results = {}
+            for name, find in (('fts', search), ('like', like_search)):
+                start = timeit.default_timer()
+                for i in range(repeat):
+                    hits = find(conn, term, limit=20)
+                results[name] = ((timeit.default_timer() - start) / repeat, len(hits))
+            log.info("{!r:>16}: {:8.3f}ms fts ({} hits), {:8.3f}ms LIKE ({} hits), {:.0f}x".format(
+                term, results['fts'][0] * 1000, results['fts'][1],
+                results['like'][0] * 1000, results['like'][1],
+                results['like'][0] / results['fts'][0]))
+        log.info("best hits for {!r}: {}".format(terms[0], search(conn, terms[0], limit=3)))
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    num_pets = int(args[0]) if args else 1000000
+
+    engine = db.make_engine(url)
+    benchmark(engine, num_pets)
+    engine.dispose()
+    log.info("all done!")
@@ -0,0 +1,513 @@
+"""
+write-behind buffer for high-rate column updates
+
+Flipping Pet.adopted or moving a pet to another shelter through the ORM
+costs a get(), an attribute change and a commit, one transaction per event.
+WriteBehind takes the same changes as plain values
+
+    buffer = WriteBehind(engine)
+    buffer.update(model.Pet, pet_id, adopted=True)
+    buffer.update(model.Pet, pet_id, shelter_id=3)     # merged with the above
+    buffer.update(model.Person, person_id, _phone='555-243-9988')
+    ...
+    buffer.close()
+
+and keeps only the latest value per row and column in memory.  A
+background thread writes them out every flush_interval seconds, or as soon
+as flush_rows rows are waiting, as one
+
+    UPDATE pet SET adopted=?, shelter_id=? WHERE pet.id = ?
+
+executemany per table and set of columns, all in one transaction.
+
+Backpressure: once max_pending rows are waiting, update() blocks until a
+flush makes room, and raises BufferFull if that takes longer than
+put_timeout.
+
+Failures: when a flush's transaction fails, its rows are retried one row
+per transaction.  A row the database still refuses (an IntegrityError or
+DataError, a shelter_id with no shelter say) is logged, counted in
+stats.dropped_rows and dropped, so one bad row can't hold up the rest.
+Any other error, the database being locked or gone, puts the rows not yet
+written back, under any newer values, for the next round.  An update whose
+id matches no row (the pet was deleted, say) writes nothing; its ids are
+logged and counted in stats.missing_rows, not in stats.rows_written.
+
+Draining: close() (or leaving a "with WriteBehind(...)" block) stops taking
+updates and flushes everything left; an atexit hook does the same when the
+process exits normally or on Ctrl-C.  Updates not yet flushed when the
+process is killed outright are lost, at most flush_interval seconds' worth,
+so only use this for changes that can be replayed from their source.
+
+Reads through a Session don't see buffered values until they are flushed;
+call flush() first where that matters.
+
+run as a script to benchmark against an ORM commit per event:
+
+    python write_behind.py [url] [number of events] [number of pets]
+"""
+import atexit
+import collections
+import importlib
+import random
+import threading
+import timeit
+
+from sqlalchemy import bindparam, func, select
+from sqlalchemy.exc import DataError, IntegrityError
+
+import db
+import instrument
+
+import logging
+
+################################################################################
+# set up logging - see: https://docs.python.org/2/howto/logging.html
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+console_handler = logging.StreamHandler()
+console_handler.setLevel(logging.DEBUG)
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+console_handler.setFormatter(formatter)
+log.addHandler(console_handler)
+
+# the domain model lives in the many-to-many demo script
+model = importlib.import_module('many-to-many')
+
+# entity -> the columns update() accepts for it
+UPDATABLE = {
+    model.Pet: ('adopted', 'shelter_id', 'breed_id', 'age'),
+    model.Person: ('_phone', 'age'),
+    model.Shelter: ('website',),
+}
+
+# entity -> column -> what update() passes values through, raising
+# ValueError on bad ones, so the buffer stores what the ORM would
+CONVERTERS = {
+    model.Person: {'_phone': model.format_phone},
+}
+
+# bind parameter name for the primary key, clear of every column name
+ID_PARAM = '_wb_id'
+
+# errors that mean the row itself is bad, not the connection
+BAD_ROW_ERRORS = (IntegrityError, DataError)
+
+# ids per SELECT when looking for the rows a batch missed
+MISSING_CHUNK = 500
+
+
+class BufferFull(RuntimeError):
+    "update() waited put_timeout seconds for room in the buffer"
+
+
+class BufferClosed(RuntimeError):
+    "update() after close()"
+
+
+################################################################################
+# metrics
+
+class WriteBehindStats(object):
+    "counters and flush latencies; coalescing is updates taken per row written"
+
+    def __init__(self):
+        self.updates = 0
+        self.rows_written = 0
+        self.statements = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.dropped_rows = 0
+        self.missing_rows = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.flush_latency = instrument.Histogram()
+
+    @property
+    def coalescing_ratio(self):
+        return self.updates / float(self.rows_written) if self.rows_written else 0.0
+
+    def as_dict(self):
+        return {
+            'updates': self.updates,
+            'rows_written': self.rows_written,
+            'statements': self.statements,
+            'flushes': self.flushes,
+            'failed_flushes': self.failed_flushes,
+            'dropped_rows': self.dropped_rows,
+            'missing_rows': self.missing_rows,
+            'coalescing_ratio': self.coalescing_ratio,
+            'backpressure_waits': self.waits,
+            'backpressure_seconds': self.wait_seconds,
+            'flush_latency': self.flush_latency.as_dict(),
+        }
+
+
+################################################################################
+# the buffer
+
+class WriteBehind(object):
+    """
+    coalescing update buffer in front of engine; see the module docstring.
+    flush_interval=None turns the background thread off, leaving flushes to
+    flush_rows and explicit flush() calls
+    """
+
+    def __init__(self, engine, flush_interval=0.5, flush_rows=1000, max_pending=10000,
+                 put_timeout=10.0):
+        self.engine = engine
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+        self.stats = WriteBehindStats()
+        # table -> id -> {column: latest value}
+        self._pending = collections.defaultdict(dict)
+        self._pending_rows = 0
+        self._closed = False
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        # one flush at a time, whichever thread asks
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        if flush_interval is not None:
+            self._thread = threading.Thread(target=self._run, name='write-behind')
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def pending(self):
+        "rows waiting to be written"
+        return self._pending_rows
+
+    def update(self, entity, id, **values):
+        "set columns of entity's row id, some time before the next flush ends"
+        if not values:
+            raise ValueError("no columns to update for {} {}".format(entity.__name__, id))
+        try:
+            allowed = UPDATABLE[entity]
+        except KeyError:
+            raise ValueError("no write-behind updates for {}".format(entity.__name__))
+        for name in values:
+            if name not in allowed:
+                raise ValueError("{}.{} can't be updated through write-behind".format(
+                    entity.__name__, name))
+        converters = CONVERTERS.get(entity, {})
+        values = dict((name, converters[name](value) if name in converters and value is not None
+                       else value)
+                      for name, value in values.items())
+        table = entity.__table__
+
+        with self._changed:
+            if self._closed:
+                raise BufferClosed("write-behind buffer is closed")
+            rows = self._pending[table]
+            if id not in rows and self._pending_rows >= self.max_pending:
+                self._wait_for_room()
+                if self._closed:
+                    # close() ran while we waited and has drained, or is draining
+                    raise BufferClosed("write-behind buffer closed while waiting for room")
+                rows = self._pending[table]
+            row = rows.get(id)
+            if row is None:
+                rows[id] = row = {}
+                self._pending_rows += 1
+            row.update(values)
+            self.stats.updates += 1
+            full = self._pending_rows >= self.flush_rows
+            if full:
+                self._changed.notify_all()
+        if full and self._thread is None:
+            self.flush()
+
+    def _wait_for_room(self):
+        # called holding the lock
+        self.stats.waits += 1
+        start = timeit.default_timer()
+        self._changed.notify_all()
+        if self._thread is None:
+            self._lock.release()
+            try:
+                self.flush()
+            finally:
+                self._lock.acquire()
+        deadline = start + self.put_timeout
+        while self._pending_rows >= self.max_pending and not self._closed:
+            remaining = deadline - timeit.default_timer()
+            if remaining <= 0:
+                raise BufferFull("{} rows waiting after {}s".format(self._pending_rows, self.put_timeout))
+            self._changed.wait(remaining)
+        self.stats.wait_seconds += timeit.default_timer() - start
+
+    def _take(self):
+        "swap out everything pending"
+        with self._lock:
+            taken = self._pending
+            self._pending = collections.defaultdict(dict)
+            self._pending_rows = 0
+            return taken
+
+    def _put_back(self, taken):
+        "return rows from a failed flush without overwriting newer values"
+        with self._lock:
+            for table, rows in taken.items():
+                pending = self._pending[table]
+                for id, values in rows.items():
+                    newer = pending.get(id)
+                    if newer is None:
+                        pending[id] = values
+                        self._pending_rows += 1
+                    else:
+                        merged = dict(values)
+                        merged.update(newer)
+                        pending[id] = merged
+
+    def _statements(self, taken):
+        "(table, statement, params) per table and set of columns"
+        for table, rows in taken.items():
+            # executemany needs the same columns in every row
+            by_columns = collections.defaultdict(list)
+            for id, values in rows.items():
+                params = dict(values)
+                params[ID_PARAM] = id
+                by_columns[tuple(sorted(values))].append(params)
+            for columns, params in by_columns.items():
+                statement = (table.update()
+                             .where(table.c.id == bindparam(ID_PARAM))
+                             .values(dict((c, bindparam(c)) for c in columns)))
+                yield table, statement, params
+
+    def _execute(self, conn, table, statement, params):
+        "run one UPDATE executemany, returns the rows it matched"
+        result = conn.execute(statement, params)
+        if result.rowcount == len(params):
+            return len(params)
+        # some rows are gone, or the driver can't count an executemany
+        ids = [row[ID_PARAM] for row in params]
+        found = set()
+        for start in range(0, len(ids), MISSING_CHUNK):
+            found.update(conn.execute(select(table.c.id).where(
+                table.c.id.in_(ids[start:start + MISSING_CHUNK]))).scalars())
+        missing = [id for id in ids if id not in found]
+        if missing:
+            log.error("write-behind lost {} updates that matched no {} row, ids {}".format(
+                len(missing), table.name, missing[:20]))
+            with self._lock:
+                self.stats.missing_rows += len(missing)
+        return len(ids) - len(missing)
+
+    def _write_rows(self, taken):
+        """
+        after a failed batch: each row in its own transaction, dropping the
+        ones the database refuses; returns (rows written, statements)
+        """
+        done = set()
+        rows_written = 0
+        statements = 0
+        try:
+            for table, statement, params in self._statements(taken):
+                for row in params:
+                    id = row[ID_PARAM]
+                    try:
+                        with self.engine.begin() as conn:
+                            rows_written += self._execute(conn, table, statement, [row])
+                        statements += 1
+                    except BAD_ROW_ERRORS as e:
+                        log.error("write-behind dropped {} {}: {}".format(table.name, id, e.orig))
+                        with self._lock:
+                            self.stats.dropped_rows += 1
+                    done.add((table, id))
+        except Exception:
+            self._put_back(dict((table, dict((id, values) for id, values in rows.items()
+                                             if (table, id) not in done))
+                                for table, rows in taken.items()))
+            raise
+        return rows_written, statements
+
+    def flush(self):
+        "write out everything pending now; returns the rows written"
+        with self._flush_lock:
+            taken = self._take()
+            if not taken:
+                return 0
+            start = timeit.default_timer()
+            rows_written = 0
+            statements = 0
+            try:
+                with self.engine.begin() as conn:
+                    for table, statement, params in self._statements(taken):
+                        rows_written += self._execute(conn, table, statement, params)
+                        statements += 1
+            except Exception:
+                with self._lock:
+                    self.stats.failed_flushes += 1
+                log.warning("write-behind batch failed, retrying row by row", exc_info=True)
+                rows_written, statements = self._write_rows(taken)
+            elapsed = timeit.default_timer() - start
+            with self._changed:
+                self.stats.flushes += 1
+                self.stats.rows_written += rows_written
+                self.stats.statements += statements
+                self.stats.flush_latency.observe(elapsed)
+                self._changed.notify_all()
+            return rows_written
+
+    def _run(self):
+        while True:
+            with self._changed:
+                if not self._closed and self._pending_rows < self.flush_rows:
+                    self._changed.wait(self.flush_interval)
+                closed = self._closed
+            try:
+                self.flush()
+            except Exception:
+                log.exception("write-behind flush failed, {} rows kept for the next one".format(
+                    self._pending_rows))
+                if closed:
+                    return
+            if closed:
+                return
+
+    def close(self):
+        "stop taking updates and write out the rest"
+        with self._changed:
+            if self._closed:
+                return
+            self._closed = True
+            self._changed.notify_all()
+        atexit.unregister(self.close)
+        if self._thread is not None:
+            self._thread.join()
+        # whatever the thread's last flush could not write gets one more try
+        # here, and raises if that fails too
+        self.flush()
+        log.info("write-behind closed: {}".format(self.stats.as_dict()))
+
+
+################################################################################
+# benchmark
+
+def events(num_events, num_pets, num_shelters, hot=0.2, seed=0):
+    """
+    (pet_id, column, value) adoption and transfer events; four in five go
+    to the hot fraction of pets, as they do when a few shelters are busy
+    """
+    rng = random.Random(seed)
+    hot_pets = max(1, int(num_pets * hot))
+    result = []
+    for i in range(num_events):
+        if rng.random() < 0.8:
+            pet_id = rng.randrange(hot_pets) + 1
+        else:
+            pet_id = rng.randrange(num_pets) + 1
+        if rng.random() < 0.7:
+            result.append((pet_id, 'adopted', rng.random() < 0.5))
+        else:
+            result.append((pet_id, 'shelter_id', rng.randrange(num_shelters) + 1))
+    return result
+
+
+def apply_orm(session, events):
+    "the ORM way: get, set, commit per event"
+    for pet_id, column, value in events:
+        pet = session.get(model.Pet, pet_id)
+        setattr(pet, column, value)
+        session.commit()
+
+
+def expected_state(events):
+    final = {}
+    for pet_id, column, value in events:
+        final.setdefault(pet_id, {})[column] = value
+    return final
+
+
+def check_state(engine, final):
+    pet = model.Pet.__table__
+    with engine.connect() as conn:
+        rows = conn.execute(select(pet.c.id, pet.c.adopted, pet.c.shelter_id)
+                            .where(pet.c.id.in_(list(final)))).fetchall()
+    assert len(rows) == len(final)
+    for id, adopted, shelter_id in rows:
+        for column, value in final[id].items():
+            assert {'adopted': adopted, 'shelter_id': shelter_id}[column] == value, (id, column)
+
+
+def seed(engine, num_pets):
+    bulk_load = importlib.import_module('bulk_load')
+    model.init_db(engine)
+    bulk_load.load_pets(engine, bulk_load.synthetic_records(num_pets))
+    with engine.connect() as conn:
+        return conn.execute(select(func.count()).select_from(model.Shelter.__table__)).scalar()
+
+
+def benchmark(engine, num_events, num_pets, orm_events=20000):
+    num_shelters = seed(engine, num_pets)
+    stream = events(num_events, num_pets, num_shelters)
+
+    # the ORM path on a slice of the stream, it is too slow for all of it
+    orm_slice = stream[:orm_events]
+    db_session = db.make_session(engine)()
+    start = timeit.default_timer()
+    apply_orm(db_session, orm_slice)
+    orm = timeit.default_timer() - start
+    db_session.close()
+    check_state(engine, expected_state(orm_slice))
+    log.info("orm commit per event: {} events in {:.3f}s, {:,.0f} events/sec".format(
+        len(orm_slice), orm, len(orm_slice) / orm))
+
+    seed(engine, num_pets)
+    buffer = WriteBehind(engine)
+    start = timeit.default_timer()
+    for pet_id, column, value in stream:
+        buffer.update(model.Pet, pet_id, **{column: value})
+    taken = timeit.default_timer() - start
+    buffer.close()
+    drained = timeit.default_timer() - start
+    check_state(engine, expected_state(stream))
+    stats = buffer.stats.as_dict()
+    log.info("write-behind: {} events taken in {:.3f}s, drained by {:.3f}s, {:,.0f} events/sec".format(
+        len(stream), taken, drained, len(stream) / drained))
+    log.info("  {rows_written} rows written in {flushes} flushes, {statements} statements, "
+             "coalescing {coalescing_ratio:.2f}x, {backpressure_waits} backpressure waits".format(**stats))
+    log.info("  flush latency p50 {p50:.4f}s p99 {p99:.4f}s max {max:.4f}s".format(**stats['flush_latency']))
+    log.info("speedup: {:.0f}x".format((len(stream) / drained) / (len(orm_slice) / orm)))
+
+    # a tiny buffer with no background thread pushes back on the producer
+    seed(engine, num_pets)
+    with WriteBehind(engine, flush_interval=None, flush_rows=10 ** 9, max_pending=100) as small:
+        for pet_id, column, value in stream[:10000]:
+            small.update(model.Pet, pet_id, **{column: value})
+    assert small.stats.waits > 0
+    check_state(engine, expected_state(stream[:10000]))
+    log.info("max_pending=100: {} backpressure waits, {} flushes".format(
+        small.stats.waits, small.stats.flushes))
+
+    # updates to pets that don't exist are counted as missing, not written
+    with WriteBehind(engine, flush_interval=None) as missing:
+        missing.update(model.Pet, num_pets + 1, adopted=True)
+        missing.update(model.Pet, 1, adopted=True)
+        assert missing.flush() == 1
+    assert missing.stats.missing_rows == 1 and missing.stats.rows_written == 1
+    log.info("an update to a pet that doesn't exist was counted as missing")
+    return stats
+
+
+if __name__ == "__main__":
+    log.info("main executing:")
+    url, args = db.parse_args()
+    num_events = int(args[0]) if len(args) > 0 else 1000000
+    num_pets = int(args[1]) if len(args) > 1 else 100000
+
+    engine = db.make_engine(url)
+    benchmark(engine, num_events, num_pets)
+    engine.dispose()
+    log.info("all done!")